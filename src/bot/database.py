@@ -195,6 +195,26 @@ class Database:
                 logger.error(f"Error while fetching user data for chat ID: {chat_id}. Error: {e}")
                 return None
 
+    async def fetch_application_last_updated(self, chat_id, application_number, application_type, application_year):
+        """Fetch the time the status of a specific application for a user was last updated"""
+
+        query = """SELECT last_updated
+                   FROM Applications
+                   WHERE user_id = (SELECT user_id FROM Users WHERE chat_id = $1)
+                   AND application_number = $2
+                   AND application_type = $3
+                   AND application_year = $4"""
+        params = (chat_id, application_number, application_type, application_year)
+
+        async with self.pool.acquire() as conn:
+            try:
+                return await conn.fetchval(query, *params)
+            except Exception as e:
+                logger.error(
+                    f"Error while fetching last update time for user {chat_id} and number: {application_number}. Error: {e}"
+                )
+                return None
+
     async def fetch_application_status(self, chat_id, application_number, application_type, application_year):
         """Fetch the status and timestamp of a specific application for a user"""
 
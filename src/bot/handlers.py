@@ -13,7 +13,7 @@ SUBSCRIPTIONS_LIMIT = 5
 BUTTON_WAIT_SECONDS = 1
 FORCE_FETCH_LIMIT_SECONDS = 86400
 COMMANDS_LIST = ["status", "subscribe", "unsubscribe", "force_refresh", "lang", "start", "help", "reminder"]
-ADMIN_COMMANDS = ["admin_stats", "fetcher_stats", "admin_broadcast"]
+ADMIN_COMMANDS = ["admin_stats", "fetcher_stats", "admin_broadcast", "fetch_budget"]
 DEFAULT_LANGUAGE = "EN"
 LANGUAGE_LIST = ["EN 🏴󠁧󠁢󠁥󠁮󠁧󠁿|🇺🇸", "RU 🇷🇺", "CZ 🇨🇿", "UA 🇺🇦"]
 IETF_LANGUAGE_MAP = {"en": "EN", "ru": "RU", "cs": "CZ", "uk": "UA"}
@@ -743,6 +743,10 @@ async def fetcher_stats_command(update: Update, context: ContextTypes.DEFAULT_TY
             uptime_minutes = int(data["uptime"] / 60)
             uptime_hours = uptime_minutes // 60
             uptime_minutes %= 60
+            # newer fetchers report requests waiting for a free browser in the pool stats
+            waiting = data["request_state"].get("waiting")
+            if waiting is None:
+                waiting = sum(data.get("browser_pool", {}).get("waiting", {}).values())
             fetcher_stats = (
                 f"🤖 Fetcher ID: <b>{fetcher_id}</b>\n"
                 f"🌐 Connection to frs.gov.cz: <b>{data['connection_status']}</b>\n"
@@ -750,20 +754,83 @@ async def fetcher_stats_command(update: Update, context: ContextTypes.DEFAULT_TY
                 f"✅ Successes (last {ttl} mins): <b>{data['fetch_status']['success']}</b>\n"
                 f"❌ Failures (last {ttl} mins): <b>{data['fetch_status']['failed']}</b>\n"
                 f"🔄 Retries (last {ttl} mins): <b>{data['fetch_status']['retries']}</b>\n"
-                f"📤 Requests state - Waiting: <b>{data['request_state']['waiting']}</b> |"
-                f" Locked: <b>{data['request_state']['locked']}</b>\n"
+                f"⌛ Expired (last {ttl} mins): <b>{data['fetch_status'].get('expired', 0)}</b>\n"
+                f"🧩 Captcha rejections (last {ttl} mins): <b>{data['fetch_status'].get('captcha', 0)}</b>\n"
+                f"📤 Requests state - Waiting: <b>{waiting}</b> |"
+                f" Locked: <b>{data['request_state']['locked']}</b> |"
+                f" Coalesced: <b>{data['request_state'].get('coalesced', 0)}</b>\n"
                 f"📊 Success rate: <b>{data['rates']['success_rate']:.2f}</b>/{interval} min(s)\n"
                 f"📊 Failure rate: <b>{data['rates']['failure_rate']:.2f}</b>/{interval} min(s)\n"
                 f"📊 Retry rate: <b>{data['rates']['retry_rate']:.2f}</b>/{interval} min(s)\n"
                 f"⏱ Uptime: <b>{uptime_hours}h {uptime_minutes}m</b>\n"
                 f"🛠️ Version: {data['version']}\n"
             )
+            circuit_breaker = data.get("circuit_breaker")
+            if circuit_breaker and circuit_breaker["state"] != "closed":
+                fetcher_stats += (
+                    f"⛔ Circuit breaker: <b>{circuit_breaker['state']}</b>,"
+                    f" next probe in <b>{circuit_breaker['retry_in']}</b>s\n"
+                )
+            captcha_throttle = data.get("captcha_throttle")
+            if captcha_throttle and (captcha_throttle["spacing"] or captcha_throttle["cooling_fingerprints"]):
+                fetcher_stats += (
+                    f"🐢 Slowed down after captcha: fetches <b>{captcha_throttle['spacing']}</b>s apart |"
+                    f" Cooling fingerprints: <b>{captcha_throttle['cooling_fingerprints']}</b>\n"
+                )
+            fingerprints = data.get("fingerprints")
+            if fingerprints:
+                fetcher_stats += (
+                    f"🎭 Fingerprints - Active: <b>{fingerprints['active']}</b> |"
+                    f" Retired: <b>{fingerprints['retired']}</b> |"
+                    f" Success rate: <b>{fingerprints['success_rate']:.2f}</b>\n"
+                )
+            rate_limiter = data.get("rate_limiter")
+            if rate_limiter:
+                fetcher_stats += (
+                    f"🚦 Request budget: <b>{rate_limiter['rate']}</b>/s |"
+                    f" Granted: <b>{rate_limiter['granted']}</b> |"
+                    f" Waited: <b>{rate_limiter['wait_seconds']}</b>s"
+                    f"{' | Minting' if rate_limiter.get('minting') else ''}\n"
+                )
+            browser_pool = data.get("browser_pool", {})
+            if "cold_starts" in browser_pool:
+                fetcher_stats += (
+                    f"🦊 Browser starts - Cold: <b>{browser_pool['cold_starts']}</b>"
+                    f" ({browser_pool['avg_cold_start_seconds']}s) |"
+                    f" Warm: <b>{browser_pool['warm_starts']}</b> ({browser_pool['avg_warm_start_seconds']}s) |"
+                    f" Recycled: <b>{browser_pool.get('recycles', 0)}</b>\n"
+                )
+            if "blocked_per_fetch" in browser_pool:
+                fetcher_stats += (
+                    f"🧹 Per fetch - Blocked requests: <b>{browser_pool['blocked_per_fetch']}</b> |"
+                    f" Transferred: <b>{browser_pool['transferred_kb_per_fetch']}</b> KB\n"
+                )
 
             await update.message.reply_text(fetcher_stats)
     else:
         await update.message.reply_text("No fetcher metrics available for now.")
 
 
+# handler for /fetch_budget
+async def fetch_budget_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set the number of requests per second all fetchers together may send to the site"""
+    logging.info(f"💻 Received /fetch_budget command from {user_info(update)}")
+    if not _is_admin(update.effective_chat.id):
+        await update.message.reply_text("Unauthorized. This command is only for admins.")
+        return
+
+    try:
+        rate = float(context.args[0])
+    except (IndexError, ValueError):
+        rate = 0
+    if rate <= 0:
+        await update.message.reply_text("Usage: /fetch_budget <requests per second>, e.g. /fetch_budget 0.5")
+        return
+
+    await rabbit.publish_fetch_budget(rate)
+    await update.message.reply_text(f"🚦 Request budget set to <b>{rate}</b> request(s) per second")
+
+
 # Handler for /admin_broadcast
 async def admin_broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Initiates the admin broadcasting process"""
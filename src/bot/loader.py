@@ -26,13 +26,21 @@ DB_PORT = os.getenv("DB_PORT", 5432)
 RABBIT_HOST = os.getenv("RABBIT_HOST", "localhost")
 RABBIT_USER = os.getenv("RABBIT_USER", "bunny_admin")
 RABBIT_PASSWORD = os.getenv("RABBIT_PASSWORD", "password")
+# Route fetch/refresh requests to fetchers by a consistent hash of the application, must match the fetchers
+SHARDING_ENABLED = os.getenv("SHARDING_ENABLED", "false").lower() == "true"
 # Time in seconds before an application request can be requeued
 REQUEUE_THRESHOLD_SECONDS = int(os.getenv("REQUEUE_THRESHOLD_SECONDS", 3600))
+# Time in seconds fetchers should still process a request, stale refreshes are dropped (they get
+# re-issued anyway), stale fetches are served after the fresh ones
+REFRESH_DEADLINE_SECONDS = int(os.getenv("REFRESH_DEADLINE_SECONDS", REQUEUE_THRESHOLD_SECONDS))
+FETCH_DEADLINE_SECONDS = int(os.getenv("FETCH_DEADLINE_SECONDS", 900))
 # Application monitor config
 REFRESH_PERIOD = int(os.getenv("REFRESH_PERIOD", 3600))
 SCHEDULER_PERIOD = int(os.getenv("SCHEDULER_PERIOD", 300))
 NOT_FOUND_MAX_DAYS = int(os.getenv("NOT_FOUND_MAX_DAYS", 30))
 NOT_FOUND_REFRESH_PERIOD = int(os.getenv("NOT_FOUND_REFRESH_PERIOD", 86400))
+# Max number of applications sent to the fetchers in a single refresh message, 1 disables batching
+REFRESH_BATCH_SIZE = int(os.getenv("REFRESH_BATCH_SIZE", 10))
 # Run mode for tests
 RUN_MODE = os.getenv("RUN_MODE", "PROD")
 
@@ -78,6 +86,8 @@ class Loader:
                 requeue_ttl=REQUEUE_THRESHOLD_SECONDS,
                 metrics=metrics.Metrics(),
                 loop=loop,
+                sharded=SHARDING_ENABLED,
+                request_deadlines={"fetch": FETCH_DEADLINE_SECONDS, "refresh": REFRESH_DEADLINE_SECONDS},
             )
         return self._rabbit
 
@@ -1,7 +1,7 @@
 import asyncio
 import logging
 from datetime import timedelta
-from bot.loader import REFRESH_PERIOD, SCHEDULER_PERIOD, NOT_FOUND_REFRESH_PERIOD, NOT_FOUND_MAX_DAYS
+from bot.loader import REFRESH_PERIOD, SCHEDULER_PERIOD, NOT_FOUND_REFRESH_PERIOD, NOT_FOUND_MAX_DAYS, REFRESH_BATCH_SIZE
 from bot.utils import generate_oam_full_string
 
 logger = logging.getLogger(__name__)
@@ -40,6 +40,7 @@ class ApplicationMonitor:
         else:
             logger.info(f"{len(applications_to_update)} application(s) need status refresh")
 
+        messages = []
         for app in applications_to_update:
             message = {
                 "chat_id": app["chat_id"],
@@ -56,7 +57,15 @@ class ApplicationMonitor:
             logger.info(
                 f"Scheduling status refresh for {oam_full_string}, user: {app['chat_id']}, last_updated: {app['last_updated']}"
             )
-            await self.rabbit.publish_message(message, routing_key="RefreshStatusQueue")
+            messages.append(message)
+
+        # Batches let a fetcher load the page once and resubmit the form for every application
+        for start in range(0, len(messages), REFRESH_BATCH_SIZE):
+            batch = messages[start : start + REFRESH_BATCH_SIZE]
+            if len(batch) == 1:
+                await self.rabbit.publish_message(batch[0], routing_key="RefreshStatusQueue")
+            else:
+                await self.rabbit.publish_batch_message(batch, routing_key="RefreshStatusQueue")
 
     async def expire_stale_not_found_applications(self):
         applications_to_expire = await self.db.fetch_applications_to_expire(self.not_found_max_age)
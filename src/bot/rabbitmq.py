@@ -3,6 +3,8 @@ import aio_pika
 import asyncio
 import logging
 import hashlib
+import datetime
+import time
 import cachetools
 from aiormq.exceptions import AMQPConnectionError
 from bot.texts import message_texts
@@ -11,12 +13,16 @@ from bot.utils import MVCR_STATUSES, categorize_application_status, notify_user
 
 MAX_RETRIES = 5  # maximum number of connection retries
 RETRY_DELAY = 5  # delay (in seconds) between retries
+# holds the last request budget set for the fetchers, must be declared the same way by the fetchers
+FETCH_BUDGET_QUEUE = "FetchBudgetQueue"
+# fetcher queues which are fed by consistent-hash exchanges in sharded mode
+SHARDED_QUEUES = ("ApplicationFetchQueue", "RefreshStatusQueue")
 
 logger = logging.getLogger(__name__)
 
 
 class RabbitMQ:
-    def __init__(self, host, user, password, bot, db, requeue_ttl, metrics, loop):
+    def __init__(self, host, user, password, bot, db, requeue_ttl, metrics, loop, sharded=False, request_deadlines=None):
         self.host = host
         self.user = user
         self.password = password
@@ -29,6 +35,10 @@ class RabbitMQ:
         self.expiration_queue = None
         self.service_queue = None
         self.default_exchange = None
+        self.sharded = sharded
+        # request type -> seconds a request stays worth processing, fetchers drop or deprioritize it afterwards
+        self.request_deadlines = request_deadlines or {}
+        self.sharded_exchanges = {}
         self.published_messages = cachetools.TTLCache(maxsize=10000, ttl=requeue_ttl)
         self.metrics = metrics
 
@@ -45,6 +55,11 @@ class RabbitMQ:
                 self.expiration_queue = await self.channel.declare_queue("ExpirationQueue", durable=True)
                 self.service_queue = await self.channel.declare_queue("FetcherMetricsQueue", durable=False)
                 self.default_exchange = self.channel.default_exchange
+                if self.sharded:
+                    for queue_name in SHARDED_QUEUES:
+                        self.sharded_exchanges[queue_name] = await self.channel.declare_exchange(
+                            f"{queue_name}.sharded", aio_pika.ExchangeType.X_CONSISTENT_HASH, durable=True
+                        )
                 logger.info("Connected to RabbitMQ")
                 break  # Exit the loop if connection is successful
             except AMQPConnectionError as e:
@@ -64,6 +79,36 @@ class RabbitMQ:
         )
         return hashlib.md5(uid_string.encode()).hexdigest()
 
+    @staticmethod
+    def get_shard_key(message):
+        """Routing key placing all requests for the same application on the same fetcher"""
+        return f"{message['number']}/{str(message['type']).upper()}-{message['year']}"
+
+    def set_deadline(self, message):
+        """Stamp the request with the absolute time (epoch seconds) after which it is stale"""
+        ttl = self.request_deadlines.get(message["request_type"])
+        if ttl:
+            message.setdefault("deadline", time.time() + ttl)
+
+    async def is_update_outdated(self, msg_data):
+        """
+        Check if the application was updated after the request of this status update was issued
+
+        Only scheduled refreshes are checked: a fetch, a reminder or a forced refresh is answered
+        even when a refresh finished first and bumped the update time.
+        """
+        if msg_data.get("request_type") != "refresh" or msg_data.get("force_refresh") or msg_data.get("is_reminder"):
+            return False
+        requested_at = msg_data.get("last_updated", "0")
+        if not requested_at or requested_at == "0":
+            return False
+        last_updated = await self.db.fetch_application_last_updated(
+            msg_data["chat_id"], msg_data["number"], msg_data["type"], int(msg_data["year"])
+        )
+        if not last_updated:
+            return False
+        return datetime.datetime.fromisoformat(requested_at) < last_updated
+
     def is_message_published(self, unique_id):
         """Check if a message with the given unique ID has been published"""
         return unique_id in self.published_messages
@@ -118,6 +163,11 @@ class RabbitMQ:
                     logger.error(f"Failed to get current status from db for {oam_full_string}, user {chat_id}")
                     return
 
+                # a request re-issued after this one has already updated the application
+                if await self.is_update_outdated(msg_data):
+                    logger.info(f"[STALE] Discarding late status update for {oam_full_string}, user {chat_id}")
+                    return
+
                 has_changed = current_status != received_status
 
                 if failed and request_type == "refresh":
@@ -268,10 +318,56 @@ class RabbitMQ:
         if not self.default_exchange:
             raise Exception("Cannot publish message: default exchange is not initialized.")
 
-        await self.default_exchange.publish(aio_pika.Message(body=json.dumps(message).encode("utf-8")), routing_key=routing_key)
+        self.set_deadline(message)
+        body = aio_pika.Message(body=json.dumps(message).encode("utf-8"))
+        if routing_key in self.sharded_exchanges:
+            await self.sharded_exchanges[routing_key].publish(body, routing_key=self.get_shard_key(message))
+        else:
+            await self.default_exchange.publish(body, routing_key=routing_key)
         self.mark_message_as_published(unique_id)
         logger.debug(f"Message {unique_id} {message_tag} has been published to {routing_key}")
 
+    async def publish_batch_message(self, messages, routing_key="RefreshStatusQueue"):
+        """Publishes several requests in a single message, skipping the ones already published"""
+        if routing_key in self.sharded_exchanges:
+            # applications of a batch may belong to different fetchers, route them one by one
+            for message in messages:
+                await self.publish_message(message, routing_key=routing_key)
+            return
+        if not self.default_exchange:
+            raise Exception("Cannot publish message: default exchange is not initialized.")
+
+        batch = []
+        unique_ids = []
+        for message in messages:
+            unique_id = self.generate_unique_id(message)
+            if self.is_message_published(unique_id):
+                logger.warning(
+                    f"Message {unique_id} for {generate_oam_full_string(message)}, user: {message['chat_id']} "
+                    "has already been published. Skipping."
+                )
+                continue
+            self.set_deadline(message)
+            batch.append(message)
+            unique_ids.append(unique_id)
+        if not batch:
+            return
+
+        body = {"request_type": batch[0]["request_type"], "batch": batch}
+        await self.default_exchange.publish(aio_pika.Message(body=json.dumps(body).encode("utf-8")), routing_key=routing_key)
+        for unique_id in unique_ids:
+            self.mark_message_as_published(unique_id)
+        logger.debug(f"Batch of {len(batch)} message(s) has been published to {routing_key}")
+
+    async def publish_fetch_budget(self, rate):
+        """Publishes the requests per second all fetchers together may send, replacing the previous budget"""
+        await self.channel.declare_queue(FETCH_BUDGET_QUEUE, durable=True, arguments={"x-max-length": 1})
+        message = aio_pika.Message(
+            body=json.dumps({"rate": rate}).encode("utf-8"), delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+        )
+        await self.default_exchange.publish(message, routing_key=FETCH_BUDGET_QUEUE)
+        logger.info(f"Request budget of the fetchers set to {rate} request(s) per second")
+
     async def close(self):
         if self.connection:
             logger.info("Shutting down rabbit connection")
@@ -4,17 +4,42 @@ Read requests from the message queue, collect application status, post status up
 
 import logging
 import signal
+import sys
+from functools import partial
 import asyncio
 import uvloop
 
 from fetcher.config import FULL_VERSION, URL, LOG_LEVEL
 from fetcher.config import RABBIT_HOST, RABBIT_SSL_PORT, RABBIT_USER, RABBIT_PASSWORD
 from fetcher.config import RABBIT_SSL_CACERTFILE, RABBIT_SSL_CERTFILE, RABBIT_SSL_KEYFILE
+from fetcher.config import SHARDING_ENABLED
 from fetcher.config import ID, METRICS_TTL, METRICS_RATE, METRICS_SEND_INTERVAL
-from fetcher.browser import Browser
+from fetcher.config import BROWSER_POOL_SIZE, PAGE_LOAD_LIMIT_SECONDS
+from fetcher.config import BROWSER_RECYCLE_FETCHES, BROWSER_RECYCLE_AGE, BROWSER_RECYCLE_RSS_MB
+from fetcher.config import MAX_MESSAGES, REFRESH_MAX_MESSAGES, REFRESH_STARVATION_LIMIT, RETRY_DELAYS, JITTER_DELAYS
+from fetcher.config import STATUS_CACHE_SIZE, STATUS_CACHE_TTL_FETCH, STATUS_CACHE_TTL_REFRESH
+from fetcher.config import FETCH_RATE_LIMIT, FETCH_RATE_BURST
+from fetcher.config import CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS, CIRCUIT_MAX_OPEN_SECONDS
+from fetcher.config import CAPTCHA_COOLDOWN_SECONDS, CAPTCHA_MAX_COOLDOWN_SECONDS, CAPTCHA_SLOWDOWN_PERIOD
+from fetcher.config import CAPTCHA_SLOWDOWN_SECONDS, CAPTCHA_MAX_SLOWDOWN_SECONDS
+from fetcher.config import FINGERPRINT_BANDIT, FINGERPRINT_STORE, FINGERPRINT_MAX, FINGERPRINT_RETIRE_AFTER
+from fetcher.config import FINGERPRINT_RETIRED_TTL
+from fetcher.config import ADAPTIVE_CONCURRENCY, ADAPTIVE_MIN_BROWSERS, ADAPTIVE_INTERVAL, ADAPTIVE_DECREASE_FACTOR
+from fetcher.config import ADAPTIVE_LATENCY_THRESHOLD, ADAPTIVE_FAILURE_THRESHOLD
+from fetcher.config import FETCH_BACKEND, HTTP_BACKEND_ENDPOINT, HTTP_BACKEND_STATUS_FIELD, HTTP_BACKEND_MAX_CONNECTIONS
+from fetcher.browser import Browser, cookie_store
+from fetcher.browser_lifecycle import RecyclePolicy
+from fetcher.browser_pool import BrowserPool
+from fetcher.backends import BrowserBackend, HttpBackend
 from fetcher.messaging import Messaging
 from fetcher.application_processor import ApplicationProcessor
+from fetcher.captcha_throttle import CaptchaThrottle
+from fetcher.circuit_breaker import CircuitBreaker, probe_site
+from fetcher.concurrency import ConcurrencyController
+from fetcher.fingerprints import FingerprintManager
 from fetcher.metrics_collector import MetricsCollector
+from fetcher.rate_limiter import RabbitTokenBucket
+from fetcher.status_cache import StatusCache
 
 
 # Set up logging
@@ -37,13 +62,61 @@ def rabbit_ssl_params():
         return None
 
 
+def create_backend(browser_pool, rate_limiter=None):
+    """Create the configured fetch backend, the browser one is always there as a fallback"""
+    browser_backend = BrowserBackend(browser_pool)
+    if FETCH_BACKEND == "http":
+        if HTTP_BACKEND_ENDPOINT:
+            return HttpBackend(
+                endpoint=HTTP_BACKEND_ENDPOINT,
+                fallback=browser_backend,
+                status_field=HTTP_BACKEND_STATUS_FIELD,
+                max_connections=HTTP_BACKEND_MAX_CONNECTIONS,
+                timeout=PAGE_LOAD_LIMIT_SECONDS,
+                rate_limiter=rate_limiter,
+            )
+        logger.error("HTTP fetch backend requested, but HTTP_BACKEND_ENDPOINT is not set, using browser backend")
+    return browser_backend
+
+
 async def main():
     """Connect to the message queue, run fetch for the application data, post back status"""
     # Set up shutdown event
     shutdown_event = asyncio.Event()
 
-    browser_instance = Browser()
-    messaging_instance = Messaging(RABBIT_HOST, RABBIT_USER, RABBIT_PASSWORD)
+    messaging_instance = Messaging(RABBIT_HOST, RABBIT_USER, RABBIT_PASSWORD, retry_delays=RETRY_DELAYS, shard_id=ID)
+    rate_limiter = None
+    if FETCH_RATE_LIMIT > 0:
+        rate_limiter = RabbitTokenBucket(messaging_instance, rate=FETCH_RATE_LIMIT, burst=FETCH_RATE_BURST)
+    captcha_throttle = CaptchaThrottle(
+        cooldown_seconds=CAPTCHA_COOLDOWN_SECONDS,
+        max_cooldown_seconds=CAPTCHA_MAX_COOLDOWN_SECONDS,
+        slowdown_seconds=CAPTCHA_SLOWDOWN_SECONDS,
+        max_slowdown_seconds=CAPTCHA_MAX_SLOWDOWN_SECONDS,
+        slowdown_period=CAPTCHA_SLOWDOWN_PERIOD,
+    )
+    fingerprints = None
+    if FINGERPRINT_BANDIT:
+        fingerprints = FingerprintManager(
+            FINGERPRINT_STORE,
+            new_useragent=Browser.random_useragent,
+            max_fingerprints=FINGERPRINT_MAX,
+            retire_after=FINGERPRINT_RETIRE_AFTER,
+            retired_ttl=FINGERPRINT_RETIRED_TTL,
+        )
+    browser_pool = BrowserPool(
+        size=BROWSER_POOL_SIZE,
+        browser_factory=partial(
+            Browser, rate_limiter=rate_limiter, captcha_throttle=captcha_throttle, fingerprints=fingerprints
+        ),
+        starvation_limit=REFRESH_STARVATION_LIMIT,
+        recycle_policy=RecyclePolicy(BROWSER_RECYCLE_FETCHES, BROWSER_RECYCLE_AGE, BROWSER_RECYCLE_RSS_MB),
+    )
+    backend = create_backend(browser_pool, rate_limiter)
+    status_cache = StatusCache(
+        maxsize=STATUS_CACHE_SIZE,
+        ttl={"fetch": STATUS_CACHE_TTL_FETCH, "refresh": STATUS_CACHE_TTL_REFRESH},
+    )
     metrics_collector = MetricsCollector(
         fetcher_id=ID,
         messaging=messaging_instance,
@@ -52,7 +125,46 @@ async def main():
         rate=METRICS_RATE,
         send_interval=METRICS_SEND_INTERVAL,
     )
-    processor = ApplicationProcessor(messaging=messaging_instance, browser=browser_instance, metrics=metrics_collector, url=URL)
+    metrics_collector.add_stats_source("browser_pool", browser_pool.get_stats)
+    metrics_collector.add_stats_source("fetch_backend", backend.get_stats)
+    metrics_collector.add_stats_source("status_cache", status_cache.get_stats)
+    metrics_collector.add_stats_source("captcha_throttle", captcha_throttle.get_stats)
+    metrics_collector.add_stats_source("cookie_store", cookie_store.get_stats)
+    if fingerprints:
+        metrics_collector.add_stats_source("fingerprints", fingerprints.get_stats)
+    if rate_limiter:
+        metrics_collector.add_stats_source("rate_limiter", rate_limiter.get_stats)
+    controller = None
+    if ADAPTIVE_CONCURRENCY:
+        controller = ConcurrencyController(
+            browser_pool=browser_pool,
+            metrics=metrics_collector,
+            messaging=messaging_instance,
+            prefetch={"ApplicationFetchQueue": MAX_MESSAGES, "RefreshStatusQueue": REFRESH_MAX_MESSAGES},
+            min_limit=ADAPTIVE_MIN_BROWSERS,
+            interval=ADAPTIVE_INTERVAL,
+            latency_threshold=ADAPTIVE_LATENCY_THRESHOLD,
+            failure_threshold=ADAPTIVE_FAILURE_THRESHOLD,
+            decrease_factor=ADAPTIVE_DECREASE_FACTOR,
+        )
+        metrics_collector.add_stats_source("concurrency", controller.get_stats)
+    circuit_breaker = None
+    if CIRCUIT_FAILURE_THRESHOLD > 0:
+        circuit_breaker = CircuitBreaker(
+            failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+            open_seconds=CIRCUIT_OPEN_SECONDS,
+            max_open_seconds=CIRCUIT_MAX_OPEN_SECONDS,
+            probe=partial(probe_site, URL, timeout=PAGE_LOAD_LIMIT_SECONDS),
+        )
+        metrics_collector.add_stats_source("circuit_breaker", circuit_breaker.get_stats)
+    processor = ApplicationProcessor(
+        messaging=messaging_instance,
+        backend=backend,
+        metrics=metrics_collector,
+        url=URL,
+        status_cache=status_cache,
+        circuit_breaker=circuit_breaker,
+    )
 
     # Register the signal handlers
     loop = asyncio.get_running_loop()
@@ -62,19 +174,27 @@ async def main():
     # Connect to RabbitMQ & set up queues with their respective durability
     await messaging_instance.connect(ssl_params=rabbit_ssl_params())
     await messaging_instance.setup_queues(
+        with_retries=True,
+        sharded=SHARDING_ENABLED,
         ApplicationFetchQueue=True,
-        StatusUpdateQueue=True,
         RefreshStatusQueue=True,
     )
+    await messaging_instance.setup_queues(StatusUpdateQueue=True)
+    # refresh requests wait out their jitter in the broker
+    await messaging_instance.setup_delay_queues("RefreshStatusQueue", JITTER_DELAYS)
     # not durable for fetcher metric queue
     await messaging_instance.setup_queues(FetcherMetricsQueue=False)
+    if rate_limiter:
+        await rate_limiter.start()
 
     # Start processing requests in the background
-    asyncio.gather(
-        messaging_instance.consume_messages("ApplicationFetchQueue", processor.fetch_callback),
-        messaging_instance.consume_messages("RefreshStatusQueue", processor.refresh_callback),
-        metrics_collector.send_metrics(),
-    )
+    await messaging_instance.consume_messages("ApplicationFetchQueue", processor.fetch_callback, MAX_MESSAGES)
+    await messaging_instance.consume_messages("RefreshStatusQueue", processor.refresh_callback, REFRESH_MAX_MESSAGES)
+    background_tasks = [metrics_collector.send_metrics(), cookie_store.run()]
+    if controller:
+        # the controller scales the prefetch of the consumer channels, so it starts once they exist
+        background_tasks.append(controller.run())
+    asyncio.gather(*background_tasks)
 
     # Keep the loop running until a shutdown signal is received
     while not shutdown_event.is_set():
@@ -85,7 +205,16 @@ async def main():
         except asyncio.TimeoutError:
             pass
 
-    await processor.shutdown()
+    if rate_limiter:
+        await rate_limiter.close()
+    try:
+        await processor.shutdown()
+    finally:
+        # the figures and cookie jars gathered since the last save would be lost with the process
+        if fingerprints:
+            fingerprints.close()
+        cookie_store.close()
+    sys.exit(0)
 
 
 if __name__ == "__main__":
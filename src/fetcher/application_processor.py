@@ -1,72 +1,121 @@
 import json
 import logging
-import sys
+import time
 import asyncio
 import random
-from fetcher.config import JITTER_SECONDS, MAX_RETRIES
+from fetcher.config import JITTER_SECONDS, MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+from fetcher.config import RETRY_BUDGET_ATTEMPTS, RETRY_BUDGET_SECONDS
+from fetcher.retry_policy import RetryPolicy, PERMANENT, CAPTCHA
 
 logger = logging.getLogger(__name__)
 
 
 class ApplicationProcessor:
-    def __init__(self, messaging, browser, metrics, url):
+    def __init__(self, messaging, backend, metrics, url, status_cache=None, circuit_breaker=None):
         self.messaging = messaging
-        self.browser = browser
+        self.backend = backend
+        self.status_cache = status_cache
+        self.circuit_breaker = circuit_breaker
+        self.recovery_task = None
         self.metrics_collector = metrics
         self.url = url
         self.current_message = None
+        # single-flight registry: application key -> future resolved with the fetched status
         self.processing_apps = {"fetch": {}, "refresh": {}}
         self.lock = asyncio.Lock()
 
-    async def is_processing(self, request_type, app_number, app_type, app_year):
-        """Check if an application is currently being processed"""
-        key = (app_number, app_type, app_year)
-        async with self.lock:
-            if request_type == "refresh":
-                exists = key in self.processing_apps["fetch"] or key in self.processing_apps["refresh"]
-            elif request_type == "fetch":
-                exists = key in self.processing_apps["fetch"]
-            return exists
-
     async def start_processing(self, request_type, app_number, app_type, app_year):
-        """Mark an application as currently being processed"""
+        """
+        Join the in-flight fetch of an application or start a new one
+
+        Returns the future with the fetch result and whether the caller is the one to fetch it.
+        Fetch and refresh requests join each other, refresh jitter is spent before they get here.
+        """
         key = (app_number, app_type, app_year)
         async with self.lock:
+            for lane in self.processing_apps:
+                if key in self.processing_apps[lane]:
+                    return self.processing_apps[lane][key], False
             logger.info(f"[{app_number}/{app_type}-{app_year}][{request_type.upper()}] Locking for processing")
-            self.processing_apps[request_type][key] = True
+            flight = asyncio.get_running_loop().create_future()
+            self.processing_apps[request_type][key] = flight
             self.metrics_collector.increment_request_state("locked")
+            return flight, True
 
-    async def end_processing(self, request_type, app_number, app_type, app_year):
-        """Mark an application as done processing"""
+    async def end_processing(self, request_type, app_number, app_type, app_year, app_status=None):
+        """Mark an application as done processing and hand the result to the waiting requests"""
         key = (app_number, app_type, app_year)
         async with self.lock:
-            if key in self.processing_apps[request_type]:
+            flight = self.processing_apps[request_type].pop(key, None)
+            if flight:
                 logger.info(f"[{app_number}/{app_type}-{app_year}][{request_type.upper()}] Unlocking, processing finished")
-                del self.processing_apps[request_type][key]
+                flight.set_result(app_status)
                 self.metrics_collector.decrement_request_state("locked")
 
     def _get_app_details_from_message(self, message):
         """Extract application details from message body"""
         return json.loads(message.body.decode("utf-8"))
 
-    async def _manage_failed_request(self, message, queue_name):
-        """Manage failed requests by rescheduling them or sending an error message"""
-        app_details = self._get_app_details_from_message(message)
-        retry_count = message.headers.get("x-retry-count", 0) + 1
+    def _get_log_prefix(self, app_details, retry_count=None):
+        """Build the log prefix identifying a request"""
+        request_type = app_details.get("request_type", "fetch")
+        log_prefix_elements = [
+            f"[{app_details.get('number')}/{app_details.get('type').upper()}-{app_details.get('year')}]",
+            f"[{request_type.upper()}]",
+        ]
+        if retry_count:
+            log_prefix_elements.append(f"[X-RETRY {retry_count}]")
+        if app_details.get("force_refresh"):
+            log_prefix_elements.append("[FORCED]")
+        return "".join(log_prefix_elements)
+
+    def _get_queue_name(self, app_details):
+        return "ApplicationFetchQueue" if app_details.get("request_type", "fetch") == "fetch" else "RefreshStatusQueue"
+
+    def _get_retry_policy(self, message):
+        return RetryPolicy.from_headers(message.headers, RETRY_BUDGET_ATTEMPTS, RETRY_BUDGET_SECONDS)
 
-        if retry_count > MAX_RETRIES:
+    async def _reschedule_request(self, app_details, retry_count, queue_name, retry_policy=None):
+        """Reschedule a failed request or send an error message once it is out of retries"""
+        retry_count = (retry_count or 0) + 1
+
+        if retry_policy and not retry_policy.should_retry():
+            logger.error(
+                "Message is out of its retry budget (attempts left: %d, last error: %s): %s",
+                retry_policy.attempts,
+                retry_policy.last_error,
+                app_details,
+            )
+            await self._publish_failure(app_details)
+        elif retry_count > MAX_RETRIES:
             logger.error("Message exceeded max retries: %s", app_details)
-            app_details["status"] = self._generate_error_message(app_details)
-            app_details["failed"] = True
-            await self.messaging.publish_message("StatusUpdateQueue", app_details)
-            await message.ack()
-            self.metrics_collector.record_fetch_status("failed")
+            await self._publish_failure(app_details)
         else:
-            logger.info("Rescheduling message, x-retry-count: %d", retry_count)
-            await self.messaging.publish_message(queue_name, app_details, headers={"x-retry-count": retry_count})
-            await message.ack()
+            delay = self._get_retry_delay(retry_count)
+            headers = {"x-retry-count": retry_count}
+            if retry_policy:
+                # a retry after the deadline would be refused anyway
+                delay = max(1, min(delay, int(retry_policy.remaining_seconds())))
+                headers.update(retry_policy.to_headers())
+            logger.info("Rescheduling message in %d seconds, x-retry-count: %d", delay, retry_count)
+            await self.messaging.publish_delayed_message(queue_name, app_details, delay, headers=headers)
             self.metrics_collector.record_fetch_status("retried")
 
+    async def _publish_failure(self, app_details):
+        """Let the requester know the status couldn't be fetched"""
+        app_details["status"] = self._generate_error_message(app_details)
+        app_details["failed"] = True
+        await self.messaging.publish_message("StatusUpdateQueue", app_details)
+        self.metrics_collector.record_fetch_status("failed")
+
+    async def _manage_failed_request(self, message, queue_name, retry_policy=None):
+        """Manage failed requests by rescheduling them or sending an error message"""
+        app_details = self._get_app_details_from_message(message)
+        # the policy of the processed request carries the attempts it has used up
+        retry_policy = retry_policy or self._get_retry_policy(message)
+        await self._reschedule_request(app_details, message.headers.get("x-retry-count", 0), queue_name, retry_policy)
+        await message.ack()
+
     def _generate_error_message(self, app_details):
         """Generate an error message for an application number"""
         app_string = "OAM-{}-{}/{}-{} ERROR".format(
@@ -78,64 +127,221 @@ class ApplicationProcessor:
         """Process a fetch or refresh request"""
         retry_count = message.headers.get("x-retry-count")
         app_details = self._get_app_details_from_message(message)
+        request_type = app_details.get("request_type", "fetch")  # stub for dealing with old format messages in queue
+        # every path that reschedules the request carries on with the same budget
+        retry_policy = self._get_retry_policy(message)
+        if self._is_expired(app_details):
+            if request_type == "refresh":
+                return await self._drop_expired(message, app_details)
+            if not app_details.get("expired"):
+                # the user is still waiting for an answer, but fresh requests are served first
+                app_details["expired"] = True
+                self.metrics_collector.record_fetch_status("expired")
+        if request_type == "refresh" and not retry_count and not message.headers.get("x-jittered"):
+            return await self._defer_refresh(message, app_details)
+        if self.circuit_breaker and self.circuit_breaker.is_open:
+            return await self._defer_while_open(message, app_details)
+        if "batch" in app_details:
+            return await self._process_batch(message, app_details["batch"])
+
         number = app_details.get("number")
         type_ = app_details.get("type").upper()
         year = app_details.get("year")
-        request_type = app_details.get("request_type", "fetch")  # stub for dealing with old format messages in queue
-        forced = app_details.get("force_refresh")
-
-        log_prefix_elements = [f"[{number}/{type_}-{year}]", f"[{request_type.upper()}]"]
-        if retry_count:
-            log_prefix_elements.append(f"[X-RETRY {retry_count}]")
-        if forced:
-            log_prefix_elements.append("[FORCED]")
-        log_prefix = "".join(log_prefix_elements)
+        log_prefix = self._get_log_prefix(app_details, retry_count)
         logger.info("%s Received request: %s", log_prefix, app_details)
 
-        if await self.is_processing(request_type, number, type_, year) and not retry_count:
-            logger.info(
-                "%s Skipping request as it's currently being processed",
-                log_prefix,
-            )
-            await message.ack()
+        cached_status = self.status_cache.get(app_details, request_type) if self.status_cache else None
+        if cached_status:
+            logger.info("%s Answering from the status cache", log_prefix)
+            await self._handle_status(message, app_details, cached_status, log_prefix, retry_policy)
             return
 
+        flight, is_leader = await self.start_processing(request_type, number, type_, year)
+        if not is_leader:
+            logger.info("%s Application is currently being processed, waiting for its result", log_prefix)
+            self.metrics_collector.increment_request_state("coalesced")
+            try:
+                # shielded, so a cancelled follower doesn't cancel the result for everyone else
+                app_status = await asyncio.shield(flight)
+            finally:
+                self.metrics_collector.decrement_request_state("coalesced")
+            await self._handle_status(message, app_details, app_status, log_prefix, retry_policy)
+            return
+
+        app_status = None
         try:
-            await self.start_processing(request_type, number, type_, year)
-
-            if request_type == "refresh" and not retry_count:
-                sleep_time = self._get_sleep_time()
-                logger.info("%s Sleeping for %d seconds before processing request", log_prefix, sleep_time)
-
-                self.metrics_collector.increment_request_state("waiting")
-                await asyncio.sleep(sleep_time)
-                self.metrics_collector.decrement_request_state("waiting")
-
-            app_status = await self.browser.fetch(self.url, app_details)
-
-            # Check if the app number is not in the received_status
-            if app_status and str(number) not in app_status:
-                logger.warning(f"{log_prefix} Retrieved status does not match the expected app number. Requeueing...")
-                queue_name = "ApplicationFetchQueue" if request_type == "fetch" else "RefreshStatusQueue"
-                await self._manage_failed_request(message, queue_name)
-            elif app_status:
-                logger.info("%s Status update succeeded", log_prefix)
-                app_details["status"] = app_status
-                await message.ack()
-                await self.messaging.publish_message("StatusUpdateQueue", app_details)
-                logger.debug("%s Update message was pushed to StateUpdateQueue", log_prefix)
-                self.metrics_collector.record_fetch_status("success")
-            else:
-                logger.error("%s Status update failed", log_prefix)
-                queue_name = "ApplicationFetchQueue" if request_type == "fetch" else "RefreshStatusQueue"
-                await self._manage_failed_request(message, queue_name)
+            app_status = await self.backend.fetch(self.url, app_details, retry_policy=retry_policy)
+            if self.status_cache and app_status and str(number) in app_status:
+                self.status_cache.put(app_details, app_status)
+        except Exception as e:
+            logger.error("%s Error fetching status: %s", log_prefix, e)
+        finally:
+            await self.end_processing(request_type, number, type_, year, app_status)
+        if not app_status and retry_policy.last_error == CAPTCHA:
+            # the site answers, it only refused this fingerprint
+            self.metrics_collector.record_fetch_status("captcha")
+        # a rejected application doesn't tell anything about the health of the site
+        elif retry_policy.last_error != PERMANENT:
+            await self._record_outcome(bool(app_status))
+
+        await self._handle_status(message, app_details, app_status, log_prefix, retry_policy)
+
+    async def _publish_status(self, app_details, app_status, retry_count, log_prefix, retry_policy=None):
+        """Publish the fetched status for the requester or reschedule the request"""
+        number = app_details.get("number")
+        queue_name = self._get_queue_name(app_details)
+        # Check if the app number is not in the received_status
+        if app_status and str(number) not in app_status:
+            logger.warning(f"{log_prefix} Retrieved status does not match the expected app number. Requeueing...")
+            await self._reschedule_request(app_details, retry_count, queue_name, retry_policy)
+        elif app_status:
+            logger.info("%s Status update succeeded", log_prefix)
+            app_details["status"] = app_status
+            await self.messaging.publish_message("StatusUpdateQueue", app_details)
+            logger.debug("%s Update message was pushed to StateUpdateQueue", log_prefix)
+            self.metrics_collector.record_fetch_status("success")
+        else:
+            logger.error("%s Status update failed", log_prefix)
+            await self._reschedule_request(app_details, retry_count, queue_name, retry_policy)
 
+    async def _handle_status(self, message, app_details, app_status, log_prefix, retry_policy=None):
+        """Publish the outcome of a single request and acknowledge its message"""
+        try:
+            await self._publish_status(
+                app_details, app_status, message.headers.get("x-retry-count"), log_prefix, retry_policy
+            )
+            await message.ack()
         except Exception as e:
             logger.error("%s Error processing request: %s", log_prefix, e)
-            queue_name = "ApplicationFetchQueue" if request_type == "fetch" else "RefreshStatusQueue"
-            await self._manage_failed_request(message, queue_name)
+            await self._manage_failed_request(message, self._get_queue_name(app_details), retry_policy)
+
+    async def _process_batch(self, message, batch):
+        """
+        Process a refresh request carrying several applications
+
+        Statuses are fetched in one browser session and published one by one,
+        entries which failed are rescheduled as single refresh requests.
+        """
+        logger.info("[BATCH] Received refresh request for %d application(s)", len(batch))
+        pending = []
+        for app_details in batch:
+            app_details["request_type"] = "refresh"
+            log_prefix = self._get_log_prefix(app_details)
+            if self._is_expired(app_details):
+                logger.info("%s Request is past its deadline, dropping it", log_prefix)
+                self.metrics_collector.record_fetch_status("expired")
+                continue
+            cached_status = self.status_cache.get(app_details, "refresh") if self.status_cache else None
+            if cached_status:
+                logger.info("%s Answering from the status cache", log_prefix)
+                flight, is_leader = asyncio.get_running_loop().create_future(), False
+                flight.set_result(cached_status)
+            else:
+                flight, is_leader = await self.start_processing(
+                    "refresh", app_details["number"], app_details["type"].upper(), app_details["year"]
+                )
+            pending.append((app_details, log_prefix, flight, is_leader))
+
+        to_fetch = [app_details for app_details, _, _, is_leader in pending if is_leader]
+        retry_policies = {
+            id(app_details): RetryPolicy.from_headers(None, RETRY_BUDGET_ATTEMPTS, RETRY_BUDGET_SECONDS)
+            for app_details in to_fetch
+        }
+        statuses = [None] * len(to_fetch)
+        try:
+            if to_fetch:
+                statuses = await self.backend.fetch_batch(
+                    self.url, to_fetch, retry_policies=[retry_policies[id(app_details)] for app_details in to_fetch]
+                )
+        except Exception as e:
+            logger.error("[BATCH] Error fetching statuses: %s", e)
         finally:
-            await self.end_processing(request_type, number, type_, year)
+            for app_details, app_status in zip(to_fetch, statuses):
+                if self.status_cache and app_status and str(app_details["number"]) in app_status:
+                    self.status_cache.put(app_details, app_status)
+                await self.end_processing(
+                    "refresh", app_details["number"], app_details["type"].upper(), app_details["year"], app_status
+                )
+        captchas = len(
+            [
+                app_details
+                for app_details, app_status in zip(to_fetch, statuses)
+                if not app_status and retry_policies[id(app_details)].last_error == CAPTCHA
+            ]
+        )
+        for _ in range(captchas):
+            self.metrics_collector.record_fetch_status("captcha")
+        if to_fetch and not captchas:
+            await self._record_outcome(any(statuses))
+
+        for app_details, log_prefix, flight, _ in pending:
+            app_status = await asyncio.shield(flight)
+            try:
+                await self._publish_status(
+                    app_details, app_status, None, log_prefix, retry_policies.get(id(app_details))
+                )
+            except Exception as e:
+                logger.error("%s Error processing request: %s", log_prefix, e)
+        await message.ack()
+
+    def _get_retry_delay(self, retry_count):
+        """Exponential backoff for the retry attempt with jitter spreading it over its upper half"""
+        delay = min(RETRY_BASE_DELAY * 2 ** (retry_count - 1), RETRY_MAX_DELAY)
+        return max(1, int(random.uniform(delay / 2, delay)))
+
+    async def _defer_refresh(self, message, body):
+        """
+        Spread refresh requests over time
+
+        The request is parked in a backoff queue for a random delay and comes back
+        marked as jittered, so no consumer slot or processing lock is held meanwhile.
+        """
+        log_prefix = "[BATCH]" if "batch" in body else self._get_log_prefix(body)
+        sleep_time = self._get_sleep_time()
+        logger.info("%s Deferring request for %d seconds before processing it", log_prefix, sleep_time)
+        await self.messaging.publish_delayed_message("RefreshStatusQueue", body, sleep_time, headers={"x-jittered": True})
+        await message.ack()
+
+    @staticmethod
+    def _is_expired(body):
+        """Check if the request is past the deadline set by the bot, batches carry deadlines per entry"""
+        deadline = body.get("deadline")
+        return bool(deadline) and time.time() > deadline
+
+    async def _drop_expired(self, message, body):
+        """Acknowledge a stale request without processing it, the bot issues a new one when it's due"""
+        logger.info("%s Request is past its deadline, dropping it", self._get_log_prefix(body))
+        self.metrics_collector.record_fetch_status("expired")
+        await message.ack()
+
+    async def _defer_while_open(self, message, body):
+        """Park the request until the site is probed again, without using up its retries"""
+        log_prefix = "[BATCH]" if "batch" in body else self._get_log_prefix(body, message.headers.get("x-retry-count"))
+        # spread the parked requests, so they don't all come back at once
+        delay = int(self.circuit_breaker.remaining()) + random.randint(1, 60)
+        logger.info("%s Site is failing, deferring request for %d seconds", log_prefix, delay)
+        await self.messaging.publish_delayed_message(
+            self._get_queue_name(body), body, delay, headers=dict(message.headers)
+        )
+        await message.ack()
+
+    async def _record_outcome(self, succeeded):
+        """Feed the outcome of a fetch to the circuit breaker, pause consuming if it opens"""
+        if not self.circuit_breaker:
+            return
+        if succeeded:
+            self.circuit_breaker.record_success()
+        elif self.circuit_breaker.record_failure():
+            await self.messaging.pause_consumers()
+            if not self.recovery_task or self.recovery_task.done():
+                self.recovery_task = asyncio.create_task(self._recover())
+
+    async def _recover(self):
+        """Probe the site after the open period and resume consuming once the circuit isn't open"""
+        while self.circuit_breaker.is_open:
+            await asyncio.sleep(self.circuit_breaker.remaining())
+            await self.circuit_breaker.try_half_open()
+        await self.messaging.resume_consumers()
 
     def _get_sleep_time(self):
         """Generate a random sleep time between 5 and JITTER_SECONDS"""
@@ -150,11 +356,13 @@ class ApplicationProcessor:
         return await self._process_request(message, "refresh")
 
     async def shutdown(self):
+        if self.recovery_task:
+            self.recovery_task.cancel()
         if self.current_message:
             logger.info("Shuting down: NACK'ing message with delivery_tag: %s", self.current_message.delivery_tag)
             await self.current_message.nack()
+        await self.messaging.leave_shards()
         logger.info("Shutting down rabbit connection ...")
         await self.messaging.close()
-        logger.info("Shutting down browser ...")
-        self.browser.close()
-        sys.exit(0)
+        logger.info("Shutting down fetch backend ...")
+        await self.backend.close()
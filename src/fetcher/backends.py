@@ -0,0 +1,172 @@
+"""
+Pluggable backends used to fetch application status
+"""
+
+import asyncio
+import json
+import logging
+
+import aiohttp
+
+from fetcher.browser import Browser
+from fetcher.browser_pool import INTERACTIVE, BACKGROUND
+from fetcher.status_capture import RECAPTCHA_FAILED_MARKER
+
+logger = logging.getLogger(__name__)
+
+
+class FallbackRequired(Exception):
+    """The backend can't answer the request, it should be served by the fallback backend"""
+
+
+class FetchBackend:
+    """Interface of a status fetch backend"""
+
+    name = None
+
+    async def fetch(self, url, app_details, retry_policy=None):
+        """
+        Return the cleaned status text of the application, or None if it couldn't be fetched
+
+        Attempts are taken from the retry policy, and the error of a failed one is recorded in it.
+        """
+        raise NotImplementedError
+
+    async def fetch_batch(self, url, batch, retry_policies=None):
+        """Return statuses of several applications in the order of the batch, None for failed ones"""
+        retry_policies = retry_policies or [None] * len(batch)
+        return [
+            await self.fetch(url, app_details, retry_policy=retry_policy)
+            for app_details, retry_policy in zip(batch, retry_policies)
+        ]
+
+    def get_stats(self):
+        return {"name": self.name}
+
+    async def close(self):
+        pass
+
+
+class BrowserBackend(FetchBackend):
+    """Fetch status by filling the form in a real browser leased from the pool"""
+
+    name = "selenium"
+
+    def __init__(self, browser_pool):
+        self.browser_pool = browser_pool
+
+    async def fetch(self, url, app_details, retry_policy=None):
+        # user-initiated requests take the next free browser ahead of background refreshes and stale requests
+        is_fresh_fetch = app_details.get("request_type", "fetch") == "fetch" and not app_details.get("expired")
+        priority = INTERACTIVE if is_fresh_fetch else BACKGROUND
+        async with self.browser_pool.lease(priority) as slot:
+            logger.debug("[%s] Leased browser slot %d", app_details["number"], slot.slot_id)
+            return await slot.fetch(url, app_details, retry_policy=retry_policy)
+
+    async def fetch_batch(self, url, batch, retry_policies=None):
+        async with self.browser_pool.lease(BACKGROUND) as slot:
+            logger.debug("Leased browser slot %d for a batch of %d applications", slot.slot_id, len(batch))
+            return await slot.fetch_batch(url, batch, retry_policies=retry_policies)
+
+    async def close(self):
+        self.browser_pool.close()
+
+
+class HttpBackend(FetchBackend):
+    """Fetch status by calling the form submission endpoint over a pooled keep-alive session"""
+
+    name = "http"
+
+    def __init__(self, endpoint, fallback, status_field="message", max_connections=4, timeout=20, rate_limiter=None):
+        self.endpoint = endpoint
+        self.fallback = fallback
+        self.status_field = status_field
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.session = None
+        self.stats = {"served": 0, "fallback": 0}
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Accept-Language": "cs-CZ", "Accept": "application/json"},
+            )
+        return self.session
+
+    def _build_payload(self, app_details):
+        """Mirror the field names of the status form"""
+        return {
+            "proceedings": {
+                "referenceNumber": str(app_details["number"]),
+                "additionalSuffix": str(app_details["suffix"]),
+                "category": app_details["type"],
+                "year": str(app_details["year"]),
+            }
+        }
+
+    def _extract_status(self, data):
+        """Walk the dotted status field path in the response"""
+        for key in self.status_field.split("."):
+            if not isinstance(data, dict) or key not in data:
+                raise FallbackRequired(f"Field '{self.status_field}' is missing in the response")
+            data = data[key]
+        if not isinstance(data, str) or not data:
+            raise FallbackRequired(f"Field '{self.status_field}' is not a status text")
+        return data
+
+    async def _request_status(self, app_details):
+        if self.rate_limiter:
+            await self.rate_limiter.acquire()
+        session = self._get_session()
+        async with session.post(self.endpoint, json=self._build_payload(app_details)) as response:
+            body = await response.text()
+            if RECAPTCHA_FAILED_MARKER in body:
+                raise FallbackRequired("challenge has been hit")
+            if response.status != 200:
+                raise FallbackRequired(f"unexpected HTTP {response.status}")
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise FallbackRequired("response is not JSON")
+
+        status = Browser.clean_html(self._extract_status(data))
+        if str(app_details["number"]) not in status:
+            raise FallbackRequired("status doesn't mention the application number")
+        return status
+
+    async def fetch(self, url, app_details, retry_policy=None):
+        # the attempt is only spent on an answer actually used, a fallback spends its own
+        if retry_policy and retry_policy.exhausted():
+            return None
+        try:
+            status = await self._request_status(app_details)
+        except (FallbackRequired, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(
+                "[%s] HTTP backend couldn't fetch status (%s), falling back to %s",
+                app_details["number"],
+                str(e) or type(e).__name__,
+                self.fallback.name,
+            )
+            self.stats["fallback"] += 1
+            return await self.fallback.fetch(url, app_details, retry_policy=retry_policy)
+        if retry_policy:
+            retry_policy.spend()
+        logger.info("[%s] Application status fetched over HTTP", app_details["number"])
+        self.stats["served"] += 1
+        return status
+
+    async def fetch_batch(self, url, batch, retry_policies=None):
+        """Batches are left to the fallback, which serves them from a single session"""
+        self.stats["fallback"] += len(batch)
+        return await self.fallback.fetch_batch(url, batch, retry_policies=retry_policies)
+
+    def get_stats(self):
+        return {"name": self.name, **self.stats}
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+        await self.fallback.close()
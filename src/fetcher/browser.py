@@ -8,9 +8,11 @@ import logging
 import asyncio
 import random
 import os
-import time
-import json
 import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import partial
 from bs4 import BeautifulSoup
 from pyvirtualdisplay import Display
 from selenium import webdriver
@@ -22,11 +24,23 @@ from selenium.common.exceptions import (
     ElementClickInterceptedException,
     TimeoutException,
     NoSuchElementException,
+    StaleElementReferenceException,
 )
 from selenium.webdriver.common.action_chains import ActionChains
-import fake_useragent
 
 from fetcher.config import PAGE_LOAD_LIMIT_SECONDS, CAPTCHA_WAIT_SECONDS, OUTPUT_DIR, RETRY_INTERVAL
+from fetcher.config import WARM_PAGE, WARM_PAGE_MAX_REUSES, BROWSER_DISPLAY_MODE
+from fetcher.config import URL, PROFILE_TEMPLATE, PROFILE_DIR
+from fetcher.config import USERAGENT_CATALOGUE, USERAGENT_MAX_VERSION_LAG, FIREFOX_BINARY
+from fetcher.config import COOKIE_DIR, COOKIE_FLUSH_INTERVAL, COOKIE_SHARED
+from fetcher.config import RESOURCE_BLOCKING, RESOURCE_BLOCKED_TYPES, RESOURCE_ALLOWED_HOSTS
+from fetcher.browser_profile import ProfileTemplate
+from fetcher.browser_lifecycle import process_tree_rss
+from fetcher.resource_blocker import ResourceBlocker
+from fetcher.useragents import UserAgentCatalogue
+from fetcher.cookie_store import CookieStore
+from fetcher.retry_policy import TRANSIENT, PERMANENT, CAPTCHA
+from fetcher import status_capture
 
 logger = logging.getLogger(__name__)
 
@@ -37,49 +51,170 @@ class CustomMaxRetryError(Exception):
         self.url = url
 
 
+class CaptchaRejectedError(Exception):
+    """Raised when the site refuses the submission, it is suspected to come from a bot"""
+
+
+class SiteResponseError(Exception):
+    """Raised when the site answers the submission with an HTTP error other than the captcha rejection"""
+
+
+class FetchCancelledError(Exception):
+    """Raised inside the browser thread when the awaiting task has been cancelled"""
+
+
+class FormRejectedError(Exception):
+    """The form doesn't offer a value of the application details, resubmitting won't help"""
+
+
+class SharedDisplay:
+    """Virtual display shared by all browsers of the process, it runs while any of them uses it"""
+
+    def __init__(self):
+        self.display = None
+        self.users = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        with self._lock:
+            if self.display is None:
+                self.display = Display(visible=0, size=size)
+                self.display.start()
+                logger.info("Started virtual display %s", size)
+            self.users += 1
+            return self.display
+
+    def release(self):
+        with self._lock:
+            self.users = max(0, self.users - 1)
+            if self.users == 0 and self.display:
+                self.display.stop()
+                self.display = None
+                logger.info("Stopped virtual display")
+
+
+# bytes the loaded document and its resources took over the network, cached responses count as 0
+TRANSFERRED_BYTES_SCRIPT = """
+return performance.getEntriesByType('navigation').concat(performance.getEntriesByType('resource'))
+    .reduce((total, entry) => total + (entry.transferSize || 0), 0);
+"""
+
+shared_display = SharedDisplay()
+profile_template = ProfileTemplate(PROFILE_DIR)
+resource_blocker = ResourceBlocker(URL, RESOURCE_BLOCKED_TYPES, RESOURCE_ALLOWED_HOSTS)
+cookie_store = CookieStore(COOKIE_DIR, COOKIE_FLUSH_INTERVAL, COOKIE_SHARED)
+useragent_catalogue = UserAgentCatalogue(USERAGENT_CATALOGUE, FIREFOX_BINARY, USERAGENT_MAX_VERSION_LAG)
+
+
 class Browser:
-    def __init__(self, retries=3):
+    def __init__(self, retries=3, executor=None, rate_limiter=None, captcha_throttle=None, fingerprints=None):
         self.display = None
         self.browser = None
         self.useragent = None
         self.retries = retries
         self.app_details = {}
+        # Selenium calls are blocking, they are run in the executor to keep the event loop responsive
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="browser")
+        self._cancelled = threading.Event()
+        # budget of requests to the site shared with the other fetchers, every page load and form submission
+        # takes a token from it on the event loop the browser was created or last run on
+        self.rate_limiter = rate_limiter
+        try:
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop = None
+        # cooldown of the fingerprints that hit the captcha and the slowdown after it
+        self.captcha_throttle = captcha_throttle
+        self.cookie_store = cookie_store
+        # picks the user agent (with its cookies) by the success of the earlier fetches, random if not set
+        self.fingerprints = fingerprints
+        # "headless" Firefox or "xvfb", a virtual display shared with the other browsers
+        self.display_mode = BROWSER_DISPLAY_MODE
+        # keep the loaded form between fetches and only reset its fields
+        self.warm_page = WARM_PAGE
+        self.max_page_reuses = WARM_PAGE_MAX_REUSES
+        self.page_reuses = 0
+        # age and use of the running session, they decide when it gets recycled
+        self.started_at = None
+        self.session_fetches = 0
+        # start from a copy of the prepared profile instead of a fresh profile
+        self.profile_template = profile_template if PROFILE_TEMPLATE else None
+        self.profile_dir = None
+        self.resource_blocker = resource_blocker if RESOURCE_BLOCKING else None
+        # traffic already counted for the session and the loaded page
+        self.counted_blocked = 0
+        self.counted_bytes = 0
+        self.stats = {
+            "page_loads": 0,
+            "page_reuses": 0,
+            "cold_starts": 0,
+            "warm_starts": 0,
+            "cold_start_seconds": 0.0,
+            "warm_start_seconds": 0.0,
+            "blocked_requests": 0,
+            "transferred_bytes": 0,
+        }
 
     def _log(self, log_level, message, *args):
         """Wrapper around logger to add application number to the log messages."""
-        msg = f"[{self.app_details['number']}] {message}"
+        msg = f"[{self.app_details.get('number', 'browser')}] {message}"
         logger.log(log_level, msg, *args)
 
+    @staticmethod
+    def random_useragent():
+        return useragent_catalogue.random()
+
+    def _is_available(self, ua_hash):
+        """A fingerprint that hit the captcha recently would most likely hit it again"""
+        return not (self.captcha_throttle and self.captcha_throttle.is_cooling(ua_hash))
+
     def _set_useragent(self):
-        useragent = fake_useragent.UserAgent(browsers=["firefox"]).random
+        if self.fingerprints:
+            useragent = self.fingerprints.choose(self._hash_useragent, self._is_available)
+        else:
+            useragent = self.random_useragent()
+            for _ in range(10):
+                if self._is_available(self._hash_useragent(useragent)):
+                    break
+                useragent = self.random_useragent()
+            else:
+                self._log(logging.WARNING, "Couldn't find a User-Agent that isn't cooling down after a captcha")
         self._log(logging.INFO, "User-Agent for this session will be %s", useragent)
         self.useragent = useragent
 
+    @staticmethod
+    def _hash_useragent(useragent):
+        return hashlib.sha256(useragent.encode("utf-8")).hexdigest()
+
     def _get_ua_hash(self):
-        """Return a hash of the user-agent string"""
-        return hashlib.sha256(self.useragent.encode("utf-8")).hexdigest()
+        """Return a hash of the user-agent string, it identifies the fingerprint together with its cookies"""
+        return self._hash_useragent(self.useragent)
 
     def save_cookies(self):
-        """Save cookies to a file"""
-        cookies = self.browser.get_cookies()
-        if not os.path.exists("cookies"):
-            os.makedirs("cookies")
-        ua_hash = self._get_ua_hash()
-        with open(f'cookies/{ua_hash}.json', 'w') as f:
-            json.dump(cookies, f)
+        """Save cookies to the store, it writes them to disk later"""
+        self.cookie_store.put(self._get_ua_hash(), self.browser.get_cookies())
+
+    def remove_cookies(self):
+        """Forget the cookies of the current User-Agent"""
+        self.cookie_store.remove(self._get_ua_hash())
+
+    def _record_fingerprint(self, succeeded, duration):
+        """Let the fingerprint manager learn from the outcome, a retired fingerprint takes its cookies along"""
+        if not self.fingerprints or not self.useragent:
+            return
+        if self.fingerprints.record(self._get_ua_hash(), self.useragent, succeeded, duration if succeeded else None):
+            self.remove_cookies()
 
     def load_cookies(self):
-        """Load cookies from a file and add them to the Selenium browser"""
-        ua_hash = self._get_ua_hash()
-        cookie_file = f'cookies/{ua_hash}.json'
-        if os.path.exists(cookie_file):
-            self._log(logging.INFO, "Found cookies for the current User-Agent, loading from %s", cookie_file)
-            with open(cookie_file, 'r') as f:
-                cookies = json.load(f)
-                for cookie in cookies:
-                    self.browser.add_cookie(cookie)
-
-    def clean_html(self, html_content):
+        """Load cookies from the store and add them to the Selenium browser"""
+        cookies = self.cookie_store.get(self._get_ua_hash())
+        if cookies:
+            self._log(logging.INFO, "Found %d cookie(s) for the current User-Agent", len(cookies))
+            for cookie in cookies:
+                self.browser.add_cookie(cookie)
+
+    @staticmethod
+    def clean_html(html_content):
         """Filter out unsupported TG html tags"""
         # https://core.telegram.org/bots/api#html-style
         allowed_tags = {
@@ -132,25 +267,93 @@ class Browser:
 
         return str(soup)
 
-    def _init_browser(self):
-        # set user-agent
-        self._set_useragent()
-        # configure display & options
-        resolution = self.set_random_resolution()
-        self.display = Display(visible=0, size=resolution)
-        self.display.start()
-        self._log(logging.INFO, "Initialized virtual display")
+    def _get_options(self, resolution, profile_dir=None):
         options = webdriver.firefox.options.Options()
+        if self.display_mode == "headless":
+            options.headless = True
+            options.add_argument(f"--width={resolution[0]}")
+            options.add_argument(f"--height={resolution[1]}")
+        else:
+            options.headless = False
+        if profile_dir:
+            options.add_argument("-profile")
+            options.add_argument(profile_dir)
         options.set_preference("intl.accept_languages", "cs-CZ")
         options.set_preference("http.response.timeout", PAGE_LOAD_LIMIT_SECONDS)
         options.set_preference("general.useragent.override", self.useragent)
         options.set_preference("dom.webdriver.enabled", False)
         options.set_preference("useAutomationExtension", False)
-        options.headless = False
-        self.browser = webdriver.Firefox(options=options)
+        return options
+
+    @staticmethod
+    def _new_session(options):
+        """Start Firefox on a geckodriver of its own, a geckodriver serves a single session at a time"""
+        return webdriver.Firefox(options=options, service_log_path=os.devnull)
+
+    def _record_startup(self, kind, started):
+        self.stats[f"{kind}_starts"] += 1
+        self.stats[f"{kind}_start_seconds"] += time.monotonic() - started
+
+    def _warm_up_profile(self, profile_dir, resolution):
+        """Load the site once in the profile, so that it keeps the cached assets"""
+        started = time.monotonic()
+        browser = self._new_session(self._get_options(resolution, profile_dir))
+        self._record_startup("cold", started)
+        try:
+            self._take_token()
+            browser.get(URL)
+            WebDriverWait(browser, PAGE_LOAD_LIMIT_SECONDS).until(
+                lambda x: x.find_element(By.CLASS_NAME, "wrapper__form"),
+                message="Application submit form wasn't found in the HTML",
+            )
+            self._accept_cookies(browser)
+        finally:
+            browser.quit()
+
+    def _start_firefox(self, resolution):
+        if self.profile_template is not None:
+            try:
+                self.profile_template.build(partial(self._warm_up_profile, resolution=resolution))
+            except Exception as e:
+                self._log(logging.WARNING, "Failed to build the profile template, starting a fresh profile: %s", e)
+        if self.profile_template is None or not self.profile_template.ready:
+            started = time.monotonic()
+            self.browser = self._new_session(self._get_options(resolution))
+            self._record_startup("cold", started)
+            return
+        started = time.monotonic()
+        self.profile_dir = self.profile_template.clone()
+        self.browser = self._new_session(self._get_options(resolution, self.profile_dir))
+        self._record_startup("warm", started)
+
+    def _init_browser(self):
+        # set user-agent
+        self._set_useragent()
+        # configure display & options
+        resolution = self.set_random_resolution()
+        if self.display_mode != "headless" and self.display is None:
+            self.display = shared_display.acquire(resolution)
+            self._log(logging.INFO, "Using shared virtual display")
+        self._start_firefox(resolution)
+        self.started_at = time.monotonic()
+        self.session_fetches = 0
+        self.counted_blocked = self.counted_bytes = 0
+        if self.resource_blocker:
+            self.resource_blocker.install(self.browser)
         self.browser.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
         self.load_cookies()
 
+    def start(self):
+        """Start the browser ahead of its first fetch"""
+        self._get_browser()
+
+    def get_rss(self):
+        """Return the memory (bytes) the Firefox processes of the session take, None if it can't be told"""
+        if not self.browser:
+            return None
+        pid = self.browser.capabilities.get("moz:processID")
+        return process_tree_rss(pid) if pid else None
+
     def _get_browser(self, force=False):
         if not force and self.browser:
             return self.browser
@@ -158,8 +361,38 @@ class Browser:
         return self.browser
 
     def random_sleep(self, min_seconds=0.5, max_seconds=1.5):
-        """Sleep for a random amount of time"""
-        time.sleep(random.uniform(min_seconds, max_seconds))
+        """Sleep for a random amount of time, waking up early if the fetch gets cancelled"""
+        if self._cancelled.wait(random.uniform(min_seconds, max_seconds)):
+            raise FetchCancelledError("Fetch has been cancelled")
+
+    async def _run_blocking(self, func, *args):
+        """Run blocking browser work in the executor, interrupting it if the caller gets cancelled"""
+        loop = self.loop = asyncio.get_running_loop()
+        self._cancelled.clear()
+        future = loop.run_in_executor(self.executor, func, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            self._cancelled.set()
+            # the browser must not be reused until the worker thread has stopped touching it
+            try:
+                await future
+            except Exception:
+                pass
+            raise
+
+    def _take_token(self):
+        """Wait in the browser thread until a request to the site fits into the budget"""
+        if not self.rate_limiter:
+            return
+        future = asyncio.run_coroutine_threadsafe(self.rate_limiter.acquire(), self.loop)
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except FutureTimeoutError:
+                if self._cancelled.is_set():
+                    future.cancel()
+                    raise FetchCancelledError("Fetch has been cancelled")
 
     def type_with_delay(self, element, text, min_delay=0.05, max_delay=0.15):
         """Type text into an element one character at a time with a delay"""
@@ -176,6 +409,18 @@ class Browser:
         self._log(logging.INFO, "Setting resolution to %s", chosen_resolution)
         return chosen_resolution
 
+    def _accept_cookies(self, browser):
+        """Try clicking on cookies button, it is gone once consent was given on this page"""
+        cookies = browser.find_elements_by_xpath(
+            '//button[@class="button button__primary" and text()="Souhlasím se všemi"]'
+        )
+        try:
+            if cookies:
+                cookies[0].click()
+                self._log(logging.INFO, "Cookies button found, clicked.")
+        except ElementClickInterceptedException:
+            self._log(logging.INFO, "Cookies button is not active")
+
     def _submit_form(self, app_details):
         """Submit application details into the form"""
         logged_details = {key: app_details[key] for key in ["number", "suffix", "type", "year"]}
@@ -185,13 +430,7 @@ class Browser:
             EC.presence_of_element_located((By.CSS_SELECTOR, ".input__control"))
         )
 
-        # Try clicking on cookies button
-        cookies = self.browser.find_element_by_xpath('//button[@class="button button__primary" and text()="Souhlasím se všemi"]')
-        try:
-            cookies.click()
-            self._log(logging.INFO, "Cookies button found, clicked.")
-        except ElementClickInterceptedException:
-            self._log(logging.INFO, "Cookies button is not active")
+        self._accept_cookies(self.browser)
 
         # Locate and fill out the application number field by its placeholder
         application_number_field = self.browser.find_element(By.NAME, "proceedings.referenceNumber")
@@ -226,16 +465,21 @@ class Browser:
             )
 
             # Adjusted XPath to locate the option correctly
-            type_option = self.browser.find_element(
+            type_options = self.browser.find_elements(
                 By.XPATH,
                 f"//div[contains(@class, 'react-select__option') and .//div[normalize-space(text())='{app_details['type']}']]"
             )
+            if not type_options:
+                raise FormRejectedError(f"Type {app_details['type']} is not offered by the form")
+            type_option = type_options[0]
 
             # Scroll the option into view and click it using JavaScript
             self.browser.execute_script("arguments[0].scrollIntoView(true);", type_option)
             self.random_sleep()
             self.browser.execute_script("arguments[0].click();", type_option)
 
+        except FormRejectedError:
+            raise
         except (WebDriverException, CustomMaxRetryError, TimeoutException):
             self._log(logging.ERROR, "Error waiting for Type list to appear")
             self.close()
@@ -270,10 +514,13 @@ class Browser:
             )
 
             # Locate the desired option
-            year_option = self.browser.find_element(
+            year_options = self.browser.find_elements(
                 By.XPATH,
                 f"//div[contains(@class, 'react-select__option') and .//div[normalize-space(text())='{app_details['year']}']]"
             )
+            if not year_options:
+                raise FormRejectedError(f"Year {app_details['year']} is not offered by the form")
+            year_option = year_options[0]
 
             # Scroll the year_option into view before clicking it
             self.browser.execute_script("arguments[0].scrollIntoView({block: 'center'});", year_option)
@@ -282,6 +529,8 @@ class Browser:
             self.browser.execute_script("arguments[0].click();", year_option)
 
 
+        except FormRejectedError:
+            raise
         except (WebDriverException, CustomMaxRetryError, TimeoutException):
             self._log(logging.ERROR, "Error waiting for year list to appear")
             self.close()
@@ -298,101 +547,277 @@ class Browser:
         actions.move_to_element(submit_button).perform()
         self.browser.execute_script("arguments[0].click();", submit_button)
 
-    async def _do_fetch_with_browser(self, url, app_details):
-        def _has_recaptcha(browser):
-            # captcha = browser.find_elements(
-            #    By.CSS_SELECTOR, "iframe[name^='a-'][src^='https://www.google.com/recaptcha/api2/anchor?']"
-            # )
-            # return bool(captcha)
-            #
-            # olegeech: MVCR website uses invisible recaptcha, so we can't detect it.
-            # It can only be detected by the fact there is no results after submitting the form.
-            # Also the POST request is being denyed with the statement "Recaptcha verification failed"
-            # It's not possible to easily see the POST reply in Selenium, so we just check for the results.
-            return False
-
-        def _save_page_source(browser):
-            # save page source in case of issues
-            if not os.path.exists(OUTPUT_DIR):
-                os.makedirs(OUTPUT_DIR)
-            out_file = f"{OUTPUT_DIR}/{app_details['number']}-{app_details['type']}-{app_details['year']}.html"
+    def _has_recaptcha(self, browser):
+        # captcha = browser.find_elements(
+        #    By.CSS_SELECTOR, "iframe[name^='a-'][src^='https://www.google.com/recaptcha/api2/anchor?']"
+        # )
+        # return bool(captcha)
+        #
+        # olegeech: MVCR website uses invisible recaptcha, so we can't detect it.
+        # It can only be detected by the fact there is no results after submitting the form.
+        # Also the POST request is being denyed with the statement "Recaptcha verification failed"
+        # The denied POST reply is seen by the status capture hooks, see _wait_for_status.
+        return False
+
+    def _save_page_source(self, browser, app_details):
+        """Save page source in case of issues"""
+        if not os.path.exists(OUTPUT_DIR):
+            os.makedirs(OUTPUT_DIR)
+        out_file = f"{OUTPUT_DIR}/{app_details['number']}-{app_details['type']}-{app_details['year']}.html"
+        try:
             page_source = browser.page_source
-            if page_source:
-                with open(out_file, "w") as f:
-                    f.write(page_source)
+        except WebDriverException as e:
+            self._log(logging.WARNING, "Couldn't save page source: %s", e)
+            return
+        if page_source:
+            with open(out_file, "w") as f:
+                f.write(page_source)
+
+    def _record_traffic(self):
+        """Count the requests blocked and the bytes transferred since the last fetch"""
+        try:
+            transferred = self.browser.execute_script(TRANSFERRED_BYTES_SCRIPT)
+            blocked = self.resource_blocker.blocked_requests(self.browser) if self.resource_blocker else 0
+        except WebDriverException as e:
+            self._log(logging.DEBUG, "Couldn't read the page traffic: %s", e)
+            return
+        self.stats["transferred_bytes"] += max(0, int(transferred or 0) - self.counted_bytes)
+        self.stats["blocked_requests"] += max(0, blocked - self.counted_blocked)
+        self.counted_bytes = int(transferred or 0)
+        self.counted_blocked = blocked
+
+    def _load_form_page(self, url):
+        """Navigate to the status page and wait for the form to appear"""
+        self._take_token()
+        self.browser.get(url)
+        # resource timings start over with the new document
+        self.counted_bytes = 0
+        self.page_reuses = 0
+        self.stats["page_loads"] += 1
+        WebDriverWait(self.browser, PAGE_LOAD_LIMIT_SECONDS).until(
+            lambda x: self._has_recaptcha(x) or x.find_element(By.CLASS_NAME, "wrapper__form"),
+            message="Application submit form wasn't found in the HTML",
+        )
+
+        if self._has_recaptcha(self.browser):
+            logger.warning("Recaptcha has been hit, solve it please to continue")
+            WebDriverWait(self.browser, CAPTCHA_WAIT_SECONDS).until(lambda x: x.find_element(By.CLASS_NAME, "wrapper__form"))
 
+    def _can_reuse_page(self, url, app_details):
+        """Check that the loaded form looks alive and can take the next application"""
+        if self.page_reuses >= self.max_page_reuses:
+            return False
+        try:
+            if not self.browser.current_url.startswith(url):
+                return False
+            if not self.browser.find_elements(By.NAME, "proceedings.referenceNumber"):
+                return False
+            # a resubmitted application would show the very same status, which can't be told from the old one
+            previous_status = self._current_status_html()
+        except WebDriverException as e:
+            self._log(logging.INFO, "Loaded page looks stale, reloading: %s", e)
+            return False
+        return not (previous_status and str(app_details["number"]) in previous_status)
+
+    def _reset_form(self):
+        """Clear the fields and dropdowns of the already loaded form"""
+        for name in ("proceedings.referenceNumber", "proceedings.additionalSuffix"):
+            self.browser.find_element(By.NAME, name).clear()
+        for clear_indicator in self.browser.find_elements(By.CLASS_NAME, "react-select__clear-indicator"):
+            self.browser.execute_script("arguments[0].click();", clear_indicator)
+        self.browser.execute_script("window.scrollTo(0, 0);")
+        self.page_reuses += 1
+        self.stats["page_reuses"] += 1
+
+    def _current_status_html(self):
+        """Return the content of the status alert currently shown on the page, if any"""
+        elements = self.browser.find_elements_by_class_name("alert__content")
+        return elements[0].get_attribute("innerHTML") if elements else None
+
+    def _wait_for_status(self, since):
+        """Return the status alert the submission produces as soon as the page shows it"""
+        event = status_capture.wait_for(self.browser, since, (status_capture.REQUEST, status_capture.ALERT), 5)
+        if event is None:
+            raise TimeoutException("The form wasn't submitted")
+        event = status_capture.wait_for(
+            self.browser,
+            since,
+            (status_capture.ALERT, status_capture.REJECTED, status_capture.HTTP_ERROR),
+            PAGE_LOAD_LIMIT_SECONDS,
+        )
+        if event is None:
+            raise TimeoutException("Status field wasn't found")
+        if event["kind"] == status_capture.REJECTED:
+            raise CaptchaRejectedError(f"Submission was rejected with HTTP {event['status']}: {event['body'][:200]}")
+        if event["kind"] == status_capture.HTTP_ERROR:
+            raise SiteResponseError(f"Submission failed with HTTP {event['status']}: {event['body'][:200]}")
+        return event["html"]
+
+    def _read_status(self, url, app_details, retry_policy=None):
+        """Submit the form and return the cleaned text of the status it produces"""
+        # a status left over from the previous submission on the same page must not be taken for the new one
+        previous_status = self._current_status_html()
+
+        def _new_status(browser):
+            status = self._current_status_html()
+            return status if status and status != previous_status else False
+
+        # BUG: sometimes on some systems after submitting data
+        # the page still appears as nothing was done
+        # Magically, re-submitting data resolves the issue ...
+        # The hooked page tells whether the submission went out at all, so only those are resubmitted.
+        application_status_text = None
+        retry_count = 0
+        for _attempt in range(3):
+            if retry_policy and not retry_policy.spend():
+                self._log(logging.WARNING, "Retry budget is used up, not submitting the form again")
+                break
+            try:
+                since = status_capture.install(self.browser)
+            except WebDriverException as e:
+                self._log(logging.WARNING, "Couldn't hook the page, falling back to polling the status: %s", e)
+                since = None
+            self._take_token()
+            self._submit_form(app_details)
+            try:
+                if since is None:
+                    application_status_text = WebDriverWait(
+                        self.browser, 5, ignored_exceptions=(NoSuchElementException, StaleElementReferenceException)
+                    ).until(_new_status, message="Status field wasn't found")
+                else:
+                    application_status_text = self._wait_for_status(since)
+                break
+            except (WebDriverException, NoSuchElementException, TimeoutException) as e:
+                retry_count += 1
+                self._log(logging.ERROR, f"Submit failed on attempt {retry_count}: {e}")
+                self.random_sleep(1, 1)
+
+        if not application_status_text:
+            raise CustomMaxRetryError(url=url, msg="Couldn't fetch application status")
+
+        self._log(logging.INFO, "Application status fetched")
+        self.save_cookies()
+        # Filter out / replace unsupported HTML tags
+        return self.clean_html(application_status_text)
+
+    def _fetch_with_browser(self, url, app_details, reuse_page=None, retry_policy=None):
+        """Fetch status of a single application, return None on failure"""
         self.app_details = app_details
+        if reuse_page is None:
+            reuse_page = self.warm_page
+        # a freshly started browser has no page loaded yet
+        reuse_page = reuse_page and self.browser is not None
         browser = self._get_browser()
-        application_status = None
+        self.session_fetches += 1
         application_status_text = None
+        started = time.monotonic()
+        # only a status or a captcha rejection tell how the fingerprint does, the other errors aren't its fault
+        fingerprint_succeeded = None
 
         try:
-            browser.get(url)
-            WebDriverWait(browser, PAGE_LOAD_LIMIT_SECONDS).until(
-                lambda x: _has_recaptcha(x) or x.find_element(By.CLASS_NAME, "wrapper__form"),
-                message="Application submit form wasn't found in the HTML",
-            )
-
-            if _has_recaptcha(browser):
-                logger.warning("Recaptcha has been hit, solve it please to continue")
-                WebDriverWait(browser, CAPTCHA_WAIT_SECONDS).until(lambda x: x.find_element(By.CLASS_NAME, "wrapper__form"))
-
-            # BUG: sometimes on some systems after submitting data
-            # the page still appears as nothing was done
-            # Magically, re-submitting data resolves the issue ...
-            retry_count = 0
-            for _attempt in range(3):
-                self._submit_form(app_details)
-                try:
-                    WebDriverWait(browser, 5).until(
-                        lambda x: x.find_element(By.CLASS_NAME, "alert__content"),
-                        message="Status field wasn't found",
-                    )
-                    application_status = browser.find_element_by_class_name("alert__content")
-                    break
-                except (WebDriverException, NoSuchElementException, TimeoutException) as e:
-                    retry_count += 1
-                    self._log(logging.ERROR, f"Submit failed on attempt {retry_count}: {e}")
-                    await asyncio.sleep(1)
-
-            if application_status:
-                application_status_text = application_status.get_attribute("innerHTML")
-                self._log(logging.INFO, "Application status fetched")
-                self.save_cookies()
-                # Filter out / replace unsupported HTML tags
-                application_status_text = self.clean_html(application_status_text)
+            if reuse_page and self._can_reuse_page(url, app_details):
+                self._reset_form()
             else:
-                raise CustomMaxRetryError(url=url, msg="Couldn't fetch application status")
-
-        except (WebDriverException, CustomMaxRetryError, TimeoutException) as err:
+                self._load_form_page(url)
+            application_status_text = self._read_status(url, app_details, retry_policy)
+            fingerprint_succeeded = True
+            self._record_traffic()
+            if self.captcha_throttle:
+                self.captcha_throttle.record_success(self._get_ua_hash())
+
+        except FetchCancelledError:
+            self._log(logging.WARNING, "Fetch has been cancelled, closing browser")
+            self.close()
+            raise
+        except FormRejectedError as err:
+            self._log(logging.ERROR, "Application details were rejected by the form: %s", err)
+            self._record_error(retry_policy, PERMANENT)
+        except CaptchaRejectedError as err:
+            # resubmitting from the same session would be refused as well, start over with a new one
+            self._log(logging.WARNING, "reCAPTCHA verification failed: %s", err)
+            fingerprint_succeeded = False
+            if self.captcha_throttle:
+                self.captcha_throttle.record_captcha(self._get_ua_hash())
+            self._save_page_source(browser, app_details)
+            self.close()
+            self._record_error(retry_policy, CAPTCHA)
+        # an HTTP error of the site (e.g. a 5xx during an outage) says nothing about the fingerprint
+        except (WebDriverException, CustomMaxRetryError, TimeoutException, SiteResponseError) as err:
             self._log(logging.ERROR, "An error has occurred during page loading: %s", err)
-            _save_page_source(browser)
+            self._save_page_source(browser, app_details)
             self.close()
+            self._record_error(retry_policy, TRANSIENT)
         except Exception as e:
             self._log(logging.ERROR, "Unexpected exception: %s", e)
-            _save_page_source(browser)
+            self._save_page_source(browser, app_details)
             self.close()
+            self._record_error(retry_policy, TRANSIENT)
 
+        if fingerprint_succeeded is not None:
+            self._record_fingerprint(fingerprint_succeeded, time.monotonic() - started)
         return application_status_text
 
-    async def fetch(self, url, app_details):
+    @staticmethod
+    def _record_error(retry_policy, kind):
+        if retry_policy:
+            retry_policy.record_error(kind)
+
+    async def _do_fetch_with_browser(self, url, app_details, reuse_page=None, retry_policy=None):
+        if retry_policy and retry_policy.exhausted():
+            return None
+        if self.captcha_throttle:
+            await self.captcha_throttle.wait()
+        return await self._run_blocking(self._fetch_with_browser, url, app_details, reuse_page, retry_policy)
+
+    async def fetch(self, url, app_details, retry_policy=None):
         """
         Fetches page with retries
+
+        With a retry policy the retries stop once its budget is spent or the error won't go away.
         """
-        res = await self._do_fetch_with_browser(url=url, app_details=app_details)
+        res = await self._do_fetch_with_browser(url=url, app_details=app_details, retry_policy=retry_policy)
         attempts_left = self.retries
-        while attempts_left and not res:
+        while attempts_left and not res and (retry_policy is None or retry_policy.should_retry()):
             attempts_left -= 1
             retry_in = int(RETRY_INTERVAL / 3 + random.randint(1, int(2 * RETRY_INTERVAL / 3)))
+            if retry_policy:
+                retry_in = min(retry_in, retry_policy.remaining_seconds())
             self._log(logging.WARNING, "Fetch failed, retrying %s later in %d seconds", url, retry_in)
             await asyncio.sleep(retry_in)
-            res = await self._do_fetch_with_browser(url=url, app_details=app_details)
+            res = await self._do_fetch_with_browser(url=url, app_details=app_details, retry_policy=retry_policy)
         return res
 
+    async def fetch_batch(self, url, batch, retry_policies=None):
+        """
+        Fetches statuses of several applications loading the page only once
+
+        The form is resubmitted in place for every application, the page is loaded
+        again only when it looks stale, e.g. after a failed entry closed the browser.
+        Failed entries are not retried here, their result is None.
+        """
+        retry_policies = retry_policies or [None] * len(batch)
+        results = []
+        for position, (app_details, retry_policy) in enumerate(zip(batch, retry_policies)):
+            reuse_page = True if position else None
+            results.append(
+                await self._do_fetch_with_browser(
+                    url=url, app_details=app_details, reuse_page=reuse_page, retry_policy=retry_policy
+                )
+            )
+        return results
+
+    async def aclose(self):
+        """Close the browser without blocking the event loop"""
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.close)
+
     def close(self):
         if self.browser:
             self.browser.quit()
             self.browser = None
+        self.started_at = None
+        if self.profile_dir:
+            ProfileTemplate.remove(self.profile_dir)
+            self.profile_dir = None
         if self.display:
-            self.display.stop()
+            shared_display.release()
             self.display = None
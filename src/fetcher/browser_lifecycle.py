@@ -0,0 +1,81 @@
+"""
+Recycling of long-lived browsers before they degrade
+"""
+
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+FETCHES = "fetches"
+AGE = "age"
+MEMORY = "memory"
+
+
+def process_tree_rss(pid):
+    """Return the resident memory (bytes) of the process and its descendants, None if it can't be read"""
+    children = {}
+    try:
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # the command name in parentheses may contain spaces, the parent pid follows it
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    except OSError:
+        return None
+
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    rss, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/statm") as f:
+                rss += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            if current == pid:
+                return None
+            continue
+        pending.extend(children.get(current, []))
+    return rss
+
+
+class RecyclePolicy:
+    """
+    Tells when a browser session is due for a replacement
+
+    A session is recycled after max_fetches fetches, max_age seconds or once its Firefox processes take
+    more than max_rss_mb of memory, whichever comes first. A limit of 0 is not checked. Reading the memory
+    walks /proc, it is done apart from the other checks, off the event loop and every memory_check_interval
+    seconds at most.
+    """
+
+    def __init__(self, max_fetches=200, max_age=3600, max_rss_mb=500, memory_check_interval=60):
+        self.max_fetches = max_fetches
+        self.max_age = max_age
+        self.max_rss_mb = max_rss_mb
+        self.memory_check_interval = memory_check_interval
+
+    def reason(self, browser):
+        """Return why the browser should be recycled by its use, None if it can stay"""
+        if browser.started_at is None:
+            return None
+        if self.max_fetches and browser.session_fetches >= self.max_fetches:
+            return FETCHES
+        if self.max_age and time.monotonic() - browser.started_at >= self.max_age:
+            return AGE
+        return None
+
+    def memory_reason(self, browser):
+        """Return MEMORY if the Firefox processes of the browser take too much memory, blocks on reading /proc"""
+        if not self.max_rss_mb or browser.started_at is None:
+            return None
+        rss = browser.get_rss()
+        if rss and rss >= self.max_rss_mb * 1024 * 1024:
+            return MEMORY
+        return None
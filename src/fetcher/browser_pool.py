@@ -0,0 +1,308 @@
+"""
+Pool of browser sessions shared by concurrently processed requests
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from fetcher.browser import Browser
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes of the pool wait queue
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+
+class BrowserSlot:
+    """A pooled browser together with its health state"""
+
+    def __init__(self, slot_id, browser, max_failures):
+        self.slot_id = slot_id
+        self.browser = browser
+        self.max_failures = max_failures
+        self.busy = False
+        self.healthy = True
+        self.fetches = 0
+        self.consecutive_failures = 0
+        # task pre-launching the browser which replaces the current one, and why it is replaced
+        self.replacement = None
+        self.recycle_reason = None
+        self.memory_checked_at = None
+
+    def mark_success(self):
+        self.fetches += 1
+        self.consecutive_failures = 0
+
+    def mark_failure(self):
+        self.fetches += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.max_failures:
+            self.healthy = False
+
+    async def fetch(self, url, app_details, retry_policy=None):
+        """Fetch application status with the slot's browser and record the outcome"""
+        try:
+            result = await self.browser.fetch(url, app_details, retry_policy=retry_policy)
+        except Exception:
+            self.mark_failure()
+            raise
+        if result:
+            self.mark_success()
+        else:
+            self.mark_failure()
+        return result
+
+    async def fetch_batch(self, url, batch, retry_policies=None):
+        """Fetch statuses of several applications in one browser session and record the outcome"""
+        try:
+            results = await self.browser.fetch_batch(url, batch, retry_policies=retry_policies)
+        except Exception:
+            self.mark_failure()
+            raise
+        if any(results):
+            self.mark_success()
+        else:
+            self.mark_failure()
+        return results
+
+
+class BrowserPool:
+    """
+    Fixed-size pool of browsers with checkout/checkin and a prioritized wait queue
+
+    Waiters of the interactive lane always get the next free browser, background
+    waiters are served in between once they have been passed over starvation_limit times.
+    Within a lane waiters are served in arrival order. At most limit browsers are leased at
+    once, the limit can be lowered below the pool size at runtime.
+    With a recycle policy a browser due for recycling keeps serving while its replacement is launched
+    in the background, the replacement takes over between two leases once it is up.
+    """
+
+    def __init__(self, size, browser_factory=Browser, max_failures=3, starvation_limit=5, recycle_policy=None):
+        if size < 1:
+            raise ValueError("Browser pool size must be at least 1")
+        self.size = size
+        # one worker thread per slot, so every leased browser can make progress at the same time
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="browser")
+        # replacements are launched apart from the workers, the fetches of the slots don't wait for them
+        self.launcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="browser-launch")
+        self.browser_factory = browser_factory
+        self.recycle_policy = recycle_policy
+        self.slots = [
+            BrowserSlot(slot_id, browser_factory(executor=self.executor), max_failures) for slot_id in range(size)
+        ]
+        self.limit = size
+        self._idle = deque(self.slots)
+        self._waiters = {INTERACTIVE: deque(), BACKGROUND: deque()}
+        self.starvation_limit = starvation_limit
+        self._background_skips = 0
+        self.restarts = 0
+        self.recycles = Counter()
+        # figures of the browsers which have been replaced, so that the totals don't drop
+        self.retired_stats = Counter()
+        self._closing = set()
+
+    async def acquire(self, priority=INTERACTIVE):
+        """Check out an idle browser slot, waiting for one in the priority lane if all are busy"""
+        if self._idle and not any(self._waiters.values()) and self._busy_count() < self.limit:
+            return self._checkout(self._idle.popleft())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(waiter)
+        try:
+            slot = await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # slot was handed over right before the cancellation, pass it on
+                slot = waiter.result()
+                slot.busy = False
+                self._hand_over(slot)
+            elif waiter in self._waiters[priority]:
+                self._waiters[priority].remove(waiter)
+            raise
+        return self._checkout(slot)
+
+    async def release(self, slot):
+        """Return a slot to the pool, restarting its browser if it became unhealthy"""
+        if not slot.healthy:
+            logger.warning(
+                "Browser slot %d failed %d times in a row, restarting it", slot.slot_id, slot.consecutive_failures
+            )
+            await slot.browser.aclose()
+            slot.healthy = True
+            slot.consecutive_failures = 0
+            self.restarts += 1
+        elif self.recycle_policy:
+            self._recycle(slot)
+        slot.busy = False
+        self._hand_over(slot)
+
+    def _recycle(self, slot):
+        """Swap in the replacement once it is up, start launching one when the browser is due for recycling"""
+        if slot.replacement is None:
+            reason = self.recycle_policy.reason(slot.browser)
+            if reason:
+                slot.replacement = asyncio.create_task(self._prelaunch(slot, reason))
+            elif self._is_memory_check_due(slot):
+                slot.replacement = asyncio.create_task(self._prelaunch_if_oversized(slot))
+            return
+        if not slot.replacement.done():
+            return
+        task, slot.replacement = slot.replacement, None
+        error = "cancelled" if task.cancelled() else task.exception()
+        if error:
+            # the browser stays, it is checked again after its next lease
+            logger.error("Failed to launch a replacement for browser slot %d: %s", slot.slot_id, error)
+            return
+        if task.result() is None:
+            # the memory check found the browser fit to stay
+            return
+        retired = slot.browser
+        slot.browser = task.result()
+        self.retired_stats.update(retired.stats)
+        self.recycles[slot.recycle_reason] += 1
+        logger.info("Browser slot %d has been recycled (%s)", slot.slot_id, slot.recycle_reason)
+        closing = asyncio.create_task(retired.aclose())
+        self._closing.add(closing)
+        closing.add_done_callback(self._closing.discard)
+
+    def _is_memory_check_due(self, slot):
+        if not self.recycle_policy.max_rss_mb:
+            return False
+        return (
+            slot.memory_checked_at is None
+            or time.monotonic() - slot.memory_checked_at >= self.recycle_policy.memory_check_interval
+        )
+
+    async def _prelaunch_if_oversized(self, slot):
+        """Read the memory of the browser in the launcher thread, launch a replacement if it takes too much"""
+        slot.memory_checked_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        reason = await loop.run_in_executor(self.launcher, self.recycle_policy.memory_reason, slot.browser)
+        if not reason:
+            return None
+        return await self._prelaunch(slot, reason)
+
+    async def _prelaunch(self, slot, reason):
+        logger.info("Browser slot %d is due for recycling (%s), launching its replacement", slot.slot_id, reason)
+        slot.recycle_reason = reason
+        browser = self.browser_factory(executor=self.executor)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.launcher, browser.start)
+        except Exception:
+            await loop.run_in_executor(self.launcher, browser.close)
+            raise
+        return browser
+
+    @asynccontextmanager
+    async def lease(self, priority=INTERACTIVE):
+        """Lease a browser slot for the duration of the context"""
+        slot = await self.acquire(priority)
+        try:
+            yield slot
+        finally:
+            await self.release(slot)
+
+    def set_limit(self, limit):
+        """Change the number of browsers which can be leased at once, within 1 and the pool size"""
+        self.limit = max(1, min(limit, self.size))
+        # a raised limit lets the waiters take the idle slots right away
+        while self._idle and self._busy_count() < self.limit:
+            waiter = self._next_waiter()
+            if not waiter:
+                break
+            self._give(waiter, self._idle.popleft())
+        return self.limit
+
+    def _busy_count(self):
+        return len([slot for slot in self.slots if slot.busy])
+
+    def _give(self, waiter, slot):
+        # the slot counts as busy as soon as it's handed over, even before the waiter wakes up
+        slot.busy = True
+        waiter.set_result(slot)
+
+    def _checkout(self, slot):
+        slot.busy = True
+        return slot
+
+    def _next_waiter(self):
+        """Pick the waiter to serve next, guarding the background lane from starvation"""
+        for lane in self._waiters.values():
+            while lane and lane[0].done():
+                lane.popleft()
+        interactive, background = self._waiters[INTERACTIVE], self._waiters[BACKGROUND]
+        if background and (not interactive or self._background_skips >= self.starvation_limit):
+            self._background_skips = 0
+            return background.popleft()
+        if interactive:
+            if background:
+                self._background_skips += 1
+            return interactive.popleft()
+        return None
+
+    def _hand_over(self, slot):
+        """Give the slot to the next waiting requester or put it back to idle"""
+        waiter = self._next_waiter() if self._busy_count() < self.limit else None
+        if waiter:
+            self._give(waiter, slot)
+        else:
+            self._idle.append(slot)
+
+    def _sum_stat(self, name):
+        return sum(slot.browser.stats[name] for slot in self.slots) + self.retired_stats[name]
+
+    def _get_startup_stats(self):
+        """Return the number and the average time of browser starts from scratch and from the profile template"""
+        stats = {}
+        for kind in ("cold", "warm"):
+            starts = self._sum_stat(f"{kind}_starts")
+            seconds = self._sum_stat(f"{kind}_start_seconds")
+            stats[f"{kind}_starts"] = starts
+            stats[f"avg_{kind}_start_seconds"] = round(seconds / starts, 2) if starts else 0
+        return stats
+
+    def _get_traffic_stats(self):
+        """Return the requests blocked and the kilobytes transferred per fetch"""
+        fetches = self._sum_stat("page_loads") + self._sum_stat("page_reuses")
+        blocked = self._sum_stat("blocked_requests")
+        transferred = self._sum_stat("transferred_bytes")
+        return {
+            "blocked_requests": blocked,
+            "blocked_per_fetch": round(blocked / fetches, 1) if fetches else 0,
+            "transferred_kb_per_fetch": round(transferred / 1024 / fetches, 1) if fetches else 0,
+        }
+
+    def get_stats(self):
+        """Return the pool usage figures"""
+        return {
+            "size": self.size,
+            "limit": self.limit,
+            "busy": self._busy_count(),
+            "waiting": {lane: len([w for w in waiters if not w.done()]) for lane, waiters in self._waiters.items()},
+            "restarts": self.restarts,
+            "recycles": sum(self.recycles.values()),
+            "recycle_reasons": dict(self.recycles),
+            "page_loads": self._sum_stat("page_loads"),
+            "page_reuses": self._sum_stat("page_reuses"),
+            **self._get_startup_stats(),
+            **self._get_traffic_stats(),
+        }
+
+    def close(self):
+        """Close every browser in the pool"""
+        for slot in self.slots:
+            slot.browser.close()
+            if slot.replacement:
+                if slot.replacement.done() and not slot.replacement.cancelled() and not slot.replacement.exception():
+                    if slot.replacement.result():
+                        slot.replacement.result().close()
+                slot.replacement.cancel()
+        self.executor.shutdown(wait=False)
+        self.launcher.shutdown(wait=False)
@@ -0,0 +1,86 @@
+"""
+Firefox profile template shared by the browsers of the process
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# lock files of a running Firefox, a clone must not inherit them
+PROFILE_LOCKS = ("lock", ".parentlock", "parent.lock")
+# cookies and site storage of the warm-up session, they belong to a fingerprint and not to every clone
+PROFILE_IDENTITY = (
+    "cookies.sqlite",
+    "cookies.sqlite-wal",
+    "cookies.sqlite-shm",
+    "webappsstore.sqlite",
+    "webappsstore.sqlite-wal",
+    "webappsstore.sqlite-shm",
+    "storage",
+)
+
+
+class ProfileTemplate:
+    """
+    Firefox profile prepared once and copied for every new browser
+
+    The template is built by a warm-up session that loads the site, so the copies start with a warm
+    HTTP cache. Its cookies and site storage are dropped, every copy gets the cookie jar of the
+    fingerprint it runs with. Profiles live in root, which should be a tmpfs like /dev/shm:
+    it has no copy-on-write, but a copy in memory takes a fraction of a fresh Firefox startup.
+    A failed build is not tried again for retry_interval seconds, browsers start with a fresh profile meanwhile.
+    """
+
+    def __init__(self, root, retry_interval=300):
+        self.root = root
+        self.retry_interval = retry_interval
+        self.path = None
+        self.failed_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.path is not None
+
+    def build(self, warm_up):
+        """Build the template once, warm_up(profile_dir) runs a session on it and quits"""
+        with self._lock:
+            if self.path:
+                return
+            if self.failed_at is not None and time.monotonic() - self.failed_at < self.retry_interval:
+                return
+            os.makedirs(self.root, exist_ok=True)
+            path = tempfile.mkdtemp(prefix="template-", dir=self.root)
+            try:
+                warm_up(path)
+            except Exception:
+                shutil.rmtree(path, ignore_errors=True)
+                self.failed_at = time.monotonic()
+                raise
+            self._forget_identity(path)
+            self.path = path
+            logger.info("Built Firefox profile template in %s", path)
+
+    @staticmethod
+    def _forget_identity(path):
+        for name in PROFILE_IDENTITY:
+            target = os.path.join(path, name)
+            if os.path.isdir(target):
+                shutil.rmtree(target, ignore_errors=True)
+            elif os.path.exists(target):
+                os.remove(target)
+
+    def clone(self):
+        """Return the directory of a fresh copy of the template"""
+        path = tempfile.mkdtemp(prefix="profile-", dir=self.root)
+        shutil.copytree(self.path, path, dirs_exist_ok=True, ignore=shutil.ignore_patterns(*PROFILE_LOCKS))
+        return path
+
+    @staticmethod
+    def remove(path):
+        shutil.rmtree(path, ignore_errors=True)
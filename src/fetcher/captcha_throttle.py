@@ -0,0 +1,91 @@
+"""
+Throttling of the fetcher after the site rejects submissions with reCAPTCHA
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CaptchaThrottle:
+    """
+    Cools down the fingerprint that hit the captcha and slows the whole fetcher down
+
+    A fingerprint (user agent with its cookies) is not used for cooldown_seconds after a rejection,
+    the cooldown doubles with every further rejection of the same fingerprint up to max_cooldown_seconds.
+    Meanwhile fetch attempts of all browsers are spaced slowdown_seconds apart, the spacing doubles with
+    every rejection up to max_slowdown_seconds and is lifted after slowdown_period without one.
+    """
+
+    def __init__(
+        self,
+        cooldown_seconds=1800,
+        max_cooldown_seconds=86400,
+        slowdown_seconds=30,
+        max_slowdown_seconds=600,
+        slowdown_period=1800,
+    ):
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self.slowdown_seconds = slowdown_seconds
+        self.max_slowdown_seconds = max_slowdown_seconds
+        self.slowdown_period = slowdown_period
+        # fingerprint -> (rejections in a row, cooled down until)
+        self.cooldowns = {}
+        self.spacing = 0
+        self.slow_until = 0
+        self._next_start = 0
+        # the fetch outcomes are recorded from the browser threads
+        self._lock = threading.Lock()
+        self.captchas = 0
+
+    def record_captcha(self, fingerprint):
+        """Cool the fingerprint down and slow down the fetches"""
+        with self._lock:
+            now = time.monotonic()
+            strikes = self.cooldowns.get(fingerprint, (0, 0))[0] + 1
+            cooldown = min(self.cooldown_seconds * 2 ** (strikes - 1), self.max_cooldown_seconds)
+            self.cooldowns[fingerprint] = (strikes, now + cooldown)
+            self.spacing = min(max(self.slowdown_seconds, self.spacing * 2), self.max_slowdown_seconds)
+            self.slow_until = now + self.slowdown_period
+            self.captchas += 1
+        logger.warning(
+            f"Captcha hit, fingerprint {fingerprint[:12]} cools down for {cooldown}s,"
+            f" fetches are spaced {self.spacing}s apart"
+        )
+
+    def record_success(self, fingerprint):
+        with self._lock:
+            self.cooldowns.pop(fingerprint, None)
+
+    def is_cooling(self, fingerprint):
+        with self._lock:
+            return self.cooldowns.get(fingerprint, (0, 0))[1] > time.monotonic()
+
+    def is_slowed_down(self):
+        return self.spacing > 0 and time.monotonic() < self.slow_until
+
+    async def wait(self):
+        """Wait for the turn of the next fetch attempt while the fetcher is slowed down"""
+        with self._lock:
+            if not self.is_slowed_down():
+                self.spacing = 0
+                return
+            now = time.monotonic()
+            delay = self._next_start - now
+            self._next_start = max(now, self._next_start) + self.spacing
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self._lock:
+            cooling = len([until for _, until in self.cooldowns.values() if until > now])
+        return {
+            "captchas": self.captchas,
+            "cooling_fingerprints": cooling,
+            "spacing": self.spacing if self.is_slowed_down() else 0,
+        }
@@ -0,0 +1,104 @@
+"""
+Circuit breaker pausing status fetches while the target site is failing
+"""
+
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+async def probe_site(url, timeout=20):
+    """Check that the site answers at all, without loading the form in a browser"""
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+            async with session.get(url) as response:
+                return response.status == 200
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"Probe of {url} failed: {str(e) or type(e).__name__}")
+        return False
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failed fetches and opens after failure_threshold of them
+
+    An open breaker waits open_seconds and probes the site. When the probe passes the breaker
+    turns half-open and the next fetch decides: a success closes it, a failure opens it again
+    for twice as long, up to max_open_seconds.
+    """
+
+    def __init__(self, failure_threshold=3, open_seconds=300, max_open_seconds=3600, probe=None):
+        self.failure_threshold = failure_threshold
+        self.base_open_seconds = open_seconds
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.probe = probe
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    @property
+    def is_open(self):
+        return self.state == OPEN
+
+    def record_success(self):
+        # a fetch started before the circuit opened doesn't tell that the site is back, the probe does
+        if self.state == OPEN:
+            return
+        if self.state == HALF_OPEN:
+            logger.info("Site has recovered, closing the circuit")
+            self.open_seconds = self.base_open_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        """Count a failed fetch, return True if it opened the circuit"""
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN:
+            self.open_seconds = min(self.open_seconds * 2, self.max_open_seconds)
+            self.trip()
+            return True
+        if self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self.trip()
+            return True
+        return False
+
+    def trip(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        logger.warning(
+            f"Circuit opened after {self.consecutive_failures} failed fetch(es), pausing for {self.open_seconds}s"
+        )
+
+    def remaining(self):
+        """Seconds left until the site is probed again"""
+        if self.state != OPEN:
+            return 0
+        return max(0, self.opened_at + self.open_seconds - time.monotonic())
+
+    async def try_half_open(self):
+        """Probe the site, turn half-open if it answers or stay open for another period"""
+        if self.probe is None or await self.probe():
+            logger.info("Site answers the probe, letting requests through")
+            self.state = HALF_OPEN
+            return True
+        self.opened_at = time.monotonic()
+        return False
+
+    def get_stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "trips": self.trips,
+            "retry_in": int(self.remaining()),
+        }
@@ -0,0 +1,107 @@
+"""
+Adaptive concurrency of status fetches driven by the health of the target site
+"""
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyController:
+    """
+    AIMD controller of the browsers in use and the prefetch of the request queues
+
+    Every interval the fetches finished since the last check and the latency to the site are
+    looked at. While the failure ratio and the latency stay under their thresholds the limit
+    grows by one browser, when either of them is exceeded the limit is cut by the decrease factor.
+    The prefetch of every queue follows the limit proportionally to its configured maximum.
+    """
+
+    def __init__(
+        self,
+        browser_pool,
+        metrics,
+        messaging,
+        prefetch,
+        min_limit=1,
+        interval=60,
+        latency_threshold=5.0,
+        failure_threshold=0.2,
+        decrease_factor=0.5,
+    ):
+        self.browser_pool = browser_pool
+        self.metrics = metrics
+        self.messaging = messaging
+        # queue name -> prefetch count at the full pool size
+        self.prefetch = prefetch
+        self.min_limit = max(1, min(min_limit, browser_pool.size))
+        self.max_limit = browser_pool.size
+        self.interval = interval
+        self.latency_threshold = latency_threshold
+        self.failure_threshold = failure_threshold
+        self.decrease_factor = decrease_factor
+        self.last_check = time.time()
+        self.stats = {"increases": 0, "decreases": 0}
+
+    def _count_since(self, status, since):
+        return len([t for t in self.metrics.fetch_status[status] if t >= since])
+
+    def _next_limit(self, limit):
+        """Return the limit for the fetches finished since the last check"""
+        now = time.time()
+        successes = self._count_since("success", self.last_check)
+        # retried attempts failed against the site as well
+        failures = self._count_since("failed", self.last_check) + self._count_since("retried", self.last_check)
+        self.last_check = now
+        latency = self.metrics.get_avg_latency()
+
+        finished = successes + failures
+        if (finished and failures / finished > self.failure_threshold) or latency > self.latency_threshold:
+            logger.warning(
+                f"Target site is struggling ({failures}/{finished} failed, latency {latency:.2f}s), backing off"
+            )
+            self.stats["decreases"] += 1
+            return max(self.min_limit, int(limit * self.decrease_factor))
+        if not finished or limit >= self.max_limit:
+            # nothing tells whether the site could take more
+            return limit
+        self.stats["increases"] += 1
+        return limit + 1
+
+    def _prefetch_for(self, limit, max_prefetch):
+        return max(1, round(max_prefetch * limit / self.max_limit))
+
+    async def apply(self, limit):
+        """Set the browser limit and scale the prefetch of the queues with it"""
+        limit = self.browser_pool.set_limit(limit)
+        for queue_name, max_prefetch in self.prefetch.items():
+            await self.messaging.set_prefetch(queue_name, self._prefetch_for(limit, max_prefetch))
+        return limit
+
+    async def adjust(self):
+        """Run a single control step"""
+        limit = self.browser_pool.limit
+        next_limit = self._next_limit(limit)
+        if next_limit != limit:
+            logger.info(f"Concurrency limit changed from {limit} to {next_limit} browser(s)")
+            await self.apply(next_limit)
+
+    async def run(self):
+        """Start from the lowest limit and adjust it periodically"""
+        await self.apply(self.min_limit)
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.adjust()
+            except Exception as e:
+                logger.error(f"Failed to adjust concurrency: {e}")
+
+    def get_stats(self):
+        return {
+            "limit": self.browser_pool.limit,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            **self.stats,
+        }
@@ -18,10 +18,102 @@ PAGE_LOAD_LIMIT_SECONDS = 20
 CAPTCHA_WAIT_SECONDS = 120
 # The max number of messages a fetcher instance should be consuming at once
 MAX_MESSAGES = int(os.getenv("MAX_MESSAGES", 10))
+# The max number of refresh messages consumed at once, they have a prefetch window of their own
+REFRESH_MAX_MESSAGES = int(os.getenv("REFRESH_MAX_MESSAGES", MAX_MESSAGES))
+# How many times waiting refreshes can be passed over by user requests before they get a browser
+REFRESH_STARVATION_LIMIT = int(os.getenv("REFRESH_STARVATION_LIMIT", 5))
+# Reuse the loaded form between fetches instead of reloading the page, reload after this many reuses
+WARM_PAGE = os.getenv("WARM_PAGE", "true").lower() == "true"
+WARM_PAGE_MAX_REUSES = int(os.getenv("WARM_PAGE_MAX_REUSES", 50))
+# How browsers render: "xvfb" shares one virtual display between all browsers of the fetcher,
+# "headless" runs Firefox natively headless without any display (and without a privileged container)
+BROWSER_DISPLAY_MODE = os.getenv("BROWSER_DISPLAY_MODE", "xvfb").lower()
+# Start browsers from a copy of a profile prepared once (warm HTTP cache),
+# profiles are kept in PROFILE_DIR which should be a tmpfs
+PROFILE_TEMPLATE = os.getenv("PROFILE_TEMPLATE", "true").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/dev/shm/fetcher-profiles")
+# Cancel the requests the form doesn't need: resources of the listed types on the site and
+# any third-party host outside the allowlist (subdomains included, reCAPTCHA needs the Google ones)
+RESOURCE_BLOCKING = os.getenv("RESOURCE_BLOCKING", "true").lower() == "true"
+RESOURCE_BLOCKED_TYPES = [t for t in os.getenv("RESOURCE_BLOCKED_TYPES", "image,imageset,font,media").split(",") if t]
+RESOURCE_ALLOWED_HOSTS = [
+    h for h in os.getenv("RESOURCE_ALLOWED_HOSTS", "google.com,gstatic.com,recaptcha.net").split(",") if h
+]
+# The number of browsers running fetches in parallel
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", 2))
+# Replace a browser session after this many fetches, seconds or MB of memory taken by its Firefox processes,
+# the replacement is launched in the background and takes over between two fetches. 0 disables a limit
+BROWSER_RECYCLE_FETCHES = int(os.getenv("BROWSER_RECYCLE_FETCHES", 200))
+BROWSER_RECYCLE_AGE = int(os.getenv("BROWSER_RECYCLE_AGE", 3600))
+BROWSER_RECYCLE_RSS_MB = int(os.getenv("BROWSER_RECYCLE_RSS_MB", 500))
+# Adapt the browsers in use (up to BROWSER_POOL_SIZE) and the prefetch to the site's health, AIMD style:
+# one more browser per healthy interval, cut by the decrease factor on high failure ratio or latency (seconds)
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() == "true"
+ADAPTIVE_MIN_BROWSERS = int(os.getenv("ADAPTIVE_MIN_BROWSERS", 1))
+ADAPTIVE_INTERVAL = int(os.getenv("ADAPTIVE_INTERVAL", 60))
+ADAPTIVE_LATENCY_THRESHOLD = float(os.getenv("ADAPTIVE_LATENCY_THRESHOLD", 5))
+ADAPTIVE_FAILURE_THRESHOLD = float(os.getenv("ADAPTIVE_FAILURE_THRESHOLD", 0.2))
+ADAPTIVE_DECREASE_FACTOR = float(os.getenv("ADAPTIVE_DECREASE_FACTOR", 0.5))
+# Requests per second to the site allowed for all fetchers together, 0 disables the budget.
+# The budget can be changed at runtime with the bot's /fetch_budget command, the burst must match on all fetchers
+FETCH_RATE_LIMIT = float(os.getenv("FETCH_RATE_LIMIT", 0))
+FETCH_RATE_BURST = int(os.getenv("FETCH_RATE_BURST", 5))
+# Status fetch backend: "selenium", or "http" which falls back to selenium on challenges
+FETCH_BACKEND = os.getenv("FETCH_BACKEND", "selenium").lower()
+# Form submission endpoint and the response field holding the status, used by the http backend
+HTTP_BACKEND_ENDPOINT = os.getenv("HTTP_BACKEND_ENDPOINT", "")
+HTTP_BACKEND_STATUS_FIELD = os.getenv("HTTP_BACKEND_STATUS_FIELD", "message")
+HTTP_BACKEND_MAX_CONNECTIONS = int(os.getenv("HTTP_BACKEND_MAX_CONNECTIONS", 4))
+# Status cache size and how long (seconds) a fetched status answers fetch / refresh requests, 0 disables
+STATUS_CACHE_SIZE = int(os.getenv("STATUS_CACHE_SIZE", 1000))
+STATUS_CACHE_TTL_FETCH = int(os.getenv("STATUS_CACHE_TTL_FETCH", 60))
+STATUS_CACHE_TTL_REFRESH = int(os.getenv("STATUS_CACHE_TTL_REFRESH", 300))
+# Stop consuming after this many failed fetches in a row and probe the site again after the open period
+# (seconds), which doubles up to the max while the site keeps failing. 0 disables the circuit breaker
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_OPEN_SECONDS = int(os.getenv("CIRCUIT_OPEN_SECONDS", 300))
+CIRCUIT_MAX_OPEN_SECONDS = int(os.getenv("CIRCUIT_MAX_OPEN_SECONDS", 3600))
+# Form submissions a request may take across the in-browser, in-process and queue retries together,
+# and the time (seconds) after which it is not retried any more
+RETRY_BUDGET_ATTEMPTS = int(os.getenv("RETRY_BUDGET_ATTEMPTS", 12))
+RETRY_BUDGET_SECONDS = int(os.getenv("RETRY_BUDGET_SECONDS", 6 * 3600))
+# After a reCAPTCHA rejection the fingerprint (user agent and its cookies) isn't used for the cooldown (seconds),
+# doubling with its every further rejection, and fetch attempts are spaced the slowdown apart (doubling up to
+# the max) until no captcha was hit for the slowdown period
+CAPTCHA_COOLDOWN_SECONDS = int(os.getenv("CAPTCHA_COOLDOWN_SECONDS", 1800))
+CAPTCHA_MAX_COOLDOWN_SECONDS = int(os.getenv("CAPTCHA_MAX_COOLDOWN_SECONDS", 86400))
+CAPTCHA_SLOWDOWN_SECONDS = int(os.getenv("CAPTCHA_SLOWDOWN_SECONDS", 30))
+CAPTCHA_MAX_SLOWDOWN_SECONDS = int(os.getenv("CAPTCHA_MAX_SLOWDOWN_SECONDS", 600))
+CAPTCHA_SLOWDOWN_PERIOD = int(os.getenv("CAPTCHA_SLOWDOWN_PERIOD", 1800))
+# Where the cookie jars of the user agents are kept and how often (seconds) the saved ones are written there,
+# with COOKIE_SHARED the directory is shared by all fetchers and jars written by the others are picked up
+COOKIE_DIR = os.getenv("COOKIE_DIR", "cookies")
+COOKIE_FLUSH_INTERVAL = int(os.getenv("COOKIE_FLUSH_INTERVAL", 30))
+COOKIE_SHARED = os.getenv("COOKIE_SHARED", "false").lower() == "true"
+# User agents are sampled from this JSON lines file in the fake_useragent format (its bundled dataset if empty),
+# keeping the ones of the installed Firefox version or up to USERAGENT_MAX_VERSION_LAG versions older
+USERAGENT_CATALOGUE = os.getenv("USERAGENT_CATALOGUE", "")
+USERAGENT_MAX_VERSION_LAG = int(os.getenv("USERAGENT_MAX_VERSION_LAG", 2))
+FIREFOX_BINARY = os.getenv("FIREFOX_BINARY", "firefox")
+# Pick the fingerprint (user agent and its cookies) by its success so far instead of at random. The figures
+# are kept in FINGERPRINT_STORE, up to FINGERPRINT_MAX fingerprints are in use and one hitting the captcha
+# FINGERPRINT_RETIRE_AFTER times in a row is retired, it's forgotten after FINGERPRINT_RETIRED_TTL seconds
+FINGERPRINT_BANDIT = os.getenv("FINGERPRINT_BANDIT", "true").lower() == "true"
+FINGERPRINT_STORE = os.getenv("FINGERPRINT_STORE", "cookies/fingerprints.json")
+FINGERPRINT_MAX = int(os.getenv("FINGERPRINT_MAX", 30))
+FINGERPRINT_RETIRE_AFTER = int(os.getenv("FINGERPRINT_RETIRE_AFTER", 5))
+FINGERPRINT_RETIRED_TTL = int(os.getenv("FINGERPRINT_RETIRED_TTL", 604800))
 # The max number of message processing attempts
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", 10))
+# Backoff of retried requests, doubling from the base delay up to the max delay (seconds)
+RETRY_BASE_DELAY = int(os.getenv("RETRY_BASE_DELAY", 30))
+RETRY_MAX_DELAY = int(os.getenv("RETRY_MAX_DELAY", 1800))
+RETRY_DELAYS = sorted({min(RETRY_BASE_DELAY * 2**attempt, RETRY_MAX_DELAY) for attempt in range(MAX_RETRIES)})
 # Max time to disperse to refresh requests
 JITTER_SECONDS = int(os.getenv("JITTER_SECONDS", 900))
+# Refresh requests are delayed by one of this many evenly spaced steps up to JITTER_SECONDS
+JITTER_BUCKETS = int(os.getenv("JITTER_BUCKETS", 10))
+JITTER_DELAYS = [5 + (JITTER_SECONDS - 5) * (bucket + 1) // JITTER_BUCKETS for bucket in range(JITTER_BUCKETS)]
 # RabbitMQ settings
 RABBIT_HOST = os.getenv("RABBIT_HOST", "localhost")
 RABBIT_USER = os.getenv("RABBIT_USER", "bunny_admin")
@@ -31,7 +123,10 @@ RABBIT_SSL_PORT = int(os.getenv("RABBIT_SSL_PORT", 5671))
 RABBIT_SSL_CACERTFILE = os.getenv("RABBIT_SSL_CACERTFILE", "")
 RABBIT_SSL_CERTFILE = os.getenv("RABBIT_SSL_CERTFILE", "")
 RABBIT_SSL_KEYFILE = os.getenv("RABBIT_SSL_KEYFILE", "")
-# Metrics settings
+# Route requests to fetcher instances by a consistent hash of the application, requires
+# the rabbitmq_consistent_hash_exchange plugin and a unique stable ID per instance
+SHARDING_ENABLED = os.getenv("SHARDING_ENABLED", "false").lower() == "true"
+# Metrics settings, the ID also names the instance's shard queues
 ID = os.getenv("ID", "fetcher")
 METRICS_TTL = int(os.getenv("METRICS_TTL", 1800))
 METRICS_RATE = int(os.getenv("METRICS_RATE", 600))
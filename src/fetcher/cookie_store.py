@@ -0,0 +1,118 @@
+"""
+Cookie jars of the fingerprints, kept in memory and written behind to disk
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class CookieStore:
+    """
+    Cookie jars by user agent hash
+
+    Jars are served from memory, a file is read only on the first use of a jar. Saved jars are written
+    to the directory every flush_interval seconds by the run task, each into a temporary file renamed
+    over the old one, so readers never see a partly written jar. With shared set the directory is expected
+    to be shared by the fetchers (e.g. a ReadWriteMany volume): a jar is read again whenever another
+    fetcher has replaced its file, so cookies warmed by one fetcher are used by all of them.
+    """
+
+    def __init__(self, directory="cookies", flush_interval=30, shared=False):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.shared = shared
+        # key -> (cookies, modification time of the file they were read from or written to)
+        self.jars = {}
+        self.dirty = set()
+        self._lock = threading.Lock()
+        self.stats = {"reads": 0, "writes": 0}
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _mtime(self, key):
+        try:
+            return os.stat(self._path(key)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _read(self, key):
+        try:
+            with open(self._path(key)) as f:
+                cookies = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error(f"Ignoring unreadable cookie jar {self._path(key)}: {e}")
+            return None
+        self.stats["reads"] += 1
+        return cookies
+
+    def get(self, key):
+        """Return the cookies saved for the key, None if there are none"""
+        with self._lock:
+            cached = self.jars.get(key)
+            if cached and (not self.shared or key in self.dirty):
+                return cached[0]
+            mtime = self._mtime(key)
+            if cached and mtime == cached[1]:
+                return cached[0]
+            cookies = self._read(key) if mtime is not None else None
+            if cookies is not None:
+                self.jars[key] = (cookies, mtime)
+            return cookies
+
+    def put(self, key, cookies):
+        with self._lock:
+            self.jars[key] = (cookies, self.jars.get(key, (None, None))[1])
+            self.dirty.add(key)
+
+    def remove(self, key):
+        with self._lock:
+            self.jars.pop(key, None)
+            self.dirty.discard(key)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        """Write the jars saved since the last flush"""
+        with self._lock:
+            if not self.dirty:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            for key in list(self.dirty):
+                path = self._path(key)
+                # unique per writer, parallel fetchers never write into the same temporary file
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                try:
+                    with open(tmp_path, "w") as f:
+                        json.dump(self.jars[key][0], f)
+                    os.replace(tmp_path, path)
+                except OSError as e:
+                    logger.error(f"Failed to write cookie jar {path}: {e}")
+                    continue
+                self.jars[key] = (self.jars[key][0], self._mtime(key))
+                self.dirty.discard(key)
+                self.stats["writes"] += 1
+
+    async def run(self):
+        """Flush the saved jars periodically without blocking the event loop"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.flush)
+            except Exception as e:
+                logger.error(f"Failed to flush cookies: {e}")
+
+    def close(self):
+        self.flush()
+
+    def get_stats(self):
+        return {"jars": len(self.jars), "pending": len(self.dirty), **self.stats}
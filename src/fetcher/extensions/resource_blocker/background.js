@@ -0,0 +1,39 @@
+"use strict";
+
+// Blocks resources of the listed types on the site and every third-party host outside the allowlist,
+// config.json is written by the fetcher when it packs the extension
+const config = fetch(browser.runtime.getURL("config.json")).then((response) => response.json());
+let blocked = 0;
+
+function matchesHost(host, hosts) {
+  return hosts.some((allowed) => host === allowed || host.endsWith(`.${allowed}`));
+}
+
+function shouldBlock(details, { siteHosts, blockedTypes, allowedHosts }) {
+  if (details.type === "main_frame") {
+    return false;
+  }
+  const host = new URL(details.url).hostname;
+  if (matchesHost(host, siteHosts)) {
+    return blockedTypes.includes(details.type);
+  }
+  return !matchesHost(host, allowedHosts);
+}
+
+browser.webRequest.onBeforeRequest.addListener(
+  async (details) => {
+    if (!shouldBlock(details, await config)) {
+      return {};
+    }
+    blocked += 1;
+    if (details.tabId >= 0) {
+      browser.tabs.sendMessage(details.tabId, blocked).catch(() => {});
+    }
+    return { cancel: true };
+  },
+  { urls: ["http://*/*", "https://*/*"] },
+  ["blocking"]
+);
+
+// a freshly loaded page asks for the count so far
+browser.runtime.onMessage.addListener(() => Promise.resolve(blocked));
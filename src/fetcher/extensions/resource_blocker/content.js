@@ -0,0 +1,13 @@
+"use strict";
+
+// Keeps the number of requests blocked in this browser session on the page, where the fetcher reads it
+function show(blocked) {
+  if (document.documentElement) {
+    document.documentElement.setAttribute("data-blocked-requests", blocked);
+  } else {
+    document.addEventListener("DOMContentLoaded", () => show(blocked), { once: true });
+  }
+}
+
+browser.runtime.onMessage.addListener(show);
+browser.runtime.sendMessage("blocked").then(show);
@@ -0,0 +1,167 @@
+"""
+Choice of the browser fingerprint (user agent and its cookie jar) learning from the fetch outcomes
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Fingerprint:
+    __slots__ = ("useragent", "successes", "failures", "failures_in_row", "latency", "retired", "retired_at")
+
+    def __init__(
+        self, useragent, successes=0, failures=0, failures_in_row=0, latency=0.0, retired=False, retired_at=None
+    ):
+        self.useragent = useragent
+        self.successes = successes
+        self.failures = failures
+        self.failures_in_row = failures_in_row
+        # moving average of the successful fetch duration (seconds)
+        self.latency = latency
+        self.retired = retired
+        # wall clock time (epoch seconds) of the retirement, stores written before it was kept start it now
+        self.retired_at = retired_at or (time.time() if retired else None)
+
+    def sample(self):
+        """Draw a plausible success rate from the Beta posterior, slower fingerprints are scaled down"""
+        return random.betavariate(self.successes + 1, self.failures + 1) / (1 + self.latency / 60)
+
+    def to_list(self):
+        latency = round(self.latency, 2)
+        return [
+            self.useragent,
+            self.successes,
+            self.failures,
+            self.failures_in_row,
+            latency,
+            self.retired,
+            self.retired_at,
+        ]
+
+
+class FingerprintManager:
+    """
+    Thompson sampling over the fingerprints tried so far
+
+    Every fingerprint keeps its successes and failures, a choice draws a success rate for each of them
+    and takes the best one. Only outcomes the fingerprint can be blamed for count: a failure is a captcha
+    rejection, not a timeout or an outage of the site. While there are fewer than max_fingerprints in use,
+    a new fingerprint from new_useragent() competes with a uniform prior, so new ones get tried until
+    the good ones are known. A fingerprint failing retire_after times in a row is retired and forgotten
+    retired_ttl seconds later. The figures are kept in a JSON file, rewritten at most every save_interval
+    seconds.
+    """
+
+    def __init__(
+        self, path, new_useragent, max_fingerprints=30, retire_after=5, save_interval=60, retired_ttl=604800
+    ):
+        self.path = path
+        self.new_useragent = new_useragent
+        self.max_fingerprints = max_fingerprints
+        self.retire_after = retire_after
+        self.save_interval = save_interval
+        self.retired_ttl = retired_ttl
+        # user agent hash -> Fingerprint
+        self.fingerprints = {}
+        # reentrant, choose reads the active fingerprints while holding it
+        self._lock = threading.RLock()
+        self._saved_at = time.monotonic()
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self.fingerprints = {key: Fingerprint(*values) for key, values in json.load(f).items()}
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(f"Ignoring unreadable fingerprint store {self.path}: {e}")
+        self._prune()
+        logger.info(f"Loaded {len(self.fingerprints)} fingerprint(s) from {self.path}")
+
+    def save(self):
+        """Write the figures to a temporary file and swap it in, so a crash never leaves a truncated store"""
+        with self._lock:
+            self._prune()
+            data = {key: fingerprint.to_list() for key, fingerprint in self.fingerprints.items()}
+            self._dirty = False
+            self._saved_at = time.monotonic()
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+
+    def _prune(self):
+        """Forget the fingerprints retired more than retired_ttl ago"""
+        expired_before = time.time() - self.retired_ttl
+        for key in [key for key, fp in self.fingerprints.items() if fp.retired and fp.retired_at < expired_before]:
+            del self.fingerprints[key]
+
+    def _active(self):
+        with self._lock:
+            return {key: fingerprint for key, fingerprint in self.fingerprints.items() if not fingerprint.retired}
+
+    def choose(self, hash_useragent, is_available=lambda key: True):
+        """Return the user agent to use next, is_available filters out e.g. the ones cooling down"""
+        with self._lock:
+            candidates = {key: fp for key, fp in self._active().items() if is_available(key)}
+            best, best_score = None, -1
+            for fingerprint in candidates.values():
+                score = fingerprint.sample()
+                if score > best_score:
+                    best, best_score = fingerprint.useragent, score
+            if len(self._active()) < self.max_fingerprints and random.random() > best_score:
+                # a fingerprint not seen yet scores like one with the uniform prior
+                useragent = self.new_useragent()
+                key = hash_useragent(useragent)
+                if key not in self.fingerprints and is_available(key):
+                    self.fingerprints[key] = Fingerprint(useragent)
+                    self._dirty = True
+                    return useragent
+            return best or self.new_useragent()
+
+    def record(self, key, useragent, succeeded, latency=None):
+        """Count the outcome of a fetch made with the fingerprint, return True if it got retired"""
+        with self._lock:
+            fingerprint = self.fingerprints.setdefault(key, Fingerprint(useragent))
+            retired = False
+            if succeeded:
+                fingerprint.successes += 1
+                fingerprint.failures_in_row = 0
+                if latency is not None:
+                    previous = fingerprint.latency or latency
+                    fingerprint.latency = 0.8 * previous + 0.2 * latency
+            else:
+                fingerprint.failures += 1
+                fingerprint.failures_in_row += 1
+                if not fingerprint.retired and fingerprint.failures_in_row >= self.retire_after:
+                    fingerprint.retired = retired = True
+                    fingerprint.retired_at = time.time()
+                    logger.warning(f"Retiring fingerprint {key[:12]} after {self.retire_after} failures in a row")
+            self._dirty = True
+            save = time.monotonic() - self._saved_at >= self.save_interval
+        if save:
+            self.save()
+        return retired
+
+    def close(self):
+        if self._dirty:
+            self.save()
+
+    def get_stats(self):
+        with self._lock:
+            active = self._active().values()
+            attempts = sum(fp.successes + fp.failures for fp in active)
+            return {
+                "active": len(active),
+                "retired": len(self.fingerprints) - len(active),
+                "success_rate": round(sum(fp.successes for fp in active) / attempts, 2) if attempts else 0,
+            }
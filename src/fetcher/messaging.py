@@ -3,25 +3,49 @@ import asyncio
 import json
 import logging
 import ssl
+import uuid
 from fetcher.config import MAX_MESSAGES
-from aiormq.exceptions import AMQPConnectionError, ChannelInvalidStateError
+from aiormq.exceptions import AMQPConnectionError, ChannelInvalidStateError, PublishError
 
 MAX_RETRIES = 25  # maximum number of connection retries
 RETRY_DELAY = 5  # delay (in seconds) between retries
 
+# weight of a fetcher instance in the consistent hash ring
+SHARD_WEIGHT = "1"
+# header picking the backoff queue of a sharded queue, headers exchanges ignore x- keys when matching
+DELAY_TIER_HEADER = "delay-tier"
+
 logger = logging.getLogger(__name__)
 
 
+def get_shard_key(app_details):
+    """Routing key placing all requests for the same application on the same shard"""
+    return f"{app_details['number']}/{str(app_details['type']).upper()}-{app_details['year']}"
+
+
+def get_sharded_exchange_name(queue_name):
+    return f"{queue_name}.sharded"
+
+
 class Messaging:
-    def __init__(self, host, user, password):
+    def __init__(self, host, user, password, retry_delays=(), shard_id=None):
         self.host = host
         self.user = user
         self.password = password
         self.port = 5672
+        # delays (in seconds) of the backoff queues set up for retried requests
+        self.retry_delays = sorted(retry_delays)
+        self.delay_queues = {}
+        # sharded queues are fed by a consistent-hash exchange, every instance consumes a shard queue of its own
+        self.shard_id = shard_id
+        self.shard_queues = {}
+        self.exchanges = {}
         self.connection = None
         self.channel = None
         self.queues = {}
         self.consumers = {}
+        self.consumer_callbacks = {}
+        self.consumer_channels = {}
 
     def _create_ssl_context(self, ssl_params):
         """Create an SSL context based on provided parameters"""
@@ -76,27 +100,137 @@ class Messaging:
                     logger.error("Max retries reached. Could not connect to RabbitMQ.")
                     raise
 
-    async def setup_queues(self, **queues):
-        """Declare necessary queues and thier durability"""
+    async def setup_queues(self, with_retries=False, sharded=False, **queues):
+        """
+        Declare necessary queues and thier durability
+
+        With with_retries every queue also gets a set of backoff queues, one per retry delay.
+        Messages expire there after the delay and are dead-lettered back to the queue.
+
+        With sharded every queue is replaced with a consistent-hash exchange and this instance's
+        shard queue bound to it, so requests for one application always land on the same instance.
+        """
         await self._ensure_channel()
         for queue_name, durable in queues.items():
-            queue = await self.channel.declare_queue(queue_name, durable=durable)
-            self.queues[queue_name] = queue
+            if sharded:
+                await self._setup_shard_queue(queue_name)
+            else:
+                queue = await self.channel.declare_queue(queue_name, durable=durable)
+                self.queues[queue_name] = queue
+            if with_retries:
+                await self.setup_delay_queues(queue_name, self.retry_delays)
+
+    async def _setup_shard_queue(self, queue_name):
+        """Declare the exchange of a sharded queue and join its hash ring with a shard queue"""
+        exchange = await self.channel.declare_exchange(
+            get_sharded_exchange_name(queue_name), aio_pika.ExchangeType.X_CONSISTENT_HASH, durable=True
+        )
+        shard_queue_name = f"{queue_name}.{self.shard_id}"
+        queue = await self.channel.declare_queue(shard_queue_name, durable=True)
+        await queue.bind(exchange, routing_key=SHARD_WEIGHT)
+        self.exchanges[queue_name] = exchange
+        self.shard_queues[queue_name] = shard_queue_name
+        self.queues[queue_name] = queue
+        logger.info(f"Joined the hash ring of {queue_name} with shard queue {shard_queue_name}")
+
+    async def setup_delay_queues(self, queue_name, delays):
+        """
+        Declare backoff queues dead-lettering expired messages into the queue
+
+        Backoff queues of a sharded queue are shared by all instances. Messages are routed into them
+        by a headers exchange, so they keep their shard key and re-enter the hash ring once expired.
+        """
+        await self._ensure_channel()
+        sharded = queue_name in self.shard_queues
+        if sharded:
+            delay_exchange = await self.channel.declare_exchange(
+                f"{get_sharded_exchange_name(queue_name)}.delay", aio_pika.ExchangeType.HEADERS, durable=True
+            )
+            self.exchanges[f"{queue_name}.delay"] = delay_exchange
+        for delay in delays:
+            if delay in self.delay_queues.get(queue_name, []):
+                continue
+            if sharded:
+                delay_queue_name = f"{get_sharded_exchange_name(queue_name)}.delay.{delay}"
+                dead_letter_arguments = {"x-dead-letter-exchange": get_sharded_exchange_name(queue_name)}
+            else:
+                delay_queue_name = f"{queue_name}.delay.{delay}"
+                dead_letter_arguments = {"x-dead-letter-exchange": "", "x-dead-letter-routing-key": queue_name}
+            queue = await self.channel.declare_queue(
+                delay_queue_name,
+                durable=True,
+                arguments={"x-message-ttl": delay * 1000, **dead_letter_arguments},
+            )
+            if sharded:
+                await queue.bind(delay_exchange, arguments={"x-match": "all", DELAY_TIER_HEADER: delay})
+                # drop the binding of older versions, it matched every message (unbinding a missing one is a no-op)
+                await queue.unbind(delay_exchange, arguments={"x-match": "all", "x-delay-tier": delay})
+            self.queues[delay_queue_name] = queue
+            self.delay_queues.setdefault(queue_name, []).append(delay)
+
+    def _get_delay_tier(self, queue_name, delay):
+        """Return the shortest backoff delay holding messages for at least the delay, or None"""
+        delays = self.delay_queues.get(queue_name)
+        if not delays:
+            return None
+        return next((tier for tier in sorted(delays) if tier >= delay), max(delays))
+
+    def _get_delay_queue(self, queue_name, delay):
+        """Return the shortest backoff queue holding messages for at least the delay, or None"""
+        tier = self._get_delay_tier(queue_name, delay)
+        if tier is None:
+            return None
+        if queue_name in self.shard_queues:
+            return f"{get_sharded_exchange_name(queue_name)}.delay.{tier}"
+        return f"{queue_name}.delay.{tier}"
+
+    def _get_route(self, queue_name, message_body):
+        """Return the exchange and routing key a message for the queue is published with"""
+        if queue_name in self.shard_queues and "number" in message_body:
+            return self.exchanges[queue_name], get_shard_key(message_body)
+        # messages without an application (batches) are routed by the name of this instance's shard
+        return self.channel.default_exchange, self.shard_queues.get(queue_name, queue_name)
 
     async def publish_message(self, queue_name, message_body, headers=None):
         """Publish a message to the specified queue"""
         await self._ensure_channel()
         message = aio_pika.Message(body=json.dumps(message_body).encode(), headers=headers)
+        exchange, routing_key = self._get_route(queue_name, message_body)
         try:
-            await self.channel.default_exchange.publish(
-                message, routing_key=queue_name
-            )
+            await exchange.publish(message, routing_key=routing_key)
             logger.debug(f"Successfully published message to {queue_name}")
         except Exception as e:
             logger.error(f"Failed to publish message: {e}")
             raise
         logger.debug(f"Successfully published message to {queue_name}")
 
+    async def publish_delayed_message(self, queue_name, message_body, delay, headers=None):
+        """
+        Publish a message which reaches the queue after the delay (in seconds)
+
+        The message waits in a backoff queue without occupying a consumer. The per-message
+        expiration lets jittered delays be shorter than the delay of the backoff queue.
+        """
+        delay_queue_name = self._get_delay_queue(queue_name, delay)
+        if not delay_queue_name:
+            logger.warning(f"No backoff queues are set up for {queue_name}, publishing without delay")
+            return await self.publish_message(queue_name, message_body, headers=headers)
+
+        await self._ensure_channel()
+        if queue_name in self.shard_queues:
+            # the routing key is kept for the hash ring, the backoff queue is picked by the tier header
+            exchange, routing_key = self.exchanges[f"{queue_name}.delay"], self._get_route(queue_name, message_body)[1]
+            headers = {**(headers or {}), DELAY_TIER_HEADER: self._get_delay_tier(queue_name, delay)}
+        else:
+            exchange, routing_key = self.channel.default_exchange, delay_queue_name
+        message = aio_pika.Message(body=json.dumps(message_body).encode(), headers=headers, expiration=delay)
+        try:
+            await exchange.publish(message, routing_key=routing_key)
+        except Exception as e:
+            logger.error(f"Failed to publish delayed message: {e}")
+            raise
+        logger.debug(f"Successfully published message to {delay_queue_name}")
+
     async def publish_service_message(self, message_body, queue_name="FetcherMetricsQueue", expiration=30, headers=None):
         """Publish a short-lived service message"""
         await self._ensure_channel()
@@ -111,19 +245,120 @@ class Messaging:
             raise
         logger.debug(f"Successfully published message to {queue_name}")
 
-    async def consume_messages(self, queue_name, callback_func):
-        """Consume messages from the specified queue"""
-        queue = self.queues.get(queue_name)
-        if not queue:
-            queue = await self.channel.declare_queue(queue_name, durable=True)
-            self.queues[queue_name] = queue
+    async def consume_messages(self, queue_name, callback_func, prefetch_count=None):
+        """
+        Consume messages from the specified queue
+
+        With prefetch_count the queue gets a channel of its own, so a backlog in one
+        queue can't use up the prefetch window of the others.
+        """
+        if prefetch_count:
+            channel = await self.connection.channel()
+            await channel.set_qos(prefetch_count=prefetch_count)
+            self.consumer_channels[queue_name] = channel
+            queue = await channel.declare_queue(self.shard_queues.get(queue_name, queue_name), durable=True)
+        else:
+            queue = self.queues.get(queue_name)
+            if not queue:
+                queue = await self.channel.declare_queue(queue_name, durable=True)
+                self.queues[queue_name] = queue
 
         consumer_tag = await queue.consume(callback_func)
         # internally used by aio_pika to keep track of consumers
         self.consumers[queue_name] = (queue, consumer_tag)
+        self.consumer_callbacks[queue_name] = (queue, callback_func)
+
+    async def pause_consumers(self):
+        """Stop receiving new messages, the ones already delivered are still processed"""
+        for queue_name, (queue, consumer_tag) in list(self.consumers.items()):
+            await queue.cancel(consumer_tag)
+            del self.consumers[queue_name]
+            logger.info(f"Paused consuming {queue_name}")
+
+    async def resume_consumers(self):
+        """Start consuming the queues stopped by pause_consumers again"""
+        for queue_name, (queue, callback_func) in self.consumer_callbacks.items():
+            if queue_name not in self.consumers:
+                self.consumers[queue_name] = (queue, await queue.consume(callback_func))
+                logger.info(f"Resumed consuming {queue_name}")
+
+    async def set_prefetch(self, queue_name, prefetch_count):
+        """
+        Change the prefetch window of a queue consumed on a channel of its own
+
+        The QoS only applies to consumers started after it, so a running consumer is started again.
+        Messages already delivered to it stay on the channel and are acked as usual.
+        """
+        channel = self.consumer_channels.get(queue_name)
+        if channel is None or channel.is_closed:
+            return False
+        consumer = self.consumers.pop(queue_name, None)
+        if consumer:
+            await consumer[0].cancel(consumer[1])
+        await channel.set_qos(prefetch_count=prefetch_count)
+        if consumer:
+            queue, callback_func = self.consumer_callbacks[queue_name]
+            self.consumers[queue_name] = (queue, await queue.consume(callback_func))
+        return True
+
+    async def leave_shards(self):
+        """
+        Leave the hash rings and hand the queued requests over to the remaining instances
+
+        The shard queue is unbound first so new requests go to other shards, then the requests
+        left in it are republished through the exchange. The queue itself is kept for messages
+        still being processed, they are picked up when an instance with the same ID rejoins.
+        Requests are published as mandatory on a channel raising on returns: when no other
+        instance is left in the ring they stay in the shard queue, which is bound again.
+        """
+        handover_channel = await self.connection.channel(on_return_raises=True)
+        try:
+            for queue_name, shard_queue_name in self.shard_queues.items():
+                await self._hand_over_shard(queue_name, shard_queue_name, handover_channel)
+        finally:
+            await handover_channel.close()
+
+    async def _hand_over_shard(self, queue_name, shard_queue_name, handover_channel):
+        self.consumer_callbacks.pop(queue_name, None)
+        consumer = self.consumers.pop(queue_name, None)
+        if consumer:
+            await consumer[0].cancel(consumer[1])
+        exchange = self.exchanges[queue_name]
+        handover_exchange = await handover_channel.declare_exchange(
+            get_sharded_exchange_name(queue_name), aio_pika.ExchangeType.X_CONSISTENT_HASH, durable=True
+        )
+        queue = await self.channel.declare_queue(shard_queue_name, durable=True)
+        await queue.unbind(exchange, routing_key=SHARD_WEIGHT)
+        moved = 0
+        while True:
+            message = await queue.get(no_ack=False, fail=False)
+            if message is None:
+                break
+            try:
+                routing_key = get_shard_key(json.loads(message.body))
+            except (ValueError, KeyError, TypeError):
+                routing_key = shard_queue_name
+            # returns are matched to the publish by the message ID
+            handover = aio_pika.Message(
+                body=message.body, headers=message.headers, message_id=message.message_id or uuid.uuid4().hex
+            )
+            try:
+                await handover_exchange.publish(handover, routing_key=routing_key, mandatory=True)
+            except PublishError:
+                await message.nack(requeue=True)
+                await queue.bind(exchange, routing_key=SHARD_WEIGHT)
+                logger.warning(
+                    f"No other instance in the hash ring of {queue_name}, keeping the requests in {shard_queue_name}"
+                )
+                return
+            await message.ack()
+            moved += 1
+        logger.info(f"Left the hash ring of {queue_name}, handed over {moved} queued message(s)")
 
     async def close(self):
         """Close the connection"""
+        for channel in self.consumer_channels.values():
+            await channel.close()
         if self.channel:
             logger.info("Closing RabbitMQ channel...")
             await self.channel.close()
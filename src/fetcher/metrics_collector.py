@@ -17,9 +17,10 @@ class MetricsCollector:
         self.rate = rate
         self.send_interval = send_interval
         self.latency_data = deque(maxlen=max_latencies)
-        self.fetch_status = {"success": deque(), "failed": deque(), "retried": deque()}
-        self.request_state = {"waiting": 0, "locked": 0}
+        self.fetch_status = {"success": deque(), "failed": deque(), "retried": deque(), "expired": deque(), "captcha": deque()}
+        self.request_state = {"locked": 0, "coalesced": 0}
         self.connection_status = "❓ Unknown"
+        self.stats_sources = {}
         self.last_report_time = time.time()
         self.start_time = time.time()
 
@@ -70,6 +71,10 @@ class MetricsCollector:
         if status in self.fetch_status:
             self.fetch_status[status].append(time.time())
 
+    def add_stats_source(self, name, getter):
+        """Register a callable whose result is reported under the given name"""
+        self.stats_sources[name] = getter
+
     def get_metrics(self):
         """Retrieve the collected metrics"""
         current_time = time.time()
@@ -79,6 +84,8 @@ class MetricsCollector:
         recent_successes = len([t for t in self.fetch_status["success"] if t >= past_time])
         recent_failures = len([t for t in self.fetch_status["failed"] if t >= past_time])
         recent_retries = len([t for t in self.fetch_status["retried"] if t >= past_time])
+        recent_expired = len([t for t in self.fetch_status["expired"] if t >= past_time])
+        recent_captchas = len([t for t in self.fetch_status["captcha"] if t >= past_time])
 
         rates = {
             "success_rate": recent_successes / (self.ttl / self.rate),
@@ -91,11 +98,17 @@ class MetricsCollector:
             while self.fetch_status[state] and self.fetch_status[state][0] < past_time:
                 self.fetch_status[state].popleft()
 
-        return {
+        metrics = {
             "fetcher_id": self.fetcher_id,
             "connection_status": self.connection_status,
             "average_latency": self.get_avg_latency(),
-            "fetch_status": {"success": recent_successes, "failed": recent_failures, "retries": recent_retries},
+            "fetch_status": {
+                "success": recent_successes,
+                "failed": recent_failures,
+                "retries": recent_retries,
+                "expired": recent_expired,
+                "captcha": recent_captchas,
+            },
             "request_state": self.request_state,
             "rates": rates,
             "rate_interval": self.rate,
@@ -103,6 +116,9 @@ class MetricsCollector:
             "uptime": uptime,
             "version": FULL_VERSION,
         }
+        for name, getter in self.stats_sources.items():
+            metrics[name] = getter()
+        return metrics
 
     async def send_metrics(self):
         while True:
@@ -0,0 +1,184 @@
+"""
+Request budget for the target site shared by all fetchers
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+import aio_pika
+from aiormq.exceptions import ChannelLockedResource
+
+logger = logging.getLogger(__name__)
+
+TOKEN_QUEUE = "FetchTokenQueue"
+BUDGET_QUEUE = "FetchBudgetQueue"
+MINTER_QUEUE = "FetchTokenMinter"
+
+
+class LocalTokenBucket:
+    """Token bucket refilled at a steady rate (requests per second), shared by the requests of this process"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.stats = {"granted": 0, "wait_seconds": 0.0}
+
+    def set_rate(self, rate):
+        if rate <= 0:
+            raise ValueError("Request budget must be positive")
+        self._refill()
+        self.rate = rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Wait until a request to the site fits into the budget"""
+        started = time.monotonic()
+        # requests waiting for a token are served in arrival order
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+        self.stats["granted"] += 1
+        self.stats["wait_seconds"] += time.monotonic() - started
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def get_stats(self):
+        return {"rate": self.rate, "burst": self.burst, **self.stats, "wait_seconds": round(self.stats["wait_seconds"])}
+
+
+class RabbitTokenBucket:
+    """
+    Token bucket shared by all fetchers through RabbitMQ
+
+    Tokens are messages of a length-limited queue, so the broker never keeps more than burst of them.
+    One fetcher at a time mints tokens at the budgeted rate, it is elected by holding an exclusive
+    queue and the others take over once its connection is gone. The budget is the last message of
+    the budget queue and is re-read periodically, so it can be changed at runtime.
+    """
+
+    def __init__(
+        self, messaging, rate, burst=None, poll_interval=0.2, tick=1.0, budget_interval=10, election_interval=15
+    ):
+        self.messaging = messaging
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.poll_interval = poll_interval
+        self.tick = tick
+        self.budget_interval = budget_interval
+        self.election_interval = election_interval
+        self.channel = None
+        self.token_queue = None
+        self.budget_queue = None
+        self.minter_channel = None
+        self.minting = False
+        self._task = None
+        self.stats = {"granted": 0, "wait_seconds": 0.0, "minted": 0}
+
+    async def start(self):
+        """Declare the token and budget queues and start taking part in the minter election"""
+        self.channel = await self.messaging.connection.channel()
+        self.token_queue = await self.channel.declare_queue(TOKEN_QUEUE, arguments={"x-max-length": self.burst})
+        self.budget_queue = await self.channel.declare_queue(BUDGET_QUEUE, durable=True, arguments={"x-max-length": 1})
+        self._task = asyncio.create_task(self._run())
+
+    def set_rate(self, rate):
+        if rate <= 0:
+            raise ValueError("Request budget must be positive")
+        if rate != self.rate:
+            logger.info(f"Request budget changed from {self.rate} to {rate} request(s) per second")
+        self.rate = rate
+
+    async def _read_budget(self):
+        """Peek at the current budget, leaving it in the queue for the other fetchers"""
+        message = await self.budget_queue.get(no_ack=False, fail=False)
+        if message is None:
+            return
+        await message.nack(requeue=True)
+        try:
+            self.set_rate(float(json.loads(message.body)["rate"]))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Ignoring invalid request budget {message.body}: {e}")
+
+    async def _elect(self):
+        """Try to become the minter by declaring the exclusive minter queue"""
+        channel = await self.messaging.connection.channel()
+        try:
+            await channel.declare_queue(MINTER_QUEUE, exclusive=True)
+        except ChannelLockedResource:
+            # the broker closes the channel, another fetcher is minting
+            return False
+        # the exclusive queue is held as long as the channel is open
+        self.minter_channel = channel
+        logger.info("This fetcher mints request tokens for the fleet")
+        return True
+
+    async def _mint(self, credit):
+        """Publish the whole tokens of the credit, return the remainder"""
+        for _ in range(int(credit)):
+            await self.channel.default_exchange.publish(aio_pika.Message(body=b""), routing_key=TOKEN_QUEUE)
+            self.stats["minted"] += 1
+        return credit - int(credit)
+
+    async def _run(self):
+        last_budget = last_election = 0
+        credit = 0.0
+        last_tick = time.monotonic()
+        while True:
+            try:
+                now = time.monotonic()
+                if now - last_budget >= self.budget_interval:
+                    last_budget = now
+                    await self._read_budget()
+                if not self.minting and now - last_election >= self.election_interval:
+                    last_election = now
+                    self.minting = await self._elect()
+                if self.minting:
+                    # tokens above the burst are dropped by the broker
+                    credit = min(self.burst, credit + (now - last_tick) * self.rate)
+                    credit = await self._mint(credit)
+                last_tick = now
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Request budget maintenance failed: {e}")
+            await asyncio.sleep(self.tick)
+
+    async def acquire(self):
+        """Wait until a request to the site fits into the fleet-wide budget"""
+        started = time.monotonic()
+        while await self.token_queue.get(no_ack=True, fail=False) is None:
+            await asyncio.sleep(self.poll_interval)
+        self.stats["granted"] += 1
+        self.stats["wait_seconds"] += time.monotonic() - started
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        for channel in (self.minter_channel, self.channel):
+            if channel and not channel.is_closed:
+                await channel.close()
+
+    def get_stats(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "minting": self.minting,
+            **self.stats,
+            "wait_seconds": round(self.stats["wait_seconds"]),
+        }
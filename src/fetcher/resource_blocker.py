@@ -0,0 +1,59 @@
+"""
+Blocking of the page resources the status form doesn't need
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import zipfile
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_DIR = os.path.join(os.path.dirname(__file__), "extensions", "resource_blocker")
+# attribute of the <html> element the extension keeps the count of blocked requests in
+BLOCKED_ATTRIBUTE = "data-blocked-requests"
+
+
+class ResourceBlocker:
+    """
+    Firefox extension cancelling heavy and third-party requests
+
+    On the site itself the requests of blocked_types (images, fonts, ...) are cancelled, any other host
+    has to be in allowed_hosts (subdomains included), which keeps what reCAPTCHA needs. The extension is
+    packed once per process with its configuration and installed as a temporary add-on in every session.
+    """
+
+    def __init__(self, site_url, blocked_types, allowed_hosts):
+        self.site_hosts = [urlparse(site_url).hostname]
+        self.blocked_types = list(blocked_types)
+        self.allowed_hosts = list(allowed_hosts)
+        self.path = None
+        self._lock = threading.Lock()
+
+    def get_config(self):
+        return {"siteHosts": self.site_hosts, "blockedTypes": self.blocked_types, "allowedHosts": self.allowed_hosts}
+
+    def pack(self):
+        """Return the path of the extension packed with the configuration"""
+        with self._lock:
+            if self.path is None:
+                fd, path = tempfile.mkstemp(prefix="resource-blocker-", suffix=".xpi")
+                with os.fdopen(fd, "wb") as f, zipfile.ZipFile(f, "w") as xpi:
+                    for name in os.listdir(EXTENSION_DIR):
+                        xpi.write(os.path.join(EXTENSION_DIR, name), name)
+                    xpi.writestr("config.json", json.dumps(self.get_config()))
+                self.path = path
+                logger.info("Packed the resource blocker to %s: %s", path, self.get_config())
+            return self.path
+
+    def install(self, driver):
+        driver.execute("INSTALL_ADDON", {"path": self.pack(), "temporary": True})
+
+    @staticmethod
+    def blocked_requests(driver):
+        """Return the number of requests blocked since the session has started"""
+        blocked = driver.execute_script(f"return document.documentElement.getAttribute('{BLOCKED_ATTRIBUTE}');")
+        return int(blocked or 0)
@@ -0,0 +1,59 @@
+"""
+Retry budget of a request shared by the browser, the processor and the queue layers
+"""
+
+import time
+
+# How a failed attempt is treated by the layers above it
+TRANSIENT = "transient"  # timeouts, browser crashes, missing status: worth another attempt later
+PERMANENT = "permanent"  # the form rejected the application details, another attempt gives the same result
+CAPTCHA = "captcha"  # reCAPTCHA rejected the submission, worth another attempt with a different fingerprint
+
+ATTEMPTS_HEADER = "x-attempts-left"
+DEADLINE_HEADER = "x-retry-deadline"
+
+
+class RetryPolicy:
+    """
+    Attempt budget and deadline of a request, every form submission takes one attempt
+
+    The policy travels in the message headers between the republishes, so the browser,
+    the in-process retries and the backoff queues all spend from the same budget.
+    """
+
+    def __init__(self, attempts, deadline):
+        self.attempts = attempts
+        # wall clock time (epoch seconds) after which the request isn't retried any more
+        self.deadline = deadline
+        self.last_error = None
+
+    @classmethod
+    def from_headers(cls, headers, attempts, ttl):
+        """Restore the policy of a republished request or start a new one"""
+        headers = headers or {}
+        if ATTEMPTS_HEADER in headers and DEADLINE_HEADER in headers:
+            return cls(int(headers[ATTEMPTS_HEADER]), float(headers[DEADLINE_HEADER]))
+        return cls(attempts, time.time() + ttl)
+
+    def to_headers(self):
+        return {ATTEMPTS_HEADER: self.attempts, DEADLINE_HEADER: self.deadline}
+
+    def remaining_seconds(self):
+        return max(0, self.deadline - time.time())
+
+    def exhausted(self):
+        return self.attempts <= 0 or self.remaining_seconds() <= 0
+
+    def spend(self):
+        """Take an attempt from the budget, return False if there is none left"""
+        if self.exhausted():
+            return False
+        self.attempts -= 1
+        return True
+
+    def record_error(self, kind):
+        self.last_error = kind
+
+    def should_retry(self):
+        """Whether another attempt is worth making after the last failure"""
+        return self.last_error != PERMANENT and not self.exhausted()
@@ -0,0 +1,49 @@
+"""
+Short-lived cache of fetched application statuses
+"""
+
+import time
+from collections import OrderedDict
+
+
+class StatusCache:
+    """Bounded LRU cache of statuses, each request type has its own freshness window"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        # request type -> seconds a cached status is considered fresh for it
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(app_details):
+        return (
+            str(app_details["number"]),
+            str(app_details.get("suffix", "0")),
+            app_details["type"].upper(),
+            str(app_details["year"]),
+        )
+
+    def get(self, app_details, request_type):
+        """Return a cached status which is fresh enough for the request type, or None"""
+        ttl = self.ttl.get(request_type, 0)
+        entry = self._entries.get(self._key(app_details))
+        if entry is None or time.monotonic() - entry[1] > ttl:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(self._key(app_details))
+        self.hits += 1
+        return entry[0]
+
+    def put(self, app_details, status):
+        """Store a freshly fetched status, evicting the least recently used one when full"""
+        key = self._key(app_details)
+        self._entries[key] = (status, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get_stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,126 @@
+"""
+Capture of the form submission outcome from the page itself
+"""
+
+# the site answers a submission it suspects with this text
+RECAPTCHA_FAILED_MARKER = "Recaptcha verification failed"
+
+# Hooks fetch and XHR of the page to record the POST requests of the form and their responses,
+# and observes the DOM for a new status alert. Every record is an event in window.__statusCapture.events,
+# the script returns their count, so that only the events of the next submission can be waited for.
+# Takes the captcha marker as its argument.
+INSTALL_SCRIPT = """
+const rejectedMarker = arguments[0];
+if (!window.__statusCapture) {
+  const alertHtml = () => {
+    const alert = document.querySelector(".alert__content");
+    return alert ? alert.innerHTML : null;
+  };
+  const capture = { events: [], listeners: [], lastAlert: alertHtml() };
+  window.__statusCapture = capture;
+  const record = (event) => {
+    capture.events.push(event);
+    capture.listeners.slice().forEach((listener) => listener());
+  };
+  const recordResponse = (url, status, body) => {
+    body = body || "";
+    let kind = "response";
+    if (body.includes(rejectedMarker)) {
+      kind = "rejected";
+    } else if (status >= 400) {
+      kind = "http_error";
+    }
+    record({ kind: kind, url: url, status: status, body: body.slice(0, 2000) });
+  };
+
+  const originalFetch = window.fetch;
+  window.fetch = function (input, init) {
+    const method = ((init && init.method) || (input && input.method) || "GET").toUpperCase();
+    const url = String((input && input.url) || input);
+    const response = originalFetch.apply(this, arguments);
+    if (method !== "POST") {
+      return response;
+    }
+    record({ kind: "request", url: url });
+    return response.then((result) => {
+      result.clone().text().then((body) => recordResponse(url, result.status, body), () => {});
+      return result;
+    });
+  };
+
+  const originalOpen = XMLHttpRequest.prototype.open;
+  const originalSend = XMLHttpRequest.prototype.send;
+  XMLHttpRequest.prototype.open = function (method, url) {
+    this.__capture = { method: String(method).toUpperCase(), url: String(url) };
+    return originalOpen.apply(this, arguments);
+  };
+  XMLHttpRequest.prototype.send = function () {
+    const info = this.__capture;
+    if (info && info.method === "POST") {
+      record({ kind: "request", url: info.url });
+      this.addEventListener("loadend", () => {
+        let body = "";
+        try {
+          body = typeof this.response === "string" ? this.response : JSON.stringify(this.response);
+        } catch (e) {}
+        recordResponse(info.url, this.status, body);
+      });
+    }
+    return originalSend.apply(this, arguments);
+  };
+
+  new MutationObserver(() => {
+    const html = alertHtml();
+    if (html && html !== capture.lastAlert) {
+      capture.lastAlert = html;
+      record({ kind: "alert", html: html });
+    }
+  }).observe(document.body, { childList: true, subtree: true, characterData: true });
+}
+return window.__statusCapture.events.length;
+"""
+
+# Resolves with the first event of the given kinds recorded after the since-th one, or null on timeout
+WAIT_SCRIPT = """
+const [since, kinds, timeout, done] = arguments;
+const capture = window.__statusCapture;
+if (!capture) {
+  done(null);
+  return;
+}
+let finished = false;
+const finish = (event) => {
+  if (finished) {
+    return;
+  }
+  finished = true;
+  capture.listeners = capture.listeners.filter((listener) => listener !== check);
+  done(event);
+};
+const check = () => {
+  const event = capture.events.slice(since).find((e) => kinds.includes(e.kind));
+  if (event) {
+    finish(event);
+  }
+};
+capture.listeners.push(check);
+setTimeout(() => finish(null), timeout * 1000);
+check();
+"""
+
+REQUEST = "request"
+RESPONSE = "response"
+REJECTED = "rejected"  # the reCAPTCHA verification failed
+HTTP_ERROR = "http_error"  # any other 4xx/5xx answer of the site
+ALERT = "alert"
+
+
+def install(driver):
+    """Hook the loaded page, if it isn't yet, and return the number of events recorded so far"""
+    return driver.execute_script(INSTALL_SCRIPT, RECAPTCHA_FAILED_MARKER)
+
+
+def wait_for(driver, since, kinds, timeout):
+    """Return the first event of kinds recorded after since, None if there was none within timeout seconds"""
+    driver.set_script_timeout(timeout + 5)
+    return driver.execute_async_script(WAIT_SCRIPT, since, list(kinds), timeout)
@@ -0,0 +1,90 @@
+"""
+User agent catalogue loaded once per process and matched to the installed Firefox
+"""
+
+import json
+import logging
+import random
+import re
+import subprocess
+import threading
+
+from fake_useragent.utils import load as load_bundled_useragents
+
+logger = logging.getLogger(__name__)
+
+FIREFOX_VERSION = re.compile(r"Firefox/(\d+)")
+
+
+def get_installed_firefox_version(binary="firefox"):
+    """Return the major version of the installed Firefox, None if it can't be told"""
+    try:
+        output = subprocess.run([binary, "--version"], capture_output=True, text=True, timeout=30).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Couldn't tell the version of {binary}: {e}")
+        return None
+    match = re.search(r"(\d+)\.", output)
+    return int(match.group(1)) if match else None
+
+
+def retarget(useragent, version):
+    """Make the user agent claim the given Firefox version, rv is frozen at 109 from Firefox 110 to 119"""
+    rv = 109 if 110 <= version < 120 else version
+    useragent = re.sub(r"rv:\d+(\.\d+)?", f"rv:{rv}.0", useragent)
+    return FIREFOX_VERSION.sub(f"Firefox/{version}", useragent)
+
+
+class UserAgentCatalogue:
+    """
+    Firefox user agents with their market share, sampled from memory
+
+    The entries come from a JSON lines file in the fake_useragent format (the dataset bundled with
+    fake_useragent by default) and are loaded on the first use. Only the ones claiming the installed
+    Firefox version, or up to max_version_lag versions below it, are kept: a user agent the engine
+    doesn't match is easy to spot. Without any such entry the Firefox ones are rewritten to that version.
+    """
+
+    def __init__(self, path=None, firefox_binary="firefox", max_version_lag=2):
+        self.path = path
+        self.firefox_binary = firefox_binary
+        self.max_version_lag = max_version_lag
+        self.useragents = None
+        self.weights = None
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if not self.path:
+            return load_bundled_useragents()
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _select(self, entries, version):
+        firefox = [entry for entry in entries if FIREFOX_VERSION.search(entry.get("useragent", ""))]
+        if version is None:
+            return firefox
+        matching = [
+            entry
+            for entry in firefox
+            if version - self.max_version_lag <= int(FIREFOX_VERSION.search(entry["useragent"]).group(1)) <= version
+        ]
+        if matching:
+            return matching
+        logger.info(f"No user agent of Firefox {version} in the catalogue, adapting the others to it")
+        return [{**entry, "useragent": retarget(entry["useragent"], version)} for entry in firefox]
+
+    def load(self):
+        with self._lock:
+            if self.useragents is not None:
+                return
+            version = get_installed_firefox_version(self.firefox_binary)
+            entries = self._select(self._read(), version)
+            if not entries:
+                raise ValueError(f"No Firefox user agents in the catalogue {self.path or 'of fake_useragent'}")
+            self.weights = [entry.get("percent") or 1 for entry in entries]
+            self.useragents = [entry["useragent"] for entry in entries]
+            logger.info(f"Loaded {len(self.useragents)} user agent(s) for Firefox {version or 'of any version'}")
+
+    def random(self):
+        if self.useragents is None:
+            self.load()
+        return random.choices(self.useragents, weights=self.weights)[0]
@@ -4,6 +4,8 @@ import os
 import json
 from unittest.mock import Mock, AsyncMock, patch
 import asyncio
+import datetime
+import time
 from bot.rabbitmq import RabbitMQ
 
 os.environ["RUN_MODE"] = "TEST"
@@ -286,3 +288,120 @@ def test_enforce_rate_limit():
 #    mock_rabbit.db.get_application_status = AsyncMock(return_value="test_status")
 #    await mock_rabbit.on_message(mock_msg)
 #    mock_rabbit.bot.updater.bot.send_message.assert_not_called()
+
+
+def test_publish_batch_message_skips_published_requests():
+    rabbit = RabbitMQ("host", "user", "password", Mock(), Mock(), 3600, Mock(), None)
+    rabbit.default_exchange = AsyncMock()
+    requests = [
+        {
+            "chat_id": chat_id,
+            "number": "12345",
+            "suffix": "0",
+            "type": "DP",
+            "year": 2023,
+            "request_type": "refresh",
+            "last_updated": "0",
+        }
+        for chat_id in (1, 2)
+    ]
+    rabbit.mark_message_as_published(rabbit.generate_unique_id(requests[0]))
+
+    asyncio.run(rabbit.publish_batch_message(requests))
+
+    message = rabbit.default_exchange.publish.await_args.args[0]
+    body = json.loads(message.body.decode("utf-8"))
+    assert body == {"request_type": "refresh", "batch": [requests[1]]}
+    assert rabbit.is_message_published(rabbit.generate_unique_id(requests[1]))
+
+
+def test_sharded_publish_routes_by_application():
+    rabbit = RabbitMQ("host", "user", "password", Mock(), Mock(), 3600, Mock(), None, sharded=True)
+    rabbit.default_exchange = AsyncMock()
+    rabbit.sharded_exchanges = {"RefreshStatusQueue": AsyncMock()}
+    requests = [
+        {
+            "chat_id": chat_id,
+            "number": number,
+            "suffix": "0",
+            "type": "dp",
+            "year": 2023,
+            "request_type": "refresh",
+            "last_updated": "0",
+        }
+        for chat_id, number in ((1, "12345"), (2, "54321"))
+    ]
+
+    asyncio.run(rabbit.publish_batch_message(requests))
+
+    exchange = rabbit.sharded_exchanges["RefreshStatusQueue"]
+    routing_keys = [call.kwargs["routing_key"] for call in exchange.publish.await_args_list]
+    assert routing_keys == ["12345/DP-2023", "54321/DP-2023"]
+    rabbit.default_exchange.publish.assert_not_awaited()
+
+
+def test_publish_message_sets_deadline():
+    rabbit = RabbitMQ(
+        "host", "user", "password", Mock(), Mock(), 3600, Mock(), None, request_deadlines={"refresh": 600}
+    )
+    rabbit.default_exchange = AsyncMock()
+    request = {
+        "chat_id": 1,
+        "number": "12345",
+        "suffix": "0",
+        "type": "DP",
+        "year": 2023,
+        "request_type": "refresh",
+        "last_updated": "0",
+    }
+
+    asyncio.run(rabbit.publish_message(request, routing_key="RefreshStatusQueue"))
+
+    body = json.loads(rabbit.default_exchange.publish.await_args.args[0].body.decode("utf-8"))
+    assert 590 < body["deadline"] - time.time() <= 600
+
+
+@pytest.mark.parametrize(
+    "requested_at, outdated",
+    [("2023-10-01T10:00:00", True), ("2023-10-01T12:00:00", False), ("0", False)],
+)
+def test_status_update_outdated_by_newer_db_update(requested_at, outdated):
+    db = Mock()
+    db.fetch_application_last_updated = AsyncMock(return_value=datetime.datetime(2023, 10, 1, 11, 0))
+    rabbit = RabbitMQ("host", "user", "password", Mock(), db, 3600, Mock(), None)
+    update = {
+        "chat_id": 1,
+        "number": "12345",
+        "type": "DP",
+        "year": "2023",
+        "request_type": "refresh",
+        "last_updated": requested_at,
+    }
+
+    assert asyncio.run(rabbit.is_update_outdated(update)) == outdated
+
+
+@pytest.mark.parametrize(
+    "request_details",
+    [
+        {"request_type": "fetch", "force_refresh": True, "is_reminder": True},
+        {"request_type": "fetch"},
+        {"request_type": "refresh", "force_refresh": True},
+    ],
+)
+def test_reminder_update_is_not_outdated_by_refresh(request_details):
+    db = Mock()
+    # a scheduled refresh finished first and bumped last_updated
+    db.fetch_application_last_updated = AsyncMock(return_value=datetime.datetime(2023, 10, 1, 11, 0))
+    rabbit = RabbitMQ("host", "user", "password", Mock(), db, 3600, Mock(), None)
+    update = {
+        "chat_id": 1,
+        "number": "12345",
+        "type": "DP",
+        "year": "2023",
+        "last_updated": "2023-10-01T10:00:00",
+        **request_details,
+    }
+
+    assert not asyncio.run(rabbit.is_update_outdated(update))
+    db.fetch_application_last_updated.assert_not_awaited()
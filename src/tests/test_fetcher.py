@@ -0,0 +1,1449 @@
+import asyncio
+import json
+import os
+import zipfile
+import threading
+import time
+from unittest.mock import Mock, AsyncMock
+
+import pytest
+from aiohttp import web
+from aiormq.exceptions import PublishError
+from pamqp.commands import Basic
+from selenium.common.exceptions import TimeoutException
+
+from fetcher.application_processor import ApplicationProcessor
+from fetcher.backends import HttpBackend
+from fetcher.browser import Browser, SharedDisplay, CaptchaRejectedError, SiteResponseError
+from fetcher.browser_profile import ProfileTemplate
+from fetcher.captcha_throttle import CaptchaThrottle
+from fetcher.browser_lifecycle import RecyclePolicy, process_tree_rss, FETCHES, AGE, MEMORY
+from fetcher.browser_pool import BrowserPool, INTERACTIVE, BACKGROUND
+from fetcher.fingerprints import FingerprintManager
+from fetcher.cookie_store import CookieStore
+from fetcher.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from fetcher.concurrency import ConcurrencyController
+from fetcher.messaging import Messaging
+from fetcher.metrics_collector import MetricsCollector
+from fetcher.rate_limiter import LocalTokenBucket, RabbitTokenBucket
+from fetcher.resource_blocker import ResourceBlocker
+from fetcher.retry_policy import RetryPolicy, PERMANENT, TRANSIENT, CAPTCHA
+from fetcher.status_cache import StatusCache
+from fetcher.useragents import UserAgentCatalogue
+
+
+def make_browser(result="OAM-12345 status", executor=None):
+    browser = Mock()
+    browser.fetch = AsyncMock(return_value=result)
+    browser.aclose = AsyncMock()
+    browser.stats = {
+        "page_loads": 0,
+        "page_reuses": 0,
+        "cold_starts": 0,
+        "warm_starts": 0,
+        "cold_start_seconds": 0.0,
+        "warm_start_seconds": 0.0,
+        "blocked_requests": 0,
+        "transferred_bytes": 0,
+    }
+    return browser
+
+
+def test_browser_pool_runs_leases_in_parallel():
+    async def run_test():
+        pool = BrowserPool(size=2, browser_factory=make_browser)
+        first = await pool.acquire()
+        second = await pool.acquire()
+        assert first is not second
+        assert pool.get_stats()["busy"] == 2
+        await pool.release(first)
+        await pool.release(second)
+        assert pool.get_stats()["busy"] == 0
+
+    asyncio.run(run_test())
+
+
+def test_browser_pool_serves_waiters_in_order():
+    async def run_test():
+        pool = BrowserPool(size=1, browser_factory=make_browser)
+        order = []
+
+        async def worker(name):
+            async with pool.lease():
+                order.append(name)
+                await asyncio.sleep(0)
+
+        async with pool.lease():
+            tasks = [asyncio.create_task(worker(name)) for name in ("a", "b", "c")]
+            await asyncio.sleep(0)
+            assert pool.get_stats()["waiting"]["interactive"] == 3
+        await asyncio.gather(*tasks)
+        assert order == ["a", "b", "c"]
+
+    asyncio.run(run_test())
+
+
+def test_browser_pool_prefers_interactive_lane_with_starvation_guard():
+    async def run_test():
+        pool = BrowserPool(size=1, browser_factory=make_browser, starvation_limit=2)
+        order = []
+
+        async def worker(name, priority):
+            async with pool.lease(priority):
+                order.append(name)
+
+        async with pool.lease():
+            tasks = [asyncio.create_task(worker(f"bg{i}", BACKGROUND)) for i in range(2)]
+            tasks += [asyncio.create_task(worker(f"ui{i}", INTERACTIVE)) for i in range(4)]
+            await asyncio.sleep(0)
+            assert pool.get_stats()["waiting"] == {INTERACTIVE: 4, BACKGROUND: 2}
+        await asyncio.gather(*tasks)
+        assert order == ["ui0", "ui1", "bg0", "ui2", "ui3", "bg1"]
+
+    asyncio.run(run_test())
+
+
+def test_browser_pool_cancelled_waiter_does_not_leak_slot():
+    async def run_test():
+        pool = BrowserPool(size=1, browser_factory=make_browser)
+        slot = await pool.acquire()
+        waiter = asyncio.create_task(pool.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await pool.release(slot)
+        assert await asyncio.wait_for(pool.acquire(), timeout=1) is slot
+
+    asyncio.run(run_test())
+
+
+def test_browser_pool_limit_caps_leases():
+    async def run_test():
+        pool = BrowserPool(size=3, browser_factory=make_browser)
+        assert pool.set_limit(1) == 1
+        first = await pool.acquire()
+        waiter = asyncio.create_task(pool.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        # raising the limit serves the waiter from the idle slots
+        pool.set_limit(2)
+        second = await asyncio.wait_for(waiter, timeout=1)
+        assert second is not first
+        assert pool.get_stats()["busy"] == 2
+        assert pool.set_limit(10) == 3
+
+    asyncio.run(run_test())
+
+
+def make_controller(pool, successes=0, failures=0, latency=1.0):
+    metrics = MetricsCollector("fetcher", Mock(), "url")
+    now = time.time()
+    metrics.fetch_status["success"].extend([now] * successes)
+    metrics.fetch_status["failed"].extend([now] * failures)
+    metrics.record_latency(latency)
+    messaging = Mock(set_prefetch=AsyncMock())
+    controller = ConcurrencyController(pool, metrics, messaging, prefetch={"Queue": 12}, min_limit=1)
+    controller.last_check = now - 1
+    return controller
+
+
+@pytest.mark.parametrize(
+    "successes, failures, latency, limit",
+    [(10, 0, 1.0, 3), (10, 0, 10.0, 1), (5, 5, 1.0, 1), (0, 0, 1.0, 2)],
+)
+def test_concurrency_controller_adjusts_limit(successes, failures, latency, limit):
+    async def run_test():
+        pool = BrowserPool(size=4, browser_factory=make_browser)
+        pool.set_limit(2)
+        controller = make_controller(pool, successes, failures, latency)
+
+        await controller.adjust()
+
+        assert pool.limit == limit
+        if limit != 2:
+            controller.messaging.set_prefetch.assert_awaited_once_with("Queue", 12 * limit // 4)
+        else:
+            controller.messaging.set_prefetch.assert_not_awaited()
+
+    asyncio.run(run_test())
+
+
+def test_browser_pool_restarts_unhealthy_slot():
+    async def run_test():
+        pool = BrowserPool(size=1, browser_factory=lambda executor: make_browser(result=None), max_failures=2)
+        for _ in range(2):
+            async with pool.lease() as slot:
+                assert await slot.fetch("url", {"number": "12345"}) is None
+        slot.browser.aclose.assert_awaited_once()
+        assert slot.healthy
+        assert pool.get_stats()["restarts"] == 1
+
+    asyncio.run(run_test())
+
+
+def test_browser_pool_recycles_browser_with_prelaunched_replacement():
+    async def run_test():
+        browsers = []
+
+        def browser_factory(executor=None):
+            browsers.append(make_browser())
+            browsers[-1].stats["page_loads"] = 10
+            return browsers[-1]
+
+        policy = Mock(max_rss_mb=0)
+        policy.reason.side_effect = [FETCHES, None]
+        pool = BrowserPool(size=1, browser_factory=browser_factory, recycle_policy=policy)
+        async with pool.lease() as slot:
+            pass
+        # the replacement is launched while the old browser keeps serving
+        await asyncio.sleep(0.05)
+        browsers[1].start.assert_called_once()
+        assert slot.browser is browsers[0]
+
+        async with pool.lease() as slot:
+            assert slot.browser is browsers[0]
+        assert slot.browser is browsers[1]
+        await asyncio.sleep(0)
+        browsers[0].aclose.assert_awaited_once()
+        stats = pool.get_stats()
+        assert stats["recycles"] == 1 and stats["recycle_reasons"] == {FETCHES: 1}
+        # the figures of the retired browser still count
+        assert stats["page_loads"] == 20
+        pool.close()
+
+    asyncio.run(run_test())
+
+
+def test_browser_pool_replacement_runs_next_to_the_retired_session(tmp_path, monkeypatch):
+    sessions = []
+
+    class FakeFirefox:
+        """A session on a geckodriver of its own, open until quit"""
+
+        def __init__(self, options, service_log_path):
+            self.open = True
+            self.capabilities = {}
+            sessions.append(self)
+
+        def quit(self):
+            self.open = False
+
+        def execute_script(self, script):
+            pass
+
+    monkeypatch.setattr("fetcher.browser.webdriver.Firefox", FakeFirefox)
+    monkeypatch.setattr("fetcher.browser.useragent_catalogue", Mock(random=Mock(return_value="ua")))
+    monkeypatch.setattr("fetcher.browser.cookie_store", CookieStore(str(tmp_path)))
+    monkeypatch.setattr("fetcher.browser.BROWSER_DISPLAY_MODE", "headless")
+    monkeypatch.setattr("fetcher.browser.PROFILE_TEMPLATE", False)
+    monkeypatch.setattr("fetcher.browser.RESOURCE_BLOCKING", False)
+
+    async def run_test():
+        policy = Mock(max_rss_mb=0)
+        policy.reason.side_effect = [FETCHES, None]
+        pool = BrowserPool(size=1, recycle_policy=policy)
+        await pool.slots[0].browser._run_blocking(pool.slots[0].browser.start)
+        async with pool.lease():
+            pass
+        await asyncio.sleep(0.05)
+        # the replacement is up while the retired session still serves
+        assert len(sessions) == 2 and all(session.open for session in sessions)
+
+        async with pool.lease() as slot:
+            assert slot.browser.browser is sessions[0]
+        assert slot.browser.browser is sessions[1]
+        await asyncio.sleep(0.05)
+        assert not sessions[0].open and sessions[1].open
+        pool.close()
+
+    asyncio.run(run_test())
+
+
+def test_browser_pool_checks_memory_off_the_event_loop():
+    async def run_test():
+        browsers = []
+        rss_threads = []
+
+        def browser_factory(executor=None):
+            browsers.append(make_browser())
+            browsers[-1].started_at = time.monotonic()
+            browsers[-1].session_fetches = 1
+
+            def get_rss():
+                rss_threads.append(threading.current_thread().name)
+                return 600 * 1024 * 1024
+
+            browsers[-1].get_rss = get_rss
+            return browsers[-1]
+
+        policy = RecyclePolicy(max_fetches=200, max_age=3600, max_rss_mb=500, memory_check_interval=60)
+        pool = BrowserPool(size=1, browser_factory=browser_factory, recycle_policy=policy)
+        async with pool.lease():
+            pass
+        await asyncio.sleep(0.05)
+        assert rss_threads and all(name.startswith("browser-launch") for name in rss_threads)
+        browsers[1].start.assert_called_once()
+
+        async with pool.lease() as slot:
+            pass
+        assert slot.browser is browsers[1]
+        assert pool.get_stats()["recycle_reasons"] == {MEMORY: 1}
+        # the memory of the same slot isn't read again before the interval is over
+        async with pool.lease():
+            pass
+        await asyncio.sleep(0.05)
+        assert len(rss_threads) == 1
+        pool.close()
+
+    asyncio.run(run_test())
+
+
+@pytest.mark.parametrize(
+    "fetches, age, rss_mb, reason",
+    [(5, 10, 100, None), (200, 10, 100, FETCHES), (5, 4000, 100, AGE), (5, 10, 600, MEMORY)],
+)
+def test_recycle_policy_reasons(fetches, age, rss_mb, reason):
+    browser = Mock(session_fetches=fetches, started_at=time.monotonic() - age)
+    browser.get_rss.return_value = rss_mb * 1024 * 1024
+    policy = RecyclePolicy(max_fetches=200, max_age=3600, max_rss_mb=500)
+    assert (policy.reason(browser) or policy.memory_reason(browser)) == reason
+    # the memory is read apart from the cheap checks, they don't block on /proc
+    assert policy.reason(browser) != MEMORY
+    # a browser which hasn't started yet has nothing to recycle
+    browser.started_at = None
+    assert RecyclePolicy().reason(browser) is None and RecyclePolicy().memory_reason(browser) is None
+
+
+def test_process_tree_rss_counts_children():
+    own = process_tree_rss(os.getpid())
+    assert own and own > 0
+    assert process_tree_rss(2**22 + 1) is None
+
+
+def test_browser_blocking_work_is_cancellable():
+    async def run_test():
+        browser = Browser()
+        started = threading.Event()
+
+        def blocking_work():
+            started.set()
+            while True:
+                browser.random_sleep(0.01, 0.01)
+
+        task = asyncio.create_task(browser._run_blocking(blocking_work))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        # the event loop stays responsive while the browser thread is busy
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(task, timeout=5)
+        browser.executor.shutdown()
+
+    asyncio.run(run_test())
+
+
+def test_shared_display_runs_while_browsers_use_it(monkeypatch):
+    displays = []
+    monkeypatch.setattr("fetcher.browser.Display", lambda **kwargs: displays.append(Mock()) or displays[-1])
+    shared = SharedDisplay()
+
+    first = shared.acquire((1920, 1080))
+    second = shared.acquire((1366, 768))
+    # the second browser joins the display of the first one
+    assert first is second and len(displays) == 1
+    shared.release()
+    displays[0].stop.assert_not_called()
+    shared.release()
+    displays[0].stop.assert_called_once()
+    assert shared.display is None
+
+
+def test_profile_template_is_built_once_and_cloned(tmp_path):
+    template = ProfileTemplate(str(tmp_path))
+    warm_ups = []
+
+    def warm_up(path):
+        warm_ups.append(path)
+        (tmp_path / path / "cookies.sqlite").write_text("consent")
+        (tmp_path / path / "storage").mkdir()
+        (tmp_path / path / "cache2").mkdir()
+        (tmp_path / path / "lock").write_text("")
+
+    template.build(warm_up)
+    template.build(warm_up)
+    assert len(warm_ups) == 1 and template.ready
+
+    first, second = template.clone(), template.clone()
+    assert first != second
+    for clone in (first, second):
+        assert (tmp_path / clone / "cache2").is_dir()
+        # cookies and storage of the warm-up session would be shared by every fingerprint
+        assert not (tmp_path / clone / "cookies.sqlite").exists()
+        assert not (tmp_path / clone / "storage").exists()
+        # the lock of the warm-up session isn't copied
+        assert not (tmp_path / clone / "lock").exists()
+    ProfileTemplate.remove(first)
+    assert not os.path.exists(first)
+
+
+def test_profile_template_failed_build_is_retried_later(tmp_path):
+    template = ProfileTemplate(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        template.build(Mock(side_effect=RuntimeError("Firefox crashed")))
+    assert not template.ready and not os.listdir(tmp_path)
+    # the site is likely still failing, the next browsers don't pay for another warm-up
+    warm_up = Mock()
+    template.build(warm_up)
+    warm_up.assert_not_called()
+    assert not template.ready
+
+    template.failed_at -= template.retry_interval
+    template.build(warm_up)
+    assert template.ready
+
+
+def test_browser_starts_warm_from_profile_template(tmp_path, monkeypatch):
+    firefox = Mock()
+    firefox.return_value.find_elements_by_xpath.return_value = []
+    monkeypatch.setattr("fetcher.browser.webdriver.Firefox", firefox)
+    browser = Browser()
+    browser.app_details = {"number": "12345"}
+    browser.profile_template = ProfileTemplate(str(tmp_path))
+
+    browser._start_firefox((1420, 1080))
+    # the template is warmed up by a cold session, the browser itself runs on a copy of it
+    assert browser.stats["cold_starts"] == 1 and browser.stats["warm_starts"] == 1
+    assert firefox.call_count == 2
+    options = firefox.call_args.kwargs["options"]
+    assert options.arguments[-2:] == ["-profile", browser.profile_dir]
+    assert browser.profile_dir != browser.profile_template.path
+
+    browser.close()
+    assert not os.path.exists(options.arguments[-1])
+    browser.executor.shutdown()
+
+
+def test_browser_cold_start_runs_its_own_geckodriver(monkeypatch):
+    firefox = Mock()
+    monkeypatch.setattr("fetcher.browser.webdriver.Firefox", firefox)
+    browser = Browser()
+    browser.profile_template = None
+
+    browser._start_firefox((1420, 1080))
+    assert browser.browser is firefox.return_value
+    assert browser.stats["cold_starts"] == 1
+    # geckodriver doesn't leave its log in the working directory
+    assert firefox.call_args.kwargs["service_log_path"] == os.devnull
+    browser.executor.shutdown()
+
+
+def test_resource_blocker_is_packed_with_its_config():
+    blocker = ResourceBlocker("https://frs.gov.cz/informace-o-stavu-rizeni/", ["image", "font"], ["gstatic.com"])
+    driver = Mock()
+    blocker.install(driver)
+    blocker.install(driver)
+
+    path = driver.execute.call_args.args[1]["path"]
+    assert driver.execute.call_args.args == ("INSTALL_ADDON", {"path": path, "temporary": True})
+    # the extension is packed only once per process
+    assert blocker.pack() == path
+    with zipfile.ZipFile(path) as xpi:
+        assert {"manifest.json", "background.js", "content.js"} <= set(xpi.namelist())
+        assert json.loads(xpi.read("config.json")) == {
+            "siteHosts": ["frs.gov.cz"],
+            "blockedTypes": ["image", "font"],
+            "allowedHosts": ["gstatic.com"],
+        }
+    os.remove(path)
+
+
+def test_browser_counts_traffic_per_fetch():
+    browser = Browser()
+    browser.app_details = {"number": "12345"}
+    browser.browser = Mock()
+    browser.resource_blocker = Mock()
+    # a page load, a reuse of the page and a second page load in the same session
+    browser.browser.execute_script.side_effect = [300_000, 320_000, 250_000]
+    browser.resource_blocker.blocked_requests.side_effect = [40, 42, 80]
+
+    browser._record_traffic()
+    browser._record_traffic()
+    browser.counted_bytes = 0
+    browser._record_traffic()
+    assert browser.stats["transferred_bytes"] == 300_000 + 20_000 + 250_000
+    assert browser.stats["blocked_requests"] == 80
+    browser.executor.shutdown()
+
+
+def make_capturing_browser(*events):
+    """Browser whose page reports the given status capture events after every submission"""
+    browser = Browser()
+    browser.app_details = {"number": "12345"}
+    browser.browser = Mock()
+    browser.browser.execute_script.return_value = 0
+    browser.browser.execute_async_script.side_effect = list(events)
+    browser._submit_form = Mock()
+    browser.save_cookies = Mock()
+    browser.random_sleep = Mock()
+    browser._current_status_html = Mock(return_value=None)
+    return browser
+
+
+def test_browser_reads_status_from_captured_alert():
+    browser = make_capturing_browser({"kind": "request"}, {"kind": "alert", "html": "<b>OAM-12345</b> status"})
+
+    assert browser._read_status("url", browser.app_details) == "<b>OAM-12345</b> status"
+    browser._submit_form.assert_called_once()
+    # waiting for the submission and then for the status, with no polling of the DOM in between
+    assert browser.browser.execute_async_script.call_count == 2
+    assert browser.browser.execute_async_script.call_args.args[2] == ["alert", "rejected", "http_error"]
+    browser.executor.shutdown()
+
+
+def test_browser_resubmits_only_when_nothing_was_sent():
+    browser = make_capturing_browser(None, {"kind": "request"}, {"kind": "alert", "html": "status"})
+
+    assert browser._read_status("url", browser.app_details) == "status"
+    assert browser._submit_form.call_count == 2
+    browser.executor.shutdown()
+
+
+def test_browser_stops_on_rejected_captcha():
+    browser = make_capturing_browser(
+        {"kind": "request"}, {"kind": "rejected", "status": 400, "body": "Recaptcha verification failed"}
+    )
+
+    with pytest.raises(CaptchaRejectedError):
+        browser._read_status("url", browser.app_details)
+    browser._submit_form.assert_called_once()
+    browser.executor.shutdown()
+
+
+def test_browser_tells_site_errors_from_captcha():
+    browser = make_capturing_browser({"kind": "request"}, {"kind": "http_error", "status": 502, "body": "Bad Gateway"})
+
+    with pytest.raises(SiteResponseError):
+        browser._read_status("url", browser.app_details)
+    # the captcha marker is handed over to the page hooks
+    assert browser.browser.execute_script.call_args.args[1] == "Recaptcha verification failed"
+    browser.executor.shutdown()
+
+
+@pytest.mark.parametrize(
+    "error, kind, captchas",
+    [
+        (CaptchaRejectedError("Recaptcha verification failed"), CAPTCHA, 1),
+        (SiteResponseError("HTTP 503"), TRANSIENT, 0),
+    ],
+)
+def test_browser_throttles_only_verified_captcha(error, kind, captchas):
+    throttle = CaptchaThrottle()
+    browser = Browser(captcha_throttle=throttle)
+    browser.browser = Mock()
+    browser.useragent = "ua"
+    browser._load_form_page = Mock()
+    browser._read_status = Mock(side_effect=error)
+    browser._save_page_source = Mock()
+    retry_policy = RetryPolicy(3, time.time() + 60)
+
+    assert browser._fetch_with_browser("url", {"number": "12345"}, reuse_page=False, retry_policy=retry_policy) is None
+    assert retry_policy.last_error == kind
+    assert throttle.captchas == captchas and throttle.is_slowed_down() == bool(captchas)
+    browser.executor.shutdown()
+
+
+def test_captcha_throttle_cools_down_fingerprint_and_slows_down():
+    async def run_test():
+        throttle = CaptchaThrottle(cooldown_seconds=10, max_cooldown_seconds=30, slowdown_seconds=0.05)
+        throttle.record_captcha("ua-1")
+        assert throttle.is_cooling("ua-1") and not throttle.is_cooling("ua-2")
+        throttle.record_captcha("ua-1")
+        throttle.record_captcha("ua-1")
+        # the cooldown doubles with every rejection of the fingerprint up to the max
+        assert throttle.cooldowns["ua-1"][1] - time.monotonic() == pytest.approx(30, abs=1)
+        assert throttle.spacing == pytest.approx(0.2)
+
+        throttle.spacing = 0.05
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.gather(*(throttle.wait() for _ in range(3)))
+        # fetch attempts of all browsers are spaced apart
+        assert loop.time() - started >= 0.09
+
+        throttle.record_success("ua-1")
+        throttle.slow_until = 0
+        assert not throttle.is_cooling("ua-1")
+        await throttle.wait()
+        assert throttle.get_stats() == {"captchas": 3, "cooling_fingerprints": 0, "spacing": 0}
+
+    asyncio.run(run_test())
+
+
+def test_captcha_throttle_is_safe_across_threads():
+    throttle = CaptchaThrottle()
+
+    def record(worker):
+        for i in range(2000):
+            throttle.record_captcha(f"ua-{worker}-{i}")
+            throttle.record_success(f"ua-{worker}-{i - 1}")
+
+    workers = [threading.Thread(target=record, args=(worker,)) for worker in range(4)]
+    for worker in workers:
+        worker.start()
+    # the stats are read on the event loop while the browser threads record outcomes
+    while any(worker.is_alive() for worker in workers):
+        throttle.get_stats()
+    for worker in workers:
+        worker.join()
+    assert throttle.get_stats()["captchas"] == 8000
+
+
+def test_browser_avoids_cooling_useragents(monkeypatch):
+    catalogue = Mock(random=Mock(side_effect=["burned", "burned", "fresh"]))
+    monkeypatch.setattr("fetcher.browser.useragent_catalogue", catalogue)
+    throttle = CaptchaThrottle()
+    browser = Browser(captcha_throttle=throttle)
+    browser.app_details = {"number": "12345"}
+    throttle.record_captcha(browser._hash_useragent("burned"))
+
+    browser._set_useragent()
+    assert browser.useragent == "fresh"
+    browser.executor.shutdown()
+
+
+def test_fingerprint_manager_prefers_working_fingerprints(tmp_path):
+    store = str(tmp_path / "fingerprints.json")
+    manager = FingerprintManager(store, new_useragent=Mock(return_value="new"), max_fingerprints=2, retire_after=3)
+    for _ in range(20):
+        manager.record("good", "good-ua", True, latency=5)
+        manager.record("bad", "bad-ua", False)
+
+    # the bad one failed too often in a row, the pool is full with the retired one gone, so new ones are tried
+    assert manager.fingerprints["bad"].retired
+    choices = [manager.choose(str, lambda key: key != "new") for _ in range(50)]
+    assert choices.count("good-ua") == 50
+    # a cooling fingerprint is skipped
+    assert manager.choose(str, lambda key: False) == "new"
+
+    manager.close()
+    restored = FingerprintManager(store, new_useragent=Mock())
+    assert restored.fingerprints["good"].successes == 20
+    assert restored.get_stats() == {"active": 1, "retired": 1, "success_rate": 1.0}
+
+
+def test_fingerprint_manager_forgets_retired_fingerprints(tmp_path):
+    store = str(tmp_path / "fingerprints.json")
+    with open(store, "w") as f:
+        # a store written before the retirement time was kept
+        json.dump({"old": ["old-ua", 0, 5, 5, 0, True]}, f)
+    manager = FingerprintManager(store, new_useragent=Mock(), retire_after=1, retired_ttl=60)
+    assert manager.fingerprints["old"].retired_at == pytest.approx(time.time(), abs=5)
+
+    manager.record("bad", "bad-ua", False)
+    manager.fingerprints["old"].retired_at -= 120
+    manager.save()
+
+    restored = FingerprintManager(store, new_useragent=Mock(), retired_ttl=60)
+    assert list(restored.fingerprints) == ["bad"] and restored.fingerprints["bad"].retired
+
+
+def test_fingerprint_manager_stats_are_safe_across_threads(tmp_path):
+    manager = FingerprintManager(str(tmp_path / "fingerprints.json"), new_useragent=Mock(), save_interval=3600)
+
+    def record(worker):
+        for i in range(2000):
+            manager.record(f"{worker}-{i}", "ua", True)
+
+    workers = [threading.Thread(target=record, args=(worker,)) for worker in range(4)]
+    for worker in workers:
+        worker.start()
+    # the stats are read on the event loop while the browser threads record outcomes
+    while any(worker.is_alive() for worker in workers):
+        manager.get_stats()
+    for worker in workers:
+        worker.join()
+    assert manager.get_stats() == {"active": 8000, "retired": 0, "success_rate": 1.0}
+
+
+def test_browser_feeds_fetch_outcome_to_fingerprints(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("fetcher.browser.cookie_store", CookieStore("cookies"))
+    fingerprints = Mock()
+    fingerprints.record.return_value = True
+    browser = Browser(fingerprints=fingerprints)
+    browser.app_details = {"number": "12345"}
+    browser.browser = Mock()
+    browser.useragent = "ua"
+    browser._can_reuse_page = Mock(return_value=True)
+    browser._reset_form = Mock()
+    browser._read_status = Mock(side_effect=TimeoutException("no status"))
+    browser._save_page_source = Mock()
+    os.makedirs("cookies")
+    open(f"cookies/{browser._get_ua_hash()}.json", "w").close()
+
+    # a timeout or an outage of the site isn't the fingerprint's fault
+    assert browser._fetch_with_browser("url", {"number": "12345"}, reuse_page=True) is None
+    fingerprints.record.assert_not_called()
+
+    browser.browser = Mock()
+    browser._read_status = Mock(side_effect=CaptchaRejectedError("Recaptcha verification failed"))
+    assert browser._fetch_with_browser("url", {"number": "12345"}, reuse_page=True) is None
+    assert fingerprints.record.call_args.args == (browser._get_ua_hash(), "ua", False, None)
+    # the retired fingerprint takes its cookies along
+    assert not os.path.exists(f"cookies/{browser._get_ua_hash()}.json")
+    browser.executor.shutdown()
+
+
+def write_catalogue(path, *useragents):
+    with open(path, "w") as f:
+        for useragent in useragents:
+            f.write(json.dumps({"percent": 1.0, "useragent": useragent}) + "\n")
+    return str(path)
+
+
+def test_useragent_catalogue_matches_installed_firefox(tmp_path, monkeypatch):
+    monkeypatch.setattr("fetcher.useragents.get_installed_firefox_version", Mock(return_value=115))
+    path = write_catalogue(
+        tmp_path / "useragents.json",
+        "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/113.0",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:102.0) Gecko/20100101 Firefox/102.0",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/114.0.0.0 Safari/537.36",
+    )
+    catalogue = UserAgentCatalogue(path, max_version_lag=2)
+
+    sampled = {catalogue.random() for _ in range(50)}
+    assert sampled == {
+        "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/113.0",
+    }
+    # the file is read only once
+    os.remove(path)
+    catalogue.random()
+
+
+def test_useragent_catalogue_adapts_to_newer_firefox(tmp_path, monkeypatch):
+    monkeypatch.setattr("fetcher.useragents.get_installed_firefox_version", Mock(return_value=128))
+    path = write_catalogue(
+        tmp_path / "useragents.json", "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0"
+    )
+
+    assert UserAgentCatalogue(path).random() == "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0"
+
+
+def test_cookie_store_writes_behind_atomically(tmp_path):
+    store = CookieStore(str(tmp_path), flush_interval=0)
+    store.put("ua", [{"name": "consent", "value": "1"}])
+    # saved cookies are served from memory before they reach the disk
+    assert store.get("ua") == [{"name": "consent", "value": "1"}]
+    assert not os.listdir(tmp_path)
+
+    store.flush()
+    assert os.listdir(tmp_path) == ["ua.json"]
+    assert CookieStore(str(tmp_path)).get("ua") == [{"name": "consent", "value": "1"}]
+    store.remove("ua")
+    assert store.get("ua") is None and not os.listdir(tmp_path)
+
+
+def test_cookie_store_picks_up_jars_of_other_fetchers(tmp_path):
+    first, second = CookieStore(str(tmp_path), shared=True), CookieStore(str(tmp_path), shared=True)
+    first.put("ua", [{"name": "session", "value": "a"}])
+    first.flush()
+    assert second.get("ua") == [{"name": "session", "value": "a"}]
+
+    first.put("ua", [{"name": "session", "value": "b"}])
+    first.flush()
+    os.utime(tmp_path / "ua.json", (time.time() + 5, time.time() + 5))
+    assert second.get("ua") == [{"name": "session", "value": "b"}]
+    assert second.get_stats()["reads"] == 2
+
+
+def test_local_token_bucket_paces_requests():
+    async def run_test():
+        bucket = LocalTokenBucket(rate=20, burst=2)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for _ in range(4):
+            await bucket.acquire()
+        # the burst goes through at once, the rest is paced at the rate
+        assert loop.time() - started >= 0.09
+        assert bucket.get_stats()["granted"] == 4
+        with pytest.raises(ValueError):
+            bucket.set_rate(0)
+
+    asyncio.run(run_test())
+
+
+def test_browser_takes_budget_token_for_every_request_to_site():
+    async def run_test():
+        rate_limiter = Mock(acquire=AsyncMock())
+        # nothing is sent with the first submission, the form is submitted again
+        browser = make_capturing_browser(None, {"kind": "request"}, {"kind": "alert", "html": "status"})
+        browser.rate_limiter = rate_limiter
+
+        await browser._run_blocking(browser._read_status, "url", browser.app_details)
+        assert rate_limiter.acquire.await_count == 2
+
+        await browser._run_blocking(browser._load_form_page, "url")
+        assert rate_limiter.acquire.await_count == 3
+        browser.executor.shutdown()
+
+    asyncio.run(run_test())
+
+
+def test_browser_token_wait_is_cancellable():
+    async def run_test():
+        async def acquire():
+            await asyncio.sleep(10)
+
+        browser = Browser(rate_limiter=Mock(acquire=acquire))
+        task = asyncio.create_task(browser._run_blocking(browser._take_token))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(task, 2)
+        browser.executor.shutdown()
+
+    asyncio.run(run_test())
+
+
+def test_rabbit_token_bucket_reads_budget_without_consuming_it():
+    async def run_test():
+        budget = Mock(body=b'{"rate": 0.5}', nack=AsyncMock())
+        bucket = RabbitTokenBucket(Mock(), rate=2)
+        bucket.budget_queue = Mock(get=AsyncMock(return_value=budget))
+
+        await bucket._read_budget()
+
+        assert bucket.rate == 0.5
+        budget.nack.assert_awaited_once_with(requeue=True)
+
+    asyncio.run(run_test())
+
+
+async def start_status_server(handler):
+    app = web.Application()
+    app.router.add_post("/status", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/status"
+
+
+@pytest.mark.parametrize(
+    "response, served_over_http",
+    [
+        (web.json_response({"message": "Řízení OAM-12345/DP-2023 se zpracovává.<br>"}), True),
+        (web.Response(status=403, text="Recaptcha verification failed"), False),
+        (web.Response(status=500, text="oops"), False),
+        (web.json_response({"unexpected": "shape"}), False),
+    ],
+)
+def test_http_backend_falls_back_to_browser(response, served_over_http):
+    app_details = {"number": "12345", "suffix": "0", "type": "DP", "year": 2023}
+
+    async def run_test():
+        async def handler(request):
+            payload = await request.json()
+            assert payload["proceedings"]["referenceNumber"] == "12345"
+            return response
+
+        runner, endpoint = await start_status_server(handler)
+        fallback = Mock()
+        fallback.name = "selenium"
+        fallback.fetch = AsyncMock(return_value="browser status")
+        fallback.close = AsyncMock()
+        backend = HttpBackend(endpoint=endpoint, fallback=fallback)
+        retry_policy = RetryPolicy(3, time.time() + 60)
+        try:
+            status = await backend.fetch("url", app_details, retry_policy=retry_policy)
+        finally:
+            await backend.close()
+            await runner.cleanup()
+
+        if served_over_http:
+            assert status == "Řízení OAM-12345/DP-2023 se zpracovává.\n"
+            fallback.fetch.assert_not_awaited()
+            assert retry_policy.attempts == 2
+        else:
+            assert status == "browser status"
+            fallback.fetch.assert_awaited_once_with("url", app_details, retry_policy=retry_policy)
+            # the fallback spends the attempt of its own submission only
+            assert retry_policy.attempts == 3
+
+    asyncio.run(run_test())
+
+
+def test_http_backend_names_errors_without_message(caplog):
+    async def run_test():
+        fallback = Mock(fetch=AsyncMock(return_value="browser status"))
+        fallback.name = "selenium"
+        backend = HttpBackend(endpoint="http://127.0.0.1:1/status", fallback=fallback)
+        backend._request_status = AsyncMock(side_effect=asyncio.TimeoutError())
+
+        assert await backend.fetch("url", {"number": "12345"}) == "browser status"
+
+    asyncio.run(run_test())
+    assert "couldn't fetch status (TimeoutError)" in caplog.text
+
+
+def test_http_backend_leaves_batches_to_fallback():
+    async def run_test():
+        fallback = Mock()
+        fallback.fetch_batch = AsyncMock(return_value=["status 1", "status 2"])
+        backend = HttpBackend(endpoint="http://127.0.0.1:1/status", fallback=fallback)
+        batch = [{"number": "1"}, {"number": "2"}]
+
+        assert await backend.fetch_batch("url", batch) == ["status 1", "status 2"]
+        fallback.fetch_batch.assert_awaited_once_with("url", batch, retry_policies=None)
+        assert backend.get_stats()["fallback"] == 2
+
+    asyncio.run(run_test())
+
+
+def make_message(chat_id, number="12345", request_type="fetch", headers=None):
+    message = Mock()
+    message.headers = headers or {}
+    message.body = json.dumps(
+        {
+            "chat_id": chat_id,
+            "number": number,
+            "suffix": "0",
+            "type": "DP",
+            "year": 2023,
+            "force_refresh": False,
+            "failed": False,
+            "request_type": request_type,
+            "last_updated": "0",
+        }
+    ).encode("utf-8")
+    message.ack = AsyncMock()
+    return message
+
+
+def make_processor(backend, status_cache=None, circuit_breaker=None):
+    messaging = Mock()
+    messaging.publish_message = AsyncMock()
+    messaging.publish_delayed_message = AsyncMock()
+    messaging.pause_consumers = AsyncMock()
+    messaging.resume_consumers = AsyncMock()
+    metrics = Mock()
+    return ApplicationProcessor(
+        messaging=messaging,
+        backend=backend,
+        metrics=metrics,
+        url="url",
+        status_cache=status_cache,
+        circuit_breaker=circuit_breaker,
+    )
+
+
+def test_processor_shutdown_returns_to_caller():
+    async def run_test():
+        backend = Mock(close=AsyncMock())
+        processor = make_processor(backend)
+        processor.messaging.leave_shards = AsyncMock()
+        processor.messaging.close = AsyncMock()
+
+        # the caller still has stores to flush after it, the process exits there
+        await processor.shutdown()
+        processor.messaging.leave_shards.assert_awaited_once()
+        backend.close.assert_awaited_once()
+
+    asyncio.run(run_test())
+
+
+def test_processor_coalesces_identical_lookups():
+    async def run_test():
+        release_fetch = asyncio.Event()
+
+        async def slow_fetch(url, app_details, retry_policy=None):
+            await release_fetch.wait()
+            return "OAM-12345/DP-2023 status"
+
+        backend = Mock()
+        backend.fetch = AsyncMock(side_effect=slow_fetch)
+        processor = make_processor(backend)
+        messages = [make_message(chat_id) for chat_id in (1, 2, 3)]
+
+        tasks = [asyncio.create_task(processor.fetch_callback(message)) for message in messages]
+        await asyncio.sleep(0.01)
+        release_fetch.set()
+        await asyncio.gather(*tasks)
+
+        backend.fetch.assert_awaited_once()
+        published = [call.args for call in processor.messaging.publish_message.await_args_list]
+        assert sorted(body["chat_id"] for _, body in published) == [1, 2, 3]
+        assert all(queue == "StatusUpdateQueue" for queue, _ in published)
+        for message in messages:
+            message.ack.assert_awaited_once()
+        assert processor.processing_apps == {"fetch": {}, "refresh": {}}
+
+    asyncio.run(run_test())
+
+
+def test_processor_follower_keeps_its_retry_budget():
+    async def run_test():
+        release_fetch = asyncio.Event()
+
+        async def failing_fetch(url, app_details, retry_policy=None):
+            await release_fetch.wait()
+            return None
+
+        backend = Mock()
+        backend.fetch = AsyncMock(side_effect=failing_fetch)
+        processor = make_processor(backend)
+        deadline = time.time() + 600
+        leader = make_message(1)
+        follower = make_message(2, headers={"x-retry-count": 2, "x-attempts-left": 4, "x-retry-deadline": deadline})
+
+        tasks = [asyncio.create_task(processor.fetch_callback(message)) for message in (leader, follower)]
+        await asyncio.sleep(0.01)
+        release_fetch.set()
+        await asyncio.gather(*tasks)
+
+        rescheduled = {
+            call.args[1]["chat_id"]: call.kwargs["headers"]
+            for call in processor.messaging.publish_delayed_message.await_args_list
+        }
+        # the follower didn't fetch, it goes on with what was left of its budget instead of a full one
+        assert rescheduled[2] == {"x-retry-count": 3, "x-attempts-left": 4, "x-retry-deadline": deadline}
+        assert rescheduled[1]["x-attempts-left"] == 12
+
+    asyncio.run(run_test())
+
+
+def test_status_cache_freshness_and_eviction():
+    cache = StatusCache(maxsize=2, ttl={"fetch": 60, "refresh": 0})
+    first = {"number": "1", "suffix": "0", "type": "dp", "year": 2023}
+    second = {"number": "2", "suffix": "0", "type": "DP", "year": 2023}
+    third = {"number": "3", "suffix": "0", "type": "DP", "year": 2023}
+
+    cache.put(first, "status 1")
+    assert cache.get({**first, "type": "DP"}, "fetch") == "status 1"
+    # a refresh window of zero never considers the entry fresh
+    assert cache.get(first, "refresh") is None
+
+    cache.put(second, "status 2")
+    cache.get(first, "fetch")
+    cache.put(third, "status 3")
+    assert cache.get(second, "fetch") is None
+    assert cache.get(first, "fetch") == "status 1"
+    assert cache.get_stats() == {"size": 2, "hits": 3, "misses": 2}
+
+
+def test_processor_answers_from_status_cache():
+    async def run_test():
+        backend = Mock()
+        backend.fetch = AsyncMock(return_value="OAM-12345/DP-2023 status")
+        processor = make_processor(backend, StatusCache(maxsize=10, ttl={"fetch": 60}))
+
+        await processor.fetch_callback(make_message(1))
+        await processor.fetch_callback(make_message(2))
+
+        backend.fetch.assert_awaited_once()
+        assert processor.messaging.publish_message.await_count == 2
+        assert processor.status_cache.get_stats()["hits"] == 1
+
+    asyncio.run(run_test())
+
+
+def test_processor_publishes_batch_entries_individually():
+    async def run_test():
+        batch = [json.loads(make_message(chat_id, number, "refresh").body) for chat_id, number in ((1, "111"), (2, "222"))]
+        message = Mock()
+        message.body = json.dumps({"request_type": "refresh", "batch": batch}).encode("utf-8")
+        message.ack = AsyncMock()
+
+        backend = Mock()
+        backend.fetch_batch = AsyncMock(return_value=["OAM-111/DP-2023 status", None])
+        message.headers = {"x-jittered": True}
+        processor = make_processor(backend)
+
+        await processor.refresh_callback(message)
+
+        backend.fetch_batch.assert_awaited_once()
+        published = processor.messaging.publish_message.await_args.args
+        assert published[0] == "StatusUpdateQueue"
+        assert published[1]["status"] == "OAM-111/DP-2023 status"
+        # the failed entry is rescheduled on its own
+        rescheduled = processor.messaging.publish_delayed_message.await_args
+        assert rescheduled.args[0] == "RefreshStatusQueue"
+        assert rescheduled.args[1]["number"] == "222"
+        assert "batch" not in rescheduled.args[1]
+        assert rescheduled.kwargs["headers"]["x-retry-count"] == 1
+        assert rescheduled.kwargs["headers"]["x-attempts-left"] == 12
+        message.ack.assert_awaited_once()
+
+    asyncio.run(run_test())
+
+
+def test_browser_reuses_warm_page_unless_stale():
+    url = "https://frs.gov.cz/informace-o-stavu-rizeni/"
+    browser = Browser()
+    browser.app_details = {"number": "12345"}
+    browser.browser = Mock()
+    browser.browser.current_url = url
+    browser.browser.find_elements.return_value = [Mock()]
+    browser._current_status_html = Mock(return_value="OAM-111/DP-2023 status")
+
+    assert browser._can_reuse_page(url, {"number": "12345"})
+    # the same application again would show an identical status, so the page is reloaded
+    assert not browser._can_reuse_page(url, {"number": "111"})
+
+    browser.page_reuses = browser.max_page_reuses
+    assert not browser._can_reuse_page(url, {"number": "12345"})
+
+    browser.page_reuses = 0
+    browser.browser.current_url = "about:blank"
+    assert not browser._can_reuse_page(url, {"number": "12345"})
+    browser.executor.shutdown()
+
+
+@pytest.mark.parametrize("delay, delay_queue", [(10, "Queue.delay.30"), (45, "Queue.delay.60"), (5000, "Queue.delay.120")])
+def test_messaging_picks_backoff_queue(delay, delay_queue):
+    messaging = Messaging("host", "user", "password")
+    messaging.delay_queues = {"Queue": [30, 60, 120]}
+    assert messaging._get_delay_queue("Queue", delay) == delay_queue
+    assert messaging._get_delay_queue("OtherQueue", delay) is None
+
+
+def test_messaging_routes_sharded_queue_through_hash_ring():
+    async def run_test():
+        messaging = Messaging("host", "user", "password", shard_id="fetcher-0")
+        messaging.channel = Mock(is_closed=False, default_exchange=AsyncMock())
+        messaging.shard_queues = {"Queue": "Queue.fetcher-0"}
+        messaging.exchanges = {"Queue": AsyncMock(), "Queue.delay": AsyncMock()}
+        messaging.delay_queues = {"Queue": [30, 60]}
+        app_details = {"number": "12345", "type": "dp", "year": 2023}
+
+        await messaging.publish_message("Queue", app_details)
+        await messaging.publish_delayed_message("Queue", app_details, 45, headers={"x-retry-count": 1})
+
+        assert messaging.exchanges["Queue"].publish.await_args.kwargs["routing_key"] == "12345/DP-2023"
+        delayed = messaging.exchanges["Queue.delay"].publish.await_args
+        assert delayed.kwargs["routing_key"] == "12345/DP-2023"
+        assert delayed.args[0].headers == {"x-retry-count": 1, "delay-tier": 60}
+        assert messaging._get_delay_queue("Queue", 45) == "Queue.sharded.delay.60"
+        messaging.channel.default_exchange.publish.assert_not_awaited()
+
+    asyncio.run(run_test())
+
+
+def test_messaging_set_prefetch_restarts_consumer():
+    async def run_test():
+        queue = AsyncMock()
+        queue.consume = AsyncMock(return_value="ctag-2")
+        callback = Mock()
+        channel = AsyncMock(is_closed=False)
+        messaging = Messaging("host", "user", "password")
+        messaging.consumer_channels = {"Queue": channel}
+        messaging.consumers = {"Queue": (queue, "ctag-1")}
+        messaging.consumer_callbacks = {"Queue": (queue, callback)}
+
+        assert await messaging.set_prefetch("Queue", 7)
+
+        queue.cancel.assert_awaited_once_with("ctag-1")
+        channel.set_qos.assert_awaited_once_with(prefetch_count=7)
+        queue.consume.assert_awaited_once_with(callback)
+        assert messaging.consumers["Queue"] == (queue, "ctag-2")
+
+        # a paused consumer gets the window when it's resumed
+        await messaging.pause_consumers()
+        assert await messaging.set_prefetch("Queue", 3)
+        assert queue.consume.await_count == 1 and "Queue" not in messaging.consumers
+        assert not await messaging.set_prefetch("OtherQueue", 3)
+
+    asyncio.run(run_test())
+
+
+def test_messaging_binds_sharded_backoff_queues_by_tier():
+    async def run_test():
+        delay_queues = {}
+
+        async def declare_queue(name, **kwargs):
+            delay_queues[name] = AsyncMock()
+            return delay_queues[name]
+
+        messaging = Messaging("host", "user", "password", shard_id="fetcher-0")
+        messaging.channel = Mock(
+            is_closed=False, declare_exchange=AsyncMock(), declare_queue=AsyncMock(side_effect=declare_queue)
+        )
+        messaging.shard_queues = {"Queue": "Queue.fetcher-0"}
+
+        await messaging.setup_delay_queues("Queue", [30, 60])
+
+        for delay in (30, 60):
+            arguments = delay_queues[f"Queue.sharded.delay.{delay}"].bind.await_args.kwargs["arguments"]
+            # a binding on x- keys only would match every message and copy it into every tier
+            assert arguments == {"x-match": "all", "delay-tier": delay}
+
+    asyncio.run(run_test())
+
+
+def test_messaging_leave_shards_hands_over_queued_messages():
+    async def run_test():
+        queued = Mock(body=json.dumps({"number": "12345", "type": "DP", "year": 2023}).encode(), headers=None)
+        queued.ack = AsyncMock()
+        shard_queue = AsyncMock()
+        shard_queue.get = AsyncMock(side_effect=[queued, None])
+        handover_exchange = AsyncMock()
+        messaging = Messaging("host", "user", "password", shard_id="fetcher-0")
+        messaging.connection = Mock(
+            channel=AsyncMock(return_value=AsyncMock(declare_exchange=AsyncMock(return_value=handover_exchange)))
+        )
+        messaging.channel = Mock(declare_queue=AsyncMock(return_value=shard_queue))
+        messaging.shard_queues = {"Queue": "Queue.fetcher-0"}
+        messaging.exchanges = {"Queue": AsyncMock()}
+        messaging.consumers = {"Queue": (shard_queue, "ctag")}
+
+        await messaging.leave_shards()
+
+        messaging.connection.channel.assert_awaited_once_with(on_return_raises=True)
+        shard_queue.cancel.assert_awaited_once_with("ctag")
+        shard_queue.unbind.assert_awaited_once_with(messaging.exchanges["Queue"], routing_key="1")
+        published = handover_exchange.publish.await_args
+        assert published.kwargs == {"routing_key": "12345/DP-2023", "mandatory": True}
+        assert published.args[0].message_id
+        queued.ack.assert_awaited_once()
+        shard_queue.bind.assert_not_awaited()
+
+    asyncio.run(run_test())
+
+
+def test_messaging_leave_shards_keeps_requests_without_other_shards():
+    async def run_test():
+        queued = Mock(body=json.dumps({"number": "12345", "type": "DP", "year": 2023}).encode(), headers=None)
+        queued.ack, queued.nack = AsyncMock(), AsyncMock()
+        shard_queue = AsyncMock()
+        shard_queue.get = AsyncMock(side_effect=[queued, queued, None])
+        # the exchange returns the request, no other shard queue is bound to it
+        handover_exchange = AsyncMock(publish=AsyncMock(side_effect=PublishError(Mock(delivery=Basic.Return()), Mock())))
+        messaging = Messaging("host", "user", "password", shard_id="fetcher-0")
+        messaging.connection = Mock(
+            channel=AsyncMock(return_value=AsyncMock(declare_exchange=AsyncMock(return_value=handover_exchange)))
+        )
+        messaging.channel = Mock(declare_queue=AsyncMock(return_value=shard_queue))
+        messaging.shard_queues = {"Queue": "Queue.fetcher-0"}
+        messaging.exchanges = {"Queue": AsyncMock()}
+
+        await messaging.leave_shards()
+
+        queued.nack.assert_awaited_once_with(requeue=True)
+        queued.ack.assert_not_awaited()
+        shard_queue.bind.assert_awaited_once_with(messaging.exchanges["Queue"], routing_key="1")
+
+    asyncio.run(run_test())
+
+
+def test_processor_retry_delay_grows_exponentially():
+    processor = make_processor(Mock())
+    delays = [processor._get_retry_delay(retry_count) for retry_count in range(1, 12)]
+    for retry_count, delay in enumerate(delays, start=1):
+        upper = min(30 * 2 ** (retry_count - 1), 1800)
+        assert upper / 2 <= delay <= upper
+
+
+def test_processor_defers_refresh_jitter_to_the_broker():
+    async def run_test():
+        backend = Mock()
+        backend.fetch = AsyncMock(return_value="OAM-12345/DP-2023 status")
+        processor = make_processor(backend)
+        message = make_message(1, request_type="refresh")
+
+        await processor.refresh_callback(message)
+
+        backend.fetch.assert_not_awaited()
+        message.ack.assert_awaited_once()
+        deferred = processor.messaging.publish_delayed_message.await_args
+        assert deferred.args[0] == "RefreshStatusQueue"
+        assert 5 <= deferred.args[2] <= 900
+        assert deferred.kwargs["headers"] == {"x-jittered": True}
+
+        jittered = make_message(1, request_type="refresh", headers=deferred.kwargs["headers"])
+        await processor.refresh_callback(jittered)
+        backend.fetch.assert_awaited_once()
+        jittered.ack.assert_awaited_once()
+
+    asyncio.run(run_test())
+
+
+def test_circuit_breaker_transitions():
+    async def run_test():
+        probe = AsyncMock(side_effect=[False, True])
+        breaker = CircuitBreaker(failure_threshold=2, open_seconds=10, max_open_seconds=15, probe=probe)
+        assert not breaker.record_failure()
+        assert breaker.record_failure()
+        assert breaker.state == OPEN and 0 < breaker.remaining() <= 10
+
+        assert not await breaker.try_half_open()
+        assert breaker.state == OPEN
+        assert await breaker.try_half_open()
+        assert breaker.state == HALF_OPEN
+
+        # a failure in half-open opens the circuit again for longer
+        assert breaker.record_failure()
+        assert breaker.open_seconds == 15
+        # a late success of a fetch started before the circuit opened is ignored
+        breaker.record_success()
+        assert breaker.state == OPEN
+        breaker.state = HALF_OPEN
+        breaker.record_success()
+        assert breaker.state == CLOSED and breaker.open_seconds == 10
+
+    asyncio.run(run_test())
+
+
+def test_processor_resumes_consumers_whenever_circuit_is_not_open():
+    async def run_test():
+        breaker = CircuitBreaker(failure_threshold=1, open_seconds=0.01, probe=AsyncMock(return_value=False))
+        processor = make_processor(Mock(), circuit_breaker=breaker)
+        breaker.trip()
+
+        async def close_meanwhile():
+            # the state changes behind the failed probe
+            breaker.state = CLOSED
+            return False
+
+        breaker.probe = close_meanwhile
+        await asyncio.wait_for(processor._recover(), 1)
+        processor.messaging.resume_consumers.assert_awaited_once()
+
+    asyncio.run(run_test())
+
+
+def test_processor_pauses_consumers_and_defers_while_circuit_is_open():
+    async def run_test():
+        backend = Mock()
+        backend.fetch = AsyncMock(return_value=None)
+        breaker = CircuitBreaker(failure_threshold=1, open_seconds=300)
+        processor = make_processor(backend, circuit_breaker=breaker)
+
+        await processor.fetch_callback(make_message(1))
+        processor.messaging.pause_consumers.assert_awaited_once()
+        assert breaker.is_open
+
+        parked = make_message(2, headers={"x-retry-count": 3})
+        await processor.fetch_callback(parked)
+        backend.fetch.assert_awaited_once()
+        parked.ack.assert_awaited_once()
+        deferred = processor.messaging.publish_delayed_message.await_args
+        assert deferred.args[0] == "ApplicationFetchQueue"
+        assert deferred.args[2] > 240
+        # the retry budget of a parked request is left alone
+        assert deferred.kwargs["headers"] == {"x-retry-count": 3}
+        processor.recovery_task.cancel()
+
+    asyncio.run(run_test())
+
+
+def test_retry_policy_travels_in_headers():
+    policy = RetryPolicy.from_headers({}, attempts=2, ttl=60)
+    assert policy.spend() and policy.spend()
+    assert not policy.spend()
+
+    restored = RetryPolicy.from_headers({"x-retry-count": 1, **policy.to_headers()}, attempts=12, ttl=3600)
+    assert restored.attempts == 0 and restored.deadline == policy.deadline
+    assert not restored.should_retry()
+
+    expired = RetryPolicy(attempts=5, deadline=time.time() - 1)
+    assert expired.exhausted()
+    fresh = RetryPolicy(attempts=5, deadline=time.time() + 60)
+    fresh.record_error(PERMANENT)
+    assert not fresh.should_retry()
+
+
+def test_browser_retries_stop_when_budget_is_spent():
+    async def run_test():
+        browser = Browser(retries=3)
+
+        def failing_fetch(url, app_details, reuse_page, retry_policy):
+            browser.app_details = app_details
+            retry_policy.spend()
+            retry_policy.spend()
+            retry_policy.record_error(TRANSIENT)
+            return None
+
+        browser._fetch_with_browser = Mock(side_effect=failing_fetch)
+        policy = RetryPolicy(attempts=2, deadline=time.time() + 60)
+
+        assert await browser.fetch("url", {"number": "12345"}, retry_policy=policy) is None
+        # the submissions of the first attempt used up the budget, no retries with sleeps follow
+        assert browser._fetch_with_browser.call_count == 1
+        browser.executor.shutdown()
+
+    asyncio.run(run_test())
+
+
+def test_processor_does_not_retry_rejected_application():
+    async def run_test():
+        async def rejected_fetch(url, app_details, retry_policy=None):
+            retry_policy.spend()
+            retry_policy.record_error(PERMANENT)
+            return None
+
+        backend = Mock()
+        backend.fetch = AsyncMock(side_effect=rejected_fetch)
+        breaker = CircuitBreaker(failure_threshold=1)
+        processor = make_processor(backend, circuit_breaker=breaker)
+
+        await processor.fetch_callback(make_message(1))
+
+        processor.messaging.publish_delayed_message.assert_not_awaited()
+        published = processor.messaging.publish_message.await_args.args
+        assert published[0] == "StatusUpdateQueue" and published[1]["failed"]
+        assert breaker.state == CLOSED
+
+    asyncio.run(run_test())
+
+
+def test_processor_counts_captcha_apart_from_site_failures():
+    async def run_test():
+        async def captcha_fetch(url, app_details, retry_policy=None):
+            retry_policy.spend()
+            retry_policy.record_error(CAPTCHA)
+            return None
+
+        backend = Mock()
+        backend.fetch = AsyncMock(side_effect=captcha_fetch)
+        breaker = CircuitBreaker(failure_threshold=1)
+        processor = make_processor(backend, circuit_breaker=breaker)
+
+        await processor.fetch_callback(make_message(1))
+
+        recorded = [call.args[0] for call in processor.metrics_collector.record_fetch_status.call_args_list]
+        assert recorded == ["captcha", "retried"]
+        # the site answered, it is not a reason to stop fetching
+        assert breaker.state == CLOSED
+        processor.messaging.publish_delayed_message.assert_awaited_once()
+
+    asyncio.run(run_test())
+
+
+def test_processor_drops_expired_refresh_and_deprioritizes_expired_fetch():
+    async def run_test():
+        backend = Mock()
+        backend.fetch = AsyncMock(return_value="OAM-12345/DP-2023 status")
+        processor = make_processor(backend)
+        refresh = make_message(1, request_type="refresh", headers={"x-jittered": True})
+        fetch = make_message(2)
+        for message in (refresh, fetch):
+            body = json.loads(message.body)
+            body["deadline"] = time.time() - 10
+            message.body = json.dumps(body).encode("utf-8")
+
+        await processor.refresh_callback(refresh)
+        backend.fetch.assert_not_awaited()
+        refresh.ack.assert_awaited_once()
+
+        await processor.fetch_callback(fetch)
+        assert backend.fetch.await_args.args[1]["expired"]
+        fetch.ack.assert_awaited_once()
+        recorded = [call.args[0] for call in processor.metrics_collector.record_fetch_status.call_args_list]
+        assert recorded == ["expired", "expired", "success"]
+
+    asyncio.run(run_test())